@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""Resolve NCBI accessions and sample names to SAMPLE_NAME,SAMN,SRA,GENBANK (Python replacement for acc-finder).
+
+Inputs may be BioSample accessions (SAMN...), assemblies (GCA_/GCF_...), SRA runs/submissions (SRR/SRA...) or
+sample names, one per line or whitespace-separated, same as acc-finder:
+
+    python acc_finder.py accessions.txt > accessions.csv
+
+Instead of one esearch | efetch pipeline per input and field, every lookup is batched: up to --batch_size
+terms go into one esearch (history server) followed by paged esummary calls. Requests run concurrently under a
+token-bucket limit (3/s, or 10/s with an API key), and every mapping found - or confirmed missing - is kept in a
+local SQLite cache, so repeated lookups make no requests at all. Point --base_url (or NCBI_EUTILS_URL) at a
+local stand-in to run without NCBI.
+"""
+import asyncio
+import os
+import re
+import sqlite3
+import sys
+import time
+from argparse import ArgumentParser
+
+import requests
+
+DEFAULT_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".acc_finder_cache.sqlite")
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_SUMMARY_PAGE = 500
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRIES = 5
+DEFAULT_MISSING_TTL = 7  # days before an accession that NCBI did not know is looked up again
+RESULT_COLS = ["SAMPLE_NAME", "SAMN", "SRA", "GENBANK"]
+
+
+#----- INPUT TYPES -----#
+def input_kind(value):
+    """Which lookup turns this input into a BioSample accession (None when it already is one)."""
+    if re.match(r"^SAMN[0-9]+", value):
+        return None
+    if re.match(r"^GC[AF]_[0-9]+\.[0-9]", value):
+        return "samn_from_assembly"
+    if re.match(r"^SR[RA][0-9]+", value):
+        return "samn_from_sra"
+    return "samn_from_name"
+
+
+#----- DOCSUM PARSING -----#
+def identifier_values(identifiers):
+    """'BioSample: SAMN1; Sample name: WA-1; SRA: SRS2' -> ['SAMN1', 'WA-1', 'SRS2'] (spaces dropped, as acc-finder)."""
+    return [part.split(":")[-1] for part in identifiers.replace(" ", "").replace('"', "").split(";")]
+
+
+def xml_accessions(*fields):
+    return [acc for field in fields for acc in re.findall(r'acc="([^"]+)"', field or "")]
+
+
+def biosample_of(expxml):
+    match = re.search(r"<Biosample>(.*?)</Biosample>", expxml or "")
+    return match.group(1) if match else None
+
+
+# each parser maps the keys of one batch to a value, given the docsums in NCBI's order (first match wins)
+def parse_samn_from_name(docsums, keys):
+    # esearch matches names case-insensitively, so compare them that way too
+    found = {}
+    for doc in docsums:
+        names = {str(n).upper() for n in [doc.get("accession")] + identifier_values(doc.get("identifiers", ""))}
+        for key in keys:
+            if key not in found and key.upper() in names:
+                found[key] = doc.get("accession")
+    return found
+
+
+def parse_samn_from_sra(docsums, keys):
+    found = {}
+    for doc in docsums:
+        accessions = set(xml_accessions(doc.get("expxml"), doc.get("runs")))
+        for key in keys:
+            if key not in found and key in accessions:
+                found[key] = biosample_of(doc.get("expxml"))
+    return found
+
+
+def parse_samn_from_assembly(docsums, keys):
+    found = {}
+    for doc in docsums:
+        synonym = doc.get("synonym") or {}
+        accessions = {doc.get("assemblyaccession"), synonym.get("genbank"), synonym.get("refseq")}
+        for key in keys:
+            if key not in found and key in accessions:
+                found[key] = doc.get("biosampleaccn")
+    return found
+
+
+def parse_sample_name(docsums, keys):
+    found = {}
+    for doc in docsums:
+        values = identifier_values(doc.get("identifiers", ""))
+        if doc.get("accession") in keys and doc.get("accession") not in found:
+            found[doc["accession"]] = values[1] if len(values) > 1 else None
+    return found
+
+
+def parse_sra(docsums, keys):
+    found = {}
+    for doc in docsums:
+        samn = biosample_of(doc.get("expxml"))
+        runs = xml_accessions(doc.get("runs"))
+        if samn in keys and samn not in found and runs:
+            found[samn] = runs[0]
+    return found
+
+
+def parse_genbank(docsums, keys):
+    found = {}
+    for doc in docsums:
+        samn = doc.get("biosampleaccn")
+        if samn in keys and samn not in found:
+            found[samn] = (doc.get("synonym") or {}).get("genbank")
+    return found
+
+
+# kind -> (database to search, parser)
+LOOKUPS = {
+    "samn_from_name": ("biosample", parse_samn_from_name),
+    "samn_from_sra": ("sra", parse_samn_from_sra),
+    "samn_from_assembly": ("assembly", parse_samn_from_assembly),
+    "sample_name": ("biosample", parse_sample_name),
+    "sra": ("sra", parse_sra),
+    "genbank": ("assembly", parse_genbank),
+}
+
+
+#----- CACHE -----#
+class AccessionCache:
+    """kind/key -> value mappings in SQLite. A NULL value records that NCBI had no answer at `fetched`."""
+
+    def __init__(self, path=DEFAULT_CACHE, missing_ttl=DEFAULT_MISSING_TTL):
+        self.path = path
+        self.missing_ttl = missing_ttl * 24 * 3600
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS mappings (
+                                 kind TEXT NOT NULL,
+                                 key TEXT NOT NULL,
+                                 value TEXT,
+                                 fetched REAL NOT NULL,
+                                 PRIMARY KEY (kind, key))""")
+        self.conn.commit()
+
+    def get_many(self, kind, keys):
+        """Cached values of the keys that are known (found, or missing for less than missing_ttl)."""
+        found = {}
+        keys = list(keys)
+        oldest_missing = time.time() - self.missing_ttl
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(f"SELECT key, value, fetched FROM mappings WHERE kind = ? AND key IN ({','.join('?' * len(chunk))})",
+                                     [kind] + chunk)
+            for key, value, fetched in rows:
+                if value is not None or fetched >= oldest_missing:
+                    found[key] = value
+        return found
+
+    def put_many(self, kind, values):
+        now = time.time()
+        self.conn.executemany("INSERT OR REPLACE INTO mappings (kind, key, value, fetched) VALUES (?, ?, ?, ?)",
+                              [(kind, key, value, now) for key, value in values.items()])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+#----- E-UTILITIES -----#
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of at most `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class EUtils:
+    """Rate-limited E-utilities client. Requests are POSTed so long OR-joined terms are not limited by URL length."""
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, api_key=None, email=None, rate=None,
+                 concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES, summary_page=DEFAULT_SUMMARY_PAGE):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.params = {k: v for k, v in [("api_key", api_key), ("email", email), ("tool", "acc_finder")] if v}
+        self.bucket = TokenBucket(rate or (10 if api_key else 3))
+        self.slots = asyncio.Semaphore(concurrency)
+        self.retries = retries
+        self.summary_page = summary_page
+        self.session = requests.Session()
+        self.n_requests = 0
+
+    async def request(self, endpoint, params):
+        for attempt in range(self.retries + 1):
+            async with self.slots:
+                await self.bucket.acquire()
+                self.n_requests += 1
+                try:
+                    response = await asyncio.to_thread(self.session.post, self.base_url + endpoint,
+                                                       data={**self.params, **params, "retmode": "json"}, timeout=60)
+                    if response.status_code not in (429, 500, 502, 503, 504):
+                        response.raise_for_status()
+                        return response.json()
+                    error = f"HTTP {response.status_code}"
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = str(e)
+            if attempt < self.retries:
+                await asyncio.sleep(min(2 ** attempt, 30))
+        raise RuntimeError(f"{endpoint} failed after {self.retries + 1} attempts: {error}")
+
+    async def docsums(self, db, terms):
+        """Document summaries of every record matching any of the terms, in search order."""
+        search = (await self.request("esearch.fcgi", {"db": db, "term": " OR ".join(f'"{t}"' for t in terms),
+                                                      "usehistory": "y", "retmax": 0}))["esearchresult"]
+        if "ERROR" in search:
+            raise RuntimeError(f"esearch {db}: {search['ERROR']}")
+        count = int(search["count"])
+        pages = await asyncio.gather(*(
+            self.request("esummary.fcgi", {"db": db, "WebEnv": search["webenv"], "query_key": search["querykey"],
+                                           "retstart": start, "retmax": self.summary_page})
+            for start in range(0, count, self.summary_page)))
+        return [page["result"][uid] for page in pages for uid in page.get("result", {}).get("uids", [])]
+
+    def close(self):
+        self.session.close()
+
+
+class Resolver:
+    def __init__(self, eutils, cache, batch_size=DEFAULT_BATCH_SIZE):
+        self.eutils = eutils
+        self.cache = cache
+        self.batch_size = batch_size
+        self.errors = []
+
+    async def _fetch(self, kind, batch):
+        db, parse = LOOKUPS[kind]
+        try:
+            found = parse(await self.eutils.docsums(db, batch), set(batch))
+        except Exception as e:
+            # leave the batch out of the cache so the next run tries again
+            self.errors.append(f"{kind} lookup of {len(batch)} term(s) failed: {e}")
+            return {}
+        values = {key: found.get(key) for key in batch}
+        self.cache.put_many(kind, values)
+        return values
+
+    async def lookup(self, kind, keys):
+        """key -> value (None when NCBI has no answer) for every key, from the cache where possible."""
+        keys = list(dict.fromkeys(k for k in keys if k))
+        values = self.cache.get_many(kind, keys)
+        todo = [k for k in keys if k not in values]
+        batches = [todo[i:i + self.batch_size] for i in range(0, len(todo), self.batch_size)]
+        for fetched in await asyncio.gather(*(self._fetch(kind, batch) for batch in batches)):
+            values.update(fetched)
+        return values
+
+    async def resolve(self, inputs):
+        """One [SAMPLE_NAME, SAMN, SRA, GENBANK] row per input, in input order."""
+        by_kind = {}
+        for value in inputs:
+            kind = input_kind(value)
+            if kind is not None:
+                by_kind.setdefault(kind, []).append(value)
+        samn = {value: value for value in inputs if input_kind(value) is None}
+        for found in await asyncio.gather(*(self.lookup(kind, values) for kind, values in by_kind.items())):
+            samn.update(found)
+
+        accessions = [a for a in samn.values() if a]
+        names, sra, genbank = await asyncio.gather(self.lookup("sample_name", accessions),
+                                                   self.lookup("sra", accessions),
+                                                   self.lookup("genbank", accessions))
+        rows = []
+        for value in inputs:
+            acc = samn.get(value)
+            rows.append([names.get(acc), acc, sra.get(acc), genbank.get(acc)] if acc else [None, None, None, None])
+        return rows
+
+
+def read_inputs(path):
+    with open(path) as f:
+        return f.read().split()
+
+
+async def main(args):
+    eutils = EUtils(args.base_url, args.api_key, args.email, args.rate, args.concurrency)
+    cache = AccessionCache(args.cache, args.missing_ttl)
+    resolver = Resolver(eutils, cache, args.batch_size)
+    try:
+        rows = await resolver.resolve(read_inputs(args.list))
+    finally:
+        eutils.close()
+        cache.close()
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    out.write(",".join(RESULT_COLS) + "\n")
+    for row in rows:
+        out.write(",".join(value or "" for value in row) + "\n")
+    if args.output:
+        out.close()
+    print(f"{len(rows)} input(s) resolved with {eutils.n_requests} E-utilities request(s)", file=sys.stderr)
+    for error in resolver.errors:
+        print(f"Error: {error}", file=sys.stderr)
+    return 1 if resolver.errors else 0
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Resolve NCBI accessions (SAMN, GENBANK/REFSEQ, SRA) and/or sample names to SAMPLE_NAME,SAMN,SRA,GENBANK.")
+    parser.add_argument("list", help="File of accessions and/or sample names")
+    parser.add_argument("-o", "--output", help="CSV to write (Default: stdout)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help=f"SQLite cache of resolved mappings (Default: {DEFAULT_CACHE})")
+    parser.add_argument("--missing_ttl", type=float, default=DEFAULT_MISSING_TTL,
+                        help=f"Days before a term NCBI did not know is looked up again (Default: {DEFAULT_MISSING_TTL})")
+    parser.add_argument("--base_url", default=os.environ.get("NCBI_EUTILS_URL", DEFAULT_BASE_URL),
+                        help="E-utilities base URL, e.g. a local stand-in (Default: $NCBI_EUTILS_URL or NCBI)")
+    parser.add_argument("--api_key", default=os.environ.get("NCBI_API_KEY"), help="NCBI API key (Default: $NCBI_API_KEY)")
+    parser.add_argument("--email", default=os.environ.get("NCBI_EMAIL"), help="Contact email sent to NCBI (Default: $NCBI_EMAIL)")
+    parser.add_argument("--rate", type=float, help="Requests per second (Default: 3, or 10 with an API key)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Requests in flight at once (Default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"Terms per esearch request (Default: {DEFAULT_BATCH_SIZE})")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,134 @@
+"""Synthetic inputs shaped like the real ones, sized by row/object count.
+
+Every generator is deterministic for a given size and seed so runs are comparable with the stored baselines.
+"""
+import os
+import sqlite3
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+RUN_PREFIX = "workflow/phoenix/runs/RUN0001"
+
+
+def sample_ids(n: int) -> List[str]:
+    return [f"WA{i:07d}" for i in range(n)]
+
+
+def terra_entities(n: int, n_extra_cols: int = 20, seed: int = 0) -> List[Dict]:
+    """Entities as returned by the Terra entityQuery API, PHoeNIx-style (gs:// outputs plus QC columns)."""
+    rng = np.random.default_rng(seed)
+    qc = rng.choice(["PASS", "FAIL"], n, p=[0.9, 0.1])
+    species = rng.choice(["Escherichia coli", "Klebsiella pneumoniae", "Staphylococcus aureus"], n)
+    coverage = rng.normal(60, 15, n).round(2)
+    entities = []
+    for i, sample in enumerate(sample_ids(n)):
+        root = f"gs://fc-workspace/submissions/sub{i % 97:04d}/phoenix/wf{i:07d}"
+        attributes = {"assembly": f"{root}/call-assembly/{sample}.scaffolds.fa.gz",
+                      "trimmed_read1": f"{root}/call-fastp/{sample}_1.trim.fastq.gz",
+                      "trimmed_read2": f"{root}/call-fastp/{sample}_2.trim.fastq.gz",
+                      "qc_outcome": qc[i],
+                      "species": species[i],
+                      "coverage": float(coverage[i])}
+        for j in range(n_extra_cols):
+            attributes[f"metric_{j}"] = f"{(i * 31 + j) % 1000}"
+        entities.append({"entityType": "sample", "name": f"{sample}-WA-M01234", "attributes": attributes})
+    return entities
+
+
+def terra_table(n: int, n_extra_cols: int = 20, seed: int = 0) -> pd.DataFrame:
+    """The same entities as an exported table, sample ID first."""
+    entities = terra_entities(n, n_extra_cols, seed)
+    df = pd.DataFrame([e["attributes"] for e in entities])
+    df.insert(0, "sample_id", [e["name"] for e in entities])
+    return df
+
+
+def mash_results(path: str, n: int, n_refs: int = 50, seed: int = 0) -> str:
+    """results.txt (reference, sample, ANI) with n rows spread over n_refs references."""
+    rng = np.random.default_rng(seed)
+    n_samples = max(1, n // n_refs)
+    refs = np.repeat([f"reference_genomes/ref{r:03d}.fna" for r in range(n_refs)], n_samples)[:n]
+    samples = np.tile([f"assemblies/{s}.fna" for s in sample_ids(n_samples)], n_refs)[:n]
+    ani = np.clip(rng.normal(97, 2, len(refs)), 80, 100).round(4)
+    pd.DataFrame({"reference": refs, "sample": samples, "ani": ani}).to_csv(path, sep="\t", index=False, header=False)
+    return path
+
+
+def phoenix_keys(n_samples: int, prefix: str = RUN_PREFIX, files_per_sample: int = 6) -> List[str]:
+    """Keys of a PHoeNIx run prefix as listed from S3, in key order."""
+    keys = [prefix + "/"]
+    for sample in sample_ids(n_samples):
+        sample = f"{sample}1"  # sample directories end with a digit
+        keys.append(f"{prefix}/{sample}/")
+        keys.append(f"{prefix}/{sample}/{sample}_summaryline.tsv")
+        for j in range(files_per_sample - 2):
+            keys.append(f"{prefix}/{sample}/qc_stats/{sample}_{j}.txt")
+        keys.append(f"{prefix}/reads/{sample}_R1_001.fastq.gz")
+        keys.append(f"{prefix}/reads/{sample}_R2_001.fastq.gz")
+    return sorted(keys)
+
+
+def fastq_keys(n_samples: int, prefix: str = "reads/run1", unpaired_every: int = 1000) -> List[str]:
+    """Paired read keys for samplesheet-from-s3.py, with an occasional missing mate."""
+    keys = []
+    for i, sample in enumerate(sample_ids(n_samples)):
+        keys.append(f"{prefix}/{sample}_S{i}_L001_R1_001.fastq.gz")
+        if i % unpaired_every:
+            keys.append(f"{prefix}/{sample}_S{i}_L001_R2_001.fastq.gz")
+    return keys
+
+
+def starlims_db(path: str, n: int, seed: int = 0) -> str:
+    """SQLite table shaped like a StarLIMS results query (used with starlims_query.extract)."""
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 365 * 24 * 3600, n), unit="s")
+    df = pd.DataFrame({"ORDNO": np.arange(n),
+                       "EXTERNAL_ID": [f"WA{i:07d}" for i in range(n)],
+                       "TESTCODE": rng.choice(["WGS", "AST", "PCR", "MALDI"], n),
+                       "RESULT": rng.choice(["Positive", "Negative", "Indeterminate"], n),
+                       "NUMRES": rng.normal(30, 5, n).round(3),
+                       "SUBMITTER": rng.choice([f"Lab {i}" for i in range(40)], n),
+                       "DATE_RECEIVED": dates.strftime("%Y-%m-%d %H:%M:%S")})
+    if os.path.exists(path):
+        os.remove(path)
+    with sqlite3.connect(path) as conn:
+        df.to_sql("RESULTS", conn, index=False)
+    return path
+
+
+def ncbi_records(n: int) -> Dict[str, Dict[str, Dict]]:
+    """BioSample, SRA and assembly docsums (as returned by esummary) for n samples, keyed by db then uid."""
+    biosample, sra, assembly = {}, {}, {}
+    for i, sample in enumerate(sample_ids(n)):
+        samn = f"SAMN{30000000 + i}"
+        biosample[str(1000000 + i)] = {"uid": str(1000000 + i), "accession": samn,
+                                       "identifiers": f"BioSample: {samn}; Sample name: {sample}; SRA: SRS{5000000 + i}"}
+        sra[str(2000000 + i)] = {"uid": str(2000000 + i),
+                                 "expxml": f'<Summary><Title>{sample}</Title></Summary><Experiment acc="SRX{7000000 + i}"/>'
+                                           f'<Biosample>{samn}</Biosample>',
+                                 "runs": f'<Run acc="SRR{9000000 + i}" total_spots="1000000" is_public="true"/>'}
+        if i % 4:  # not every sample has an assembly
+            assembly[str(3000000 + i)] = {"uid": str(3000000 + i), "assemblyaccession": f"GCA_{i:09d}.1",
+                                          "biosampleaccn": samn,
+                                          "synonym": {"genbank": f"GCA_{i:09d}.1", "refseq": ""}}
+    return {"biosample": biosample, "sra": sra, "assembly": assembly}
+
+
+def ncbi_inputs(n: int) -> List[str]:
+    """acc-finder input list mixing sample names, SAMN, SRR and GCA accessions of ncbi_records(n)."""
+    inputs = []
+    for i, sample in enumerate(sample_ids(n)):
+        inputs.append([sample, f"SAMN{30000000 + i}", f"SRR{9000000 + i}", f"GCA_{i:09d}.1"][i % 4])
+    return inputs
+
+
+def transfer_jobs(n_objects: int, bucket: str = "fc-workspace", files_per_sample: int = 3) -> Dict[str, List]:
+    """gcp2aws-style manifest: per sample an assembly and two read files, as (gs_uri, s3_uri) pairs."""
+    jobs = {}
+    for i in range(n_objects):
+        sample = f"WA{i // files_per_sample:07d}"
+        name = f"{sample}_{i % files_per_sample}.fastq.gz"
+        jobs.setdefault(sample, []).append((f"gs://{bucket}/data/{name}", f"s3://bench-bucket/reads/{name}"))
+    return jobs
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""Time the transfer and summarization hot paths on synthetic data and compare them with stored baselines.
+
+    python benchmarks/run_benchmarks.py --save                      # record baselines on this machine
+    python benchmarks/run_benchmarks.py                             # compare a later run against them
+    python benchmarks/run_benchmarks.py --cases mash_best_ref transfer_plan --sizes 1000 1000000
+
+By default each case runs at 10^3, 10^4 and 10^5 rows or objects. 10^6 can be asked for with --sizes, but the
+cases that go through moto, the Terra stand-in or the E-utilities stand-in are capped below that (samplesheet_listing,
+gcp2aws_transfer and acc_finder at 10^4, terra_export at 10^5) because their setup alone takes minutes at larger
+sizes; sizes above a case's cap are reported as skipped.
+
+Baselines are wall-clock times and only mean something on the machine that recorded them. A case whose best
+time is more than --threshold times its baseline is reported as a regression and the exit code is 1. Cases
+that need an optional package (moto, firecloud, google-cloud-storage, ...) are skipped when it is missing.
+S3, GCS, Terra and NCBI E-utilities are replaced by the local stand-ins in stand_ins.py.
+"""
+import asyncio
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [HERE, ROOT, os.path.join(ROOT, "waphl-terra2aws")]
+
+import generators
+import stand_ins
+from stand_ins import MissingDependency
+
+DEFAULT_BASELINE = os.path.join(HERE, "baselines.json")
+DEFAULT_SIZES = [10**3, 10**4, 10**5]
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 1.25
+
+CASES = {}
+
+
+def case(name, max_size=10**6):
+    """Register a benchmark. The function is a context manager that does the setup for a size and yields the
+    zero-argument callable to time."""
+    def register(fn):
+        CASES[name] = (contextlib.contextmanager(fn), max_size)
+        return fn
+    return register
+
+
+def load_script(name, path):
+    """Import a script whose file name is not a valid module name (e.g. samplesheet-from-s3.py)."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def require(module):
+    try:
+        return importlib.import_module(module)
+    except ImportError as e:
+        raise MissingDependency(e.name or module)
+
+
+#----- CASES -----#
+@case("mash_best_ref")
+def bench_best_ref(size, tmp):
+    mash_summary = require("mash_summary")
+    df = mash_summary.read_mash_table(generators.mash_results(os.path.join(tmp, "results.txt"), size))
+    yield lambda: mash_summary.best_ref(df)
+
+
+@case("mash_bad_ani_seqs")
+def bench_bad_ani_seqs(size, tmp):
+    mash_summary = require("mash_summary")
+    df = mash_summary.read_mash_table(generators.mash_results(os.path.join(tmp, "results.txt"), size))
+    ref = mash_summary.best_ref(df)
+    yield lambda: mash_summary.bad_ani_seqs(df, ref, mash_summary.DEFAULT_MIN_ANI)
+
+
+@case("phoenix_reads")
+def bench_phoenix_reads(size, tmp):
+    require("boto3")
+    s3_phoenix_fix = require("s3_phoenix_fix")
+    # 8 keys per sample: directory, summaryline, 4 QC files and 2 reads
+    keys = generators.phoenix_keys(max(1, size // 8))
+    yield lambda: s3_phoenix_fix.get_phoenix_reads(keys, "bench-bucket", generators.RUN_PREFIX)
+
+
+@case("samplesheet_pairing")
+def bench_samplesheet_pairing(size, tmp):
+    require("boto3")
+    samplesheet = load_script("samplesheet_from_s3", "samplesheet-from-s3.py")
+    keys = generators.fastq_keys(max(1, size // 2))
+    yield lambda: samplesheet.pair_reads(keys)
+
+
+@case("samplesheet_listing", max_size=10**4)
+def bench_samplesheet_listing(size, tmp):
+    samplesheet = load_script("samplesheet_from_s3", "samplesheet-from-s3.py")
+    with stand_ins.moto_s3("bench-bucket") as s3_client:
+        for key in generators.fastq_keys(max(1, size // 2)):
+            s3_client.put_object(Bucket="bench-bucket", Key=key, Body=b"")
+        yield lambda: samplesheet.pair_reads(samplesheet.iter_keys(s3_client, "bench-bucket", "reads/"))
+
+
+@case("terra_export", max_size=10**5)
+def bench_terra_export(size, tmp):
+    require("tqdm")
+    with stand_ins.terra_api(generators.terra_entities(size)):
+        export_large_tsv = require("export_large_tsv")
+        yield lambda: export_large_tsv.download_tsv_from_workspace("bench", "bench", "sample", os.path.join(tmp, "sample.tsv"))
+
+
+@case("transfer_plan")
+def bench_transfer_plan(size, tmp):
+    transfer_plan = require("transfer_plan")
+    df = generators.terra_table(size).rename(columns={"sample_id": "sample"})
+    uri_cols = transfer_plan.detect_uri_columns(df.drop(columns="sample"))
+    yield lambda: transfer_plan.build_transfer_plan(df, uri_cols, [r"WA\d{7}"], "phoenix")
+
+
+@case("starlims_extract")
+def bench_starlims_extract(size, tmp):
+    require("pyarrow")
+    starlims_query = require("starlims_query")
+    db = generators.starlims_db(os.path.join(tmp, "starlims.sqlite"), size)
+    output = os.path.join(tmp, "results.parquet")
+    yield lambda: starlims_query.extract(lambda: sqlite3.connect(db), "SELECT * FROM RESULTS", output, "parquet")
+
+
+@case("gcp2aws_transfer", max_size=10**4)
+def bench_gcp2aws_transfer(size, tmp):
+    gcs2s3 = require("gcs2s3")
+    jobs = generators.transfer_jobs(size)
+    objects = {gs_uri: os.urandom(1024) for files in jobs.values() for gs_uri, _ in files}
+    gcs_client = stand_ins.gcs_client(objects)
+    with stand_ins.moto_s3("bench-bucket") as s3_client:
+        yield lambda: gcs2s3.transfer_samples(jobs, gcs_client, s3_client)
+
+
+@case("acc_finder", max_size=10**4)
+def bench_acc_finder(size, tmp):
+    require("requests")
+    acc_finder = require("acc_finder")
+    inputs = generators.ncbi_inputs(size)
+    runs = iter(range(10**6))
+
+    async def resolve(base_url):
+        # a fresh cache every run, otherwise every run after the first makes no requests
+        eutils = acc_finder.EUtils(base_url, rate=1000)
+        cache = acc_finder.AccessionCache(os.path.join(tmp, f"cache{next(runs)}.sqlite"))
+        try:
+            return await acc_finder.Resolver(eutils, cache).resolve(inputs)
+        finally:
+            eutils.close()
+            cache.close()
+
+    with stand_ins.eutils_server(generators.ncbi_records(size)) as (base_url, _):
+        yield lambda: asyncio.run(resolve(base_url))
+
+
+#----- RUNNER -----#
+def time_case(name, size, repeat):
+    """Best wall-clock time of `repeat` runs, in seconds."""
+    setup, _ = CASES[name]
+    with tempfile.TemporaryDirectory() as tmp, setup(size, tmp) as run:
+        times = []
+        for _ in range(repeat):
+            # keep progress bars and per-object prints out of the report
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                start = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get("results", {})
+
+
+def save_baselines(path, results):
+    baselines = load_baselines(path)
+    baselines.update(results)
+    with open(path, "w") as f:
+        json.dump({"machine": platform.node(), "python": platform.python_version(), "platform": platform.platform(),
+                   "results": dict(sorted(baselines.items()))}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the transfer and summarization hot paths on synthetic data.")
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=sorted(CASES), help="Cases to run (Default: all)")
+    caps = ", ".join(f"{name} {max_size}" for name, (_, max_size) in sorted(CASES.items()) if max_size < 10**6)
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES,
+                        help=f"Rows or objects per case, up to 1000000; sizes above a case's cap are skipped ({caps}) (Default: {DEFAULT_SIZES})")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help=f"Runs per case, the best is kept (Default: {DEFAULT_REPEAT})")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="JSON file of baseline times (Default: benchmarks/baselines.json)")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Slowdown relative to the baseline that counts as a regression (Default: {DEFAULT_THRESHOLD})")
+    parser.add_argument("--save", action="store_true", help="Store this run's times as the new baselines")
+    args = parser.parse_args()
+
+    baselines = load_baselines(args.baseline)
+    results = {}
+    regressions = []
+    print(f"{'case':<22}{'size':>9}{'seconds':>11}{'baseline':>11}{'ratio':>8}  status")
+    for name in args.cases:
+        for size in sorted(args.sizes):
+            if size > CASES[name][1]:
+                print(f"{name:<22}{size:>9}{'':>11}{'':>11}{'':>8}  skipped (capped at {CASES[name][1]})")
+                continue
+            key = f"{name}/{size}"
+            try:
+                seconds = time_case(name, size, args.repeat)
+            except MissingDependency as e:
+                print(f"{name:<22}{size:>9}{'':>11}{'':>11}{'':>8}  skipped (needs {e})")
+                break
+            results[key] = seconds
+            baseline = baselines.get(key)
+            ratio = seconds / baseline if baseline else None
+            status = "new" if ratio is None else ("REGRESSION" if ratio > args.threshold else "ok")
+            if status == "REGRESSION":
+                regressions.append(key)
+            print(f"{name:<22}{size:>9}{seconds:>11.4f}{baseline or float('nan'):>11.4f}{ratio or float('nan'):>8.2f}  {status}", flush=True)
+
+    if args.save:
+        save_baselines(args.baseline, results)
+        print(f"\nBaselines for {len(results)} case(s) saved to {args.baseline}")
+    if regressions:
+        sys.exit(f"\n{len(regressions)} regression(s) over {args.threshold}x baseline: {', '.join(regressions)}")
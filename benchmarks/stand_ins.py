@@ -0,0 +1,240 @@
+"""Local stand-ins for the remote services the benchmarked code talks to.
+
+- S3: moto's in-process mock (optional, `pip install moto`).
+- GCS: fake-gcs-server when STORAGE_EMULATOR_HOST is set (e.g. `docker run -p 4443:4443 fsouza/fake-gcs-server
+  -scheme http` and STORAGE_EMULATOR_HOST=http://localhost:4443), otherwise an in-process fake client with the
+  parts of the google-cloud-storage API that gcs2s3.py and table_snapshot.py use.
+- Terra: firecloud.api's entity calls patched to serve pages from a list of synthetic entities.
+- NCBI: a local HTTP server answering esearch (with history) and esummary over synthetic docsums, for
+  acc_finder.py --base_url.
+"""
+import base64
+import contextlib
+import datetime
+import hashlib
+import io
+import math
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+
+class MissingDependency(Exception):
+    """Raised when a benchmark needs an optional package that is not installed."""
+
+
+#----- S3 -----#
+@contextlib.contextmanager
+def moto_s3(*buckets):
+    """In-process S3 with the given buckets created. Yields a boto3 S3 client."""
+    try:
+        from moto import mock_aws
+    except ImportError:
+        raise MissingDependency("moto")
+    import boto3
+
+    with mock.patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench",
+                                      "AWS_DEFAULT_REGION": "us-east-1"}), mock_aws():
+        s3_client = boto3.client("s3", region_name="us-east-1")
+        for bucket in buckets:
+            s3_client.create_bucket(Bucket=bucket)
+        yield s3_client
+
+
+#----- GCS -----#
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def get_blob(self, name):
+        data = self.client.objects.get((self.name, name))
+        return None if data is None else FakeBlob(self, name, data)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, data):
+        self.bucket = bucket
+        self.name = name
+        self._data = data
+        self.size = len(data)
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        self.crc32c = base64.b64encode(google_crc32c.Checksum(data).digest()).decode() if google_crc32c else None
+        self.generation = hash((bucket.name, name, self.size)) & 0xFFFFFFFF
+        self.time_created = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def download_as_bytes(self, start=None, end=None):
+        # like google-cloud-storage, `end` is inclusive
+        return self._data[start or 0:None if end is None else end + 1]
+
+    def open(self, mode="rb", chunk_size=None):
+        return io.BytesIO(self._data)
+
+
+class FakeGCSClient:
+    """Objects held in memory as {(bucket, name): bytes}."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def upload(self, bucket, name, data):
+        self.objects[(bucket, name)] = data
+
+    def list_blobs(self, bucket, prefix="", fields=None):
+        for (b, name), data in sorted(self.objects.items()):
+            if b == bucket and name.startswith(prefix):
+                yield FakeBlob(self.bucket(b), name, data)
+
+
+def gcs_client(objects):
+    """A GCS client holding {gs_uri: bytes}: fake-gcs-server if STORAGE_EMULATOR_HOST is set, else in-process."""
+    if os.environ.get("STORAGE_EMULATOR_HOST"):
+        try:
+            from google.auth.credentials import AnonymousCredentials
+            from google.cloud import storage
+        except ImportError:
+            raise MissingDependency("google-cloud-storage")
+        client = storage.Client(project="bench", credentials=AnonymousCredentials())
+        for uri, data in objects.items():
+            bucket, _, name = uri[len("gs://"):].partition("/")
+            try:
+                client.create_bucket(bucket)
+            except Exception:
+                pass  # already exists
+            client.bucket(bucket).blob(name).upload_from_string(data)
+        return client
+
+    client = FakeGCSClient()
+    for uri, data in objects.items():
+        bucket, _, name = uri[len("gs://"):].partition("/")
+        client.upload(bucket, name, data)
+    return client
+
+
+#----- TERRA -----#
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self._payload = payload
+        self.status_code = status_code
+        self.text = ""
+
+    def json(self):
+        return self._payload
+
+
+@contextlib.contextmanager
+def terra_api(entities, entity_type="sample", latency=0.0):
+    """Serve entities through firecloud.api.list_entity_types / get_entities_query, with optional per-page latency."""
+    try:
+        from firecloud import api as fapi
+    except ImportError:
+        raise MissingDependency("firecloud")
+
+    attribute_names = list(entities[0]["attributes"]) if entities else []
+
+    def list_entity_types(project, workspace):
+        return FakeResponse({entity_type: {"count": len(entities), "idName": f"{entity_type}_id",
+                                           "attributeNames": list(attribute_names)}})
+
+    def get_entities_query(project, workspace, etype, page=1, page_size=100, sort_direction="asc", filter_terms=None):
+        if latency:
+            time.sleep(latency)
+        start = (page - 1) * page_size
+        # the API hands back fresh objects every call; copy so the exporter can add the ID to attributes
+        results = [dict(e, attributes=dict(e["attributes"])) for e in entities[start:start + page_size]]
+        return FakeResponse({"results": results,
+                             "resultMetadata": {"filteredPageCount": math.ceil(len(entities) / page_size)}})
+
+    with mock.patch.object(fapi, "list_entity_types", list_entity_types), \
+            mock.patch.object(fapi, "get_entities_query", get_entities_query):
+        yield
+
+
+#----- NCBI E-UTILITIES -----#
+class EUtilsHandler(BaseHTTPRequestHandler):
+    """esearch.fcgi (term = OR of quoted terms, usehistory) and esummary.fcgi (WebEnv/query_key or id=) in JSON."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.respond(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        self.respond(parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()))
+
+    def respond(self, params):
+        params = {k: v[0] for k, v in params.items()}
+        server = self.server
+        server.n_requests += 1
+        db = server.records.get(params.get("db"), {})
+        endpoint = urlparse(self.path).path.rsplit("/", 1)[-1]
+        if endpoint == "esearch.fcgi":
+            terms = re.findall(r'"([^"]+)"|(\S+)', params.get("term", ""))
+            uids = []
+            for quoted, bare in terms:
+                term = (quoted or bare).upper()
+                if term != "OR":
+                    uids.extend(server.index.get(params["db"], {}).get(term, []))
+            uids = sorted(set(uids), key=int)
+            webenv = uuid.uuid4().hex
+            server.history[webenv] = uids
+            payload = {"esearchresult": {"count": str(len(uids)), "webenv": webenv, "querykey": "1",
+                                         "idlist": uids[:int(params.get("retmax", 20))]}}
+        elif endpoint == "esummary.fcgi":
+            if "WebEnv" in params:
+                start = int(params.get("retstart", 0))
+                uids = server.history.get(params["WebEnv"], [])[start:start + int(params.get("retmax", 20))]
+            else:
+                uids = params.get("id", "").split(",")
+            uids = [uid for uid in uids if uid in db]
+            payload = {"result": {"uids": uids, **{uid: db[uid] for uid in uids}}}
+        else:
+            self.send_error(404)
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@contextlib.contextmanager
+def eutils_server(records, latency=0.0):
+    """Serve {db: {uid: docsum}} like E-utilities. Yields the base URL; the server counts requests in n_requests."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EUtilsHandler)
+    server.records = records
+    server.history = {}
+    server.latency = latency
+    server.n_requests = 0
+    # every word-like token of a docsum finds it, the way an all-fields search would
+    server.index = {}
+    for db, docs in records.items():
+        index = server.index.setdefault(db, {})
+        for uid, doc in docs.items():
+            for token in set(re.findall(r"[A-Za-z0-9_.\-]+", json.dumps(doc))):
+                index.setdefault(token.upper(), []).append(uid)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/entrez/eutils/", server
+    finally:
+        server.shutdown()
+        server.server_close()
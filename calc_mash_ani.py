@@ -0,0 +1,171 @@
+import os
+import sys
+import glob
+import hashlib
+import shlex
+import subprocess
+import tempfile
+import pandas as pd
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+"""
+Incremental replacement for calc_mash_ani.sh.
+
+Sketches are cached by the content hash of each genome, so only new or changed
+FASTA files are sketched, and distances are only computed for reference/sample
+pairs that are not already in the stored distance table. The output is the same
+results.txt (reference, sample, ANI) that mash_summary.py reads.
+
+python calc_mash_ani.py --threads 8
+"""
+
+DIST_COLS = ["ref_hash", "sample_hash", "ani"]
+
+
+def file_hash(path:str, sketch_args:str) -> str:
+    # sketch options are part of the key so changing them invalidates the cache
+    h = hashlib.sha256(sketch_args.encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def find_genomes(directory:str) -> List[str]:
+    return sorted(glob.glob(os.path.join(directory, "**", "*.fna"), recursive=True))
+
+
+def load_sketch_index(cache:str) -> Dict[str, str]:
+    """Genome hash of each cached sketch, keyed by its name (the path it was sketched from)."""
+    index_file = os.path.join(cache, "sketches.tsv")
+    if not os.path.exists(index_file):
+        return {}
+    df = pd.read_csv(index_file, sep="\t", names=["hash", "name"], dtype=str)
+    # the last entry for a name wins, as in indexes appended to before stale entries were evicted
+    return dict(zip(df["name"], df["hash"]))
+
+
+def save_sketch_index(cache:str, sketch_index:Dict[str, str]) -> None:
+    with open(os.path.join(cache, "sketches.tsv"), "w") as index_file:
+        for name, genome_hash in sketch_index.items():
+            index_file.write(f"{genome_hash}\t{name}\n")
+
+
+def evict_stale(sketch_index:Dict[str, str], hashes:Dict[str, str], cache:str) -> int:
+    """Drop the sketches of paths whose contents changed since they were sketched.
+
+    mash reports distances by sketch name, so each name must stand for a single hash: the old sketch is removed
+    and its hash is sketched again (under another path) if another genome still has those contents.
+    """
+    stale = [name for name, genome_hash in sketch_index.items() if hashes.get(name, genome_hash) != genome_hash]
+    for name in stale:
+        old = os.path.join(cache, "sketches", sketch_index.pop(name) + ".msh")
+        if os.path.exists(old):
+            os.remove(old)
+    return len(stale)
+
+
+def sketch(path:str, genome_hash:str, cache:str, sketch_args:str) -> None:
+    out = os.path.join(cache, "sketches", genome_hash)
+    subprocess.run(f"mash sketch -p 1 {sketch_args} -o {shlex.quote(out)} {shlex.quote(path)}", shell=True, check=True,
+                   capture_output=True)
+
+
+def paste(sketches:List[str], out:str) -> str:
+    """Combine cached sketches into a single .msh so mash dist can be run once."""
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as listing:
+        listing.write("\n".join(sketches) + "\n")
+    subprocess.run(f"mash paste -l {shlex.quote(out)} {shlex.quote(listing.name)}", shell=True, check=True, capture_output=True)
+    os.remove(listing.name)
+    return out + ".msh"
+
+
+def mash_dist(refs_msh:str, samples_msh:str, threads:int, name_to_hash:Dict[str, str]) -> pd.DataFrame:
+    proc = subprocess.run(f"mash dist -p {threads} {shlex.quote(refs_msh)} {shlex.quote(samples_msh)}", shell=True, check=True,
+                          capture_output=True, universal_newlines=True)
+    rows = []
+    for line in proc.stdout.splitlines():
+        ref, sample, dist = line.split("\t")[:3]
+        rows.append([name_to_hash[ref], name_to_hash[sample], 100 * (1 - float(dist))])
+    return pd.DataFrame(rows, columns=DIST_COLS)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--threads", dest="threads", default=1, type=int, help="number of threads for sketching and mash dist")
+    parser.add_argument("--references", dest="references", default="reference_genomes", help="directory of reference .fna files")
+    parser.add_argument("--assemblies", dest="assemblies", default="assemblies", help="directory of sample .fna files")
+    parser.add_argument("--cache", dest="cache", default=".mash_cache", help="directory for cached sketches and distances")
+    parser.add_argument("--sketch_args", dest="sketch_args", default="", help="extra arguments for mash sketch, e.g. '-k 21 -s 10000'")
+    parser.add_argument("--output", dest="output", default="results.txt", help="distance table to write for mash_summary.py")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(args.cache, "sketches"), exist_ok=True)
+    dist_file = os.path.join(args.cache, "distances.tsv")
+
+    ref_paths = find_genomes(args.references)
+    sample_paths = find_genomes(args.assemblies)
+    if not ref_paths or not sample_paths:
+        sys.exit(f"Error: no .fna files found in {args.references} and/or {args.assemblies}")
+
+    #----- HASH & SKETCH -----#
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        hashes = dict(zip(ref_paths + sample_paths,
+                          pool.map(lambda p: file_hash(p, args.sketch_args), ref_paths + sample_paths)))
+        sketch_index = load_sketch_index(args.cache)
+        n_stale = evict_stale(sketch_index, hashes, args.cache)
+        sketched = set(sketch_index.values())
+        to_sketch = {}
+        for path, genome_hash in hashes.items():
+            if genome_hash not in sketched and genome_hash not in to_sketch:
+                to_sketch[genome_hash] = path
+        print(f"{len(hashes)} genomes found, {len(to_sketch)} new or changed genome(s) to sketch")
+        list(pool.map(lambda item: sketch(item[1], item[0], args.cache, args.sketch_args), to_sketch.items()))
+
+    if to_sketch or n_stale:
+        sketch_index.update({path: genome_hash for genome_hash, path in to_sketch.items()})
+        save_sketch_index(args.cache, sketch_index)
+
+    #----- DISTANCES FOR NEW PAIRS -----#
+    if os.path.exists(dist_file):
+        distances = pd.read_csv(dist_file, sep="\t", dtype={"ref_hash": str, "sample_hash": str, "ani": "float64"})
+    else:
+        distances = pd.DataFrame(columns=DIST_COLS)
+    ref_hashes = sorted({hashes[p] for p in ref_paths})
+    sample_hashes = sorted({hashes[p] for p in sample_paths})
+    # every (reference, sample) pair without a stored distance, including pairs left out by an interrupted run
+    done = set(zip(distances["ref_hash"], distances["sample_hash"]))
+    missing_refs = {}
+    for sample_hash in sample_hashes:
+        refs_needed = tuple(h for h in ref_hashes if (h, sample_hash) not in done)
+        if refs_needed:
+            missing_refs[sample_hash] = refs_needed
+    # samples missing the same references share one mash dist run (e.g. all new samples against every reference)
+    groups = {}
+    for sample_hash, refs_needed in missing_refs.items():
+        groups.setdefault(refs_needed, []).append(sample_hash)
+    print(f"{sum(len(r) for r in missing_refs.values())} missing distance(s) across {len(missing_refs)} sample(s)")
+
+    def msh(genome_hashes):
+        return [os.path.join(args.cache, "sketches", h + ".msh") for h in genome_hashes]
+
+    new_distances = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (refs_needed, samples_needed) in enumerate(groups.items()):
+            new_distances.append(mash_dist(paste(msh(refs_needed), os.path.join(tmp, f"refs_{i}")),
+                                           paste(msh(samples_needed), os.path.join(tmp, f"samples_{i}")),
+                                           args.threads, sketch_index))
+    if new_distances:
+        new_distances = pd.concat(new_distances, ignore_index=True)
+        new_distances.to_csv(dist_file, sep="\t", index=False, mode="a", header=not os.path.exists(dist_file))
+        distances = pd.concat([distances, new_distances], ignore_index=True)
+        print(f"{len(new_distances)} new distance(s) computed")
+
+    #----- WRITE RESULTS -----#
+    refs = pd.DataFrame({"reference": ref_paths, "ref_hash": [hashes[p] for p in ref_paths]})
+    samples = pd.DataFrame({"sample": sample_paths, "sample_hash": [hashes[p] for p in sample_paths]})
+    results = distances.merge(refs, on="ref_hash").merge(samples, on="sample_hash")
+    results[["reference", "sample", "ani"]].to_csv(args.output, sep="\t", index=False, header=False)
+    print(f"{len(results)} distances written to {args.output}")
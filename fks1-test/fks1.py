@@ -0,0 +1,154 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pandas as pd
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
+
+"""
+Multi-sample replacement for fks1.sh.
+
+Calls FKS1 hotspot mutations for every sample in a samplesheet (sample,fastq_1,fastq_2 - as written by
+samplesheet-from-s3.py), running as many samples at once as the CPU budget allows. The reference is indexed
+once up front (the checked-in bwa/faidx index is reused when present), subsampled reads are piped from
+seqtk straight into bwa mem, and every sample's hotspot mutations are written to one combined table.
+
+python fks1.py samplesheet.csv --cpus 16 --outdir fks1_results
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_REF = os.path.join(HERE, "CAB11_002014T0.fna")
+DEFAULT_GFF = os.path.join(HERE, "CAB11_002014T0.gff")
+DEFAULT_READS = 1000000
+DEFAULT_SEED = 11  # seqtk's default; both mates must use the same seed to stay paired
+DEFAULT_THREADS_PER_SAMPLE = 4
+BWA_INDEX_EXTS = [".amb", ".ann", ".bwt", ".pac", ".sa"]
+
+# hotspot regions (positions strictly between the bounds) of the reference CDS
+HOTSPOT_NAMES = np.array(["hs1", "hs3", "hs2"])
+HOTSPOTS = pd.IntervalIndex.from_tuples([(1901, 1929), (2069, 2074), (4046, 4071)], closed="neither")
+
+
+def index_reference(ref:str) -> None:
+    """Build the bwa and faidx indexes of the reference if any index file is missing."""
+    if not all(os.path.exists(ref + ext) for ext in BWA_INDEX_EXTS):
+        print(f"Indexing {ref} with bwa")
+        subprocess.run(["bwa", "index", ref], check=True, capture_output=True)
+    if not os.path.exists(ref + ".fai"):
+        subprocess.run(["samtools", "faidx", ref], check=True, capture_output=True)
+
+
+def wait_all(procs:List[subprocess.Popen], what:str) -> None:
+    failed = [p.args for p in procs if p.wait() != 0]
+    if failed:
+        raise RuntimeError(f"{what} failed: {' '.join(map(str, failed[0]))}")
+
+
+def align(r1:str, r2:str, ref:str, bam:str, n_reads:int, seed:int, threads:int, log) -> None:
+    """seqtk sample | bwa mem | samtools view -F 4 | samtools sort, without writing the subsampled reads."""
+    sample_1 = subprocess.Popen(["seqtk", "sample", "-s", str(seed), r1, str(n_reads)], stdout=subprocess.PIPE, stderr=log)
+    sample_2 = subprocess.Popen(["seqtk", "sample", "-s", str(seed), r2, str(n_reads)], stdout=subprocess.PIPE, stderr=log)
+    fds = (sample_1.stdout.fileno(), sample_2.stdout.fileno())
+    # bwa reads both mates at once, so each seqtk stream is handed over as its own /dev/fd path
+    bwa = subprocess.Popen(["bwa", "mem", "-t", str(threads), ref] + [f"/dev/fd/{fd}" for fd in fds],
+                           stdout=subprocess.PIPE, stderr=log, pass_fds=fds)
+    sample_1.stdout.close()
+    sample_2.stdout.close()
+    view = subprocess.Popen(["samtools", "view", "-b", "-F", "4", "-"], stdin=bwa.stdout, stdout=subprocess.PIPE, stderr=log)
+    bwa.stdout.close()
+    # sort into a temporary file so an interrupted run never leaves a BAM that later runs would reuse
+    sort = subprocess.Popen(["samtools", "sort", "-o", bam + ".tmp", "-"], stdin=view.stdout, stderr=log)
+    view.stdout.close()
+    wait_all([sample_1, sample_2, bwa, view, sort], "alignment")
+    os.replace(bam + ".tmp", bam)
+
+
+def call_variants(prefix:str, bam:str, ref:str, gff:str, min_depth:int, min_freq:float, log) -> str:
+    mpileup = subprocess.Popen(["samtools", "mpileup", "-aa", "-A", "-d", "0", "-B", "-Q", "0", "--reference", ref, bam],
+                               stdout=subprocess.PIPE, stderr=log)
+    ivar = subprocess.Popen(["ivar", "variants", "-p", prefix, "-r", ref, "-m", str(min_depth), "-g", gff, "-t", str(min_freq)],
+                            stdin=mpileup.stdout, stdout=log, stderr=log)
+    mpileup.stdout.close()
+    wait_all([mpileup, ivar], "variant calling")
+    return prefix + ".tsv"
+
+
+def annotate(variants:pd.DataFrame) -> pd.DataFrame:
+    """Add HOTSPOT (hs1/hs2/hs3) and MUTATION (REF_AA POS_AA ALT_AA, e.g. S639F) to an ivar variants table."""
+    hit = HOTSPOTS.get_indexer(variants["POS"].astype(int))
+    variants["HOTSPOT"] = np.where(hit >= 0, HOTSPOT_NAMES[hit], "")
+    variants["MUTATION"] = np.where(hit >= 0, variants["REF_AA"] + variants["POS_AA"] + variants["ALT_AA"], "")
+    return variants
+
+
+def run_sample(sample:str, r1:str, r2:str, args) -> pd.DataFrame:
+    """Align, call and annotate one sample. Returns its hotspot mutations."""
+    prefix = os.path.join(args.outdir, sample)
+    bam = prefix + ".bam"
+    with open(prefix + ".log", "w") as log:
+        if args.force or not os.path.exists(bam):
+            align(r1, r2, args.ref, bam, args.reads, args.seed, args.threads_per_sample, log)
+        tsv = call_variants(prefix, bam, args.ref, args.gff, args.min_depth, args.min_freq, log)
+
+    variants = annotate(pd.read_csv(tsv, sep="\t", dtype=str, keep_default_na=False))
+    variants.to_csv(prefix + ".anno.tsv", sep="\t", index=False)
+    mutations = variants[variants["MUTATION"] != ""].copy()
+    with open(prefix + ".mutations.txt", "w") as f:
+        f.writelines(m + "\n" for m in mutations["MUTATION"])
+    mutations.insert(0, "SAMPLE", sample)
+    return mutations
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Call FKS1 hotspot mutations for every sample in a samplesheet.")
+    parser.add_argument("samplesheet", help="CSV with sample,fastq_1,fastq_2 columns")
+    parser.add_argument("--ref", dest="ref", default=DEFAULT_REF, help="reference FASTA (Default: CAB11_002014T0.fna next to this script)")
+    parser.add_argument("--gff", dest="gff", default=DEFAULT_GFF, help="reference GFF (Default: CAB11_002014T0.gff next to this script)")
+    parser.add_argument("--outdir", dest="outdir", default=".", help="directory for the per-sample BAM, ivar and annotation files")
+    parser.add_argument("--output", dest="output", default="fks1_mutations.tsv", help="combined hotspot mutation table for all samples")
+    parser.add_argument("--cpus", dest="cpus", type=int, default=os.cpu_count(), help=f"total CPUs to use (Default: {os.cpu_count()})")
+    parser.add_argument("--threads_per_sample", dest="threads_per_sample", type=int, default=DEFAULT_THREADS_PER_SAMPLE,
+                        help=f"bwa mem threads per sample; cpus // threads_per_sample samples run at once (Default: {DEFAULT_THREADS_PER_SAMPLE})")
+    parser.add_argument("--reads", dest="reads", type=int, default=DEFAULT_READS, help=f"read pairs to subsample with seqtk (Default: {DEFAULT_READS})")
+    parser.add_argument("--seed", dest="seed", type=int, default=DEFAULT_SEED, help=f"seqtk sample seed (Default: {DEFAULT_SEED})")
+    parser.add_argument("--min_depth", dest="min_depth", type=int, default=10, help="ivar variants -m (Default: 10)")
+    parser.add_argument("--min_freq", dest="min_freq", type=float, default=0.75, help="ivar variants -t (Default: 0.75)")
+    parser.add_argument("--force", dest="force", action="store_true", help="re-align samples that already have a BAM in --outdir")
+    args = parser.parse_args()
+
+    samples = pd.read_csv(args.samplesheet, dtype=str)
+    missing = {"sample", "fastq_1", "fastq_2"} - set(samples.columns)
+    if missing:
+        sys.exit(f"Error: {args.samplesheet} is missing column(s): {', '.join(sorted(missing))}")
+    os.makedirs(args.outdir, exist_ok=True)
+
+    # index once here; every sample then reuses it
+    index_reference(args.ref)
+
+    args.threads_per_sample = min(args.threads_per_sample, max(1, args.cpus))
+    workers = max(1, args.cpus // args.threads_per_sample)
+    print(f"Processing {len(samples)} sample(s), {workers} at a time with {args.threads_per_sample} thread(s) each")
+    results = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_sample, row.sample, row.fastq_1, row.fastq_2, args): row.sample
+                   for row in samples.itertuples(index=False)}
+        for future in as_completed(futures):
+            sample = futures[future]
+            try:
+                mutations = future.result()
+            except Exception as e:
+                failed.append(sample)
+                print(f"{sample}: FAILED ({e}; see {os.path.join(args.outdir, sample + '.log')})", flush=True)
+                continue
+            results.append(mutations)
+            print(f"{sample}: {', '.join(mutations['MUTATION']) or 'no hotspot mutations'}", flush=True)
+
+    # rows of each sample stay in ivar's position order
+    combined = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=["SAMPLE", "HOTSPOT", "MUTATION"])
+    combined.sort_values("SAMPLE", kind="stable").to_csv(args.output, sep="\t", index=False)
+    print(f"{len(combined)} hotspot mutation(s) from {len(results)} sample(s) written to {args.output}")
+    if failed:
+        sys.exit(f"Error: {len(failed)} sample(s) failed: {', '.join(sorted(failed))}")
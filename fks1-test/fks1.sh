@@ -13,7 +13,7 @@ then
     bwa index $REF_FASTA
     bwa mem $REF_FASTA $PREFIX.sampled.1.fq.gz $PREFIX.sampled.2.fq.gz | samtools view -b -F 4 - | samtools sort - > $PREFIX.bam
 fi
-samtools mpileup -aa -A -d 0 -B -Q 0 --reference CAB11_002014T0.fna $PREFIX.bam | ivar variants -p $PREFIX -r $REF_FASTA -m 10 -g $REF_GFF -t 0.75
+samtools mpileup -aa -A -d 0 -B -Q 0 --reference $REF_FASTA $PREFIX.bam | ivar variants -p $PREFIX -r $REF_FASTA -m 10 -g $REF_GFF -t 0.75
 cat $PREFIX.tsv | \
     awk '{ \
     if ( NR == 1 ) print $0, "HOTSPOT"  ; \
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Copy the assemblies and reads of a BigBacter manifest from GCS to S3 (Python replacement for gcp2aws.sh).
+
+    python gcp2aws.py manifest.csv s3://<bucket>/<path>
+
+Every file is streamed GCS -> S3 through gcs2s3 (no local copies), several samples at once. Each copy is
+checked against the CRC32C/MD5 GCS stored for the object while it streams, and files that already have an
+identical copy in S3 are skipped. Assemblies go to <path>/assemblies/ and reads to <path>/reads/, and the
+manifest with the S3 paths is uploaded to <path>/manifest.csv, as gcp2aws.sh did. Samples whose files could
+not be copied are left out of it and reported.
+"""
+import os
+import sys
+from argparse import ArgumentParser
+from typing import Dict, List, Tuple
+
+import pandas as pd
+
+import gcs2s3
+import transfer_metrics
+from transfer_ledger import TransferLedger, DEFAULT_LEDGER, REVALIDATE_HELP
+
+MANIFEST_COLS = ["sample", "taxa", "assembly", "fastq_1", "fastq_2"]
+
+
+def read_manifest(path:str) -> pd.DataFrame:
+    """sample,taxa,assembly,fastq_1,fastq_2 with whitespace stripped from the IDs and paths."""
+    df = pd.read_csv(path, dtype=str, keep_default_na=False).iloc[:, :5]
+    df.columns = MANIFEST_COLS
+    for col in ["sample", "assembly", "fastq_1", "fastq_2"]:
+        df[col] = df[col].str.replace(r"\s", "", regex=True)
+    return df
+
+
+def plan_transfers(manifest:pd.DataFrame, dest:str) -> Tuple[pd.DataFrame, Dict[str, List[Tuple[str, str]]]]:
+    """Manifest with the S3 paths, and the (gs_uri, s3_uri) pairs of each sample."""
+    s3_manifest = manifest.copy()
+    s3_manifest["assembly"] = [f"{dest}/assemblies/{os.path.basename(p)}" for p in manifest["assembly"]]
+    for col in ["fastq_1", "fastq_2"]:
+        s3_manifest[col] = [f"{dest}/reads/{os.path.basename(p)}" for p in manifest[col]]
+    jobs = {}
+    for gs_row, s3_row in zip(manifest.itertuples(index=False), s3_manifest.itertuples(index=False)):
+        jobs.setdefault(gs_row.sample, []).extend([(gs_row.assembly, s3_row.assembly),
+                                                   (gs_row.fastq_1, s3_row.fastq_1),
+                                                   (gs_row.fastq_2, s3_row.fastq_2)])
+    return s3_manifest, jobs
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Copy the files of a manifest from GCS to S3 and upload the S3 manifest.")
+    parser.add_argument("manifest", help="CSV with sample,taxa,assembly,fastq_1,fastq_2 (gs:// paths)")
+    parser.add_argument("s3", help="Destination S3 URI")
+    parser.add_argument("--sample_workers", dest="sample_workers", type=int, default=gcs2s3.DEFAULT_SAMPLE_WORKERS,
+                        help=f"Number of samples to transfer at once (Default: {gcs2s3.DEFAULT_SAMPLE_WORKERS})")
+    parser.add_argument("--file_workers", dest="file_workers", type=int, default=gcs2s3.DEFAULT_FILE_WORKERS,
+                        help=f"Number of files to transfer at once across all samples (Default: {gcs2s3.DEFAULT_FILE_WORKERS})")
+    parser.add_argument("--ledger", dest="ledger", default=DEFAULT_LEDGER,
+                        help=f"Local cache of files already copied to AWS (Default: {DEFAULT_LEDGER})")
+    parser.add_argument("--force", dest="force", action="store_true",
+                        help="Copy every file, even if an identical copy already exists in AWS.")
+    parser.add_argument("--revalidate", dest="revalidate", action="store_true", help=REVALIDATE_HELP)
+    transfer_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    transfer_metrics.configure_from_args("gcp2aws", args)
+    dest = args.s3.rstrip("/")
+
+    manifest = read_manifest(args.manifest)
+    s3_manifest, jobs = plan_transfers(manifest, dest)
+    print(f"Starting file transfer for {len(jobs)} sample(s):")
+    gcs_client, s3_client = gcs2s3.make_clients(args.file_workers * gcs2s3.DEFAULT_PARTS_IN_FLIGHT)
+    ledger = None if args.force else TransferLedger(args.ledger, revalidate=args.revalidate)
+    with transfer_metrics.span("transfer", samples=len(jobs)) as attrs:
+        results = gcs2s3.transfer_samples(jobs, gcs_client, s3_client, sample_workers=args.sample_workers,
+                                          file_workers=args.file_workers, ledger=ledger)
+        attrs["bytes"] = sum(r.n_bytes for r in results)
+
+    failed = sorted(r.sample for r in results if not r.ok)
+    transfer_metrics.count("samples", len(results) - len(failed), status="ok")
+    transfer_metrics.count("samples", len(failed), status="failed")
+    s3_manifest = s3_manifest[~s3_manifest["sample"].isin(failed)]
+    s3_bucket, s3_key = gcs2s3.split_uri(f"{dest}/manifest.csv")
+    s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=s3_manifest.to_csv(index=False).encode("utf-8"))
+    print(f"{len(s3_manifest)} sample(s) written to {dest}/manifest.csv")
+    if failed:
+        sys.exit(f"Error: file transfer failed for {len(failed)} sample(s), left out of the manifest: {', '.join(failed)}")
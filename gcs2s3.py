@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""Stream objects from Google Cloud Storage straight into S3 without staging them on local disk.
+
+Every copy is verified on the way through: the CRC32C and MD5 of the streamed bytes are compared with the
+checksums GCS stored for the object before the S3 object is created (or the multipart upload completed), and
+S3 checks each request body against the CRC32C sent with it.
+"""
+import base64
+import hashlib
+import io
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, NamedTuple, Tuple
+
+import boto3
+import google_crc32c
+import requests
+from botocore.config import Config
+from google.cloud import storage
+
+import transfer_metrics
+from transfer_ledger import checksum_metadata
+
+DEFAULT_PART_SIZE = 64 * 1024 * 1024  # S3 requires >= 5 MiB for every part but the last
+DEFAULT_PARTS_IN_FLIGHT = 4
+DEFAULT_SAMPLE_WORKERS = 4
+DEFAULT_FILE_WORKERS = 8
+
+
+class ChecksumMismatch(ValueError):
+    """The bytes read from GCS do not match the checksums GCS stored for the object."""
+
+
+class StreamChecksums:
+    """CRC32C and MD5 of an object, updated as its bytes stream through. Digests are base64, as GCS reports them."""
+
+    def __init__(self):
+        self._crc32c = google_crc32c.Checksum()
+        self._md5 = hashlib.md5()
+
+    def update(self, data: bytes) -> None:
+        self._crc32c.update(data)
+        self._md5.update(data)
+
+    @property
+    def crc32c(self) -> str:
+        return base64.b64encode(self._crc32c.digest()).decode()
+
+    @property
+    def md5(self) -> str:
+        return base64.b64encode(self._md5.digest()).decode()
+
+    def verify(self, blob) -> None:
+        """Raise ChecksumMismatch unless the bytes seen match every checksum GCS has for the blob.
+
+        Composite objects have no MD5 in GCS; their CRC32C is still checked.
+        """
+        mismatched = [f"{name} {expected} (GCS) != {actual} (streamed)"
+                      for name, expected, actual in [("crc32c", blob.crc32c, self.crc32c), ("md5", blob.md5_hash, self.md5)]
+                      if expected and expected != actual]
+        if mismatched:
+            transfer_metrics.count("checksum_mismatches")
+            raise ChecksumMismatch(f"gs://{blob.bucket.name}/{blob.name}: {'; '.join(mismatched)}")
+
+
+def crc32c_b64(data: bytes) -> str:
+    return base64.b64encode(google_crc32c.Checksum(data).digest()).decode()
+
+
+class TransferResult(NamedTuple):
+    sample: str
+    ok: bool
+    n_bytes: int
+    seconds: float
+    errors: List[str]
+
+
+def split_uri(uri: str) -> Tuple[str, str]:
+    """Split a gs:// or s3:// URI into (bucket, key)."""
+    if "://" not in uri:
+        raise ValueError(f"{uri} does not look like a gs:// or s3:// URI")
+    path = uri.split("://", 1)[1]
+    bucket, _, key = path.partition("/")
+    if not bucket or not key:
+        raise ValueError(f"{uri} does not contain both a bucket and an object key")
+    return bucket, key
+
+
+def make_clients(max_connections: int = DEFAULT_FILE_WORKERS * DEFAULT_PARTS_IN_FLIGHT):
+    """Create a GCS and an S3 client that can be shared by all transfer threads."""
+    gcs_client = storage.Client()
+    # the default requests pool keeps 10 connections, which would serialize larger worker pools
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    gcs_client._http.mount("https://", adapter)
+    s3_client = boto3.client("s3", config=Config(max_pool_connections=max_connections))
+    return gcs_client, transfer_metrics.instrument_s3_client(s3_client)
+
+
+def _read_part(reader, part_size: int) -> bytes:
+    # BlobReader.read() may return short reads; fill the part before handing it to S3
+    chunks = []
+    remaining = part_size
+    while remaining > 0:
+        chunk = reader.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def stream_gcs_to_s3(gs_uri: str, s3_uri: str, gcs_client, s3_client,
+                     part_size: int = DEFAULT_PART_SIZE,
+                     parts_in_flight: int = DEFAULT_PARTS_IN_FLIGHT,
+                     ledger=None) -> int:
+    """Copy one object from GCS to S3 through a bounded in-memory buffer. Returns the number of bytes copied.
+
+    At most `parts_in_flight` parts of `part_size` bytes are held in memory at any time. If a
+    TransferLedger is supplied, objects that already have an identical copy in S3 are skipped (0 bytes).
+    """
+    gs_bucket, gs_blob = split_uri(gs_uri)
+    s3_bucket, s3_key = split_uri(s3_uri)
+
+    with transfer_metrics.span("gcs_metadata", source=gs_uri):
+        blob = gcs_client.bucket(gs_bucket).get_blob(gs_blob)
+    if blob is None:
+        raise FileNotFoundError(f"{gs_uri} does not exist")
+    return stream_blob_to_s3(blob, s3_bucket, s3_key, s3_client, part_size, parts_in_flight, ledger)
+
+
+def stream_blob_to_s3(blob, s3_bucket: str, s3_key: str, s3_client,
+                      part_size: int = DEFAULT_PART_SIZE,
+                      parts_in_flight: int = DEFAULT_PARTS_IN_FLIGHT,
+                      ledger=None) -> int:
+    """Same as stream_gcs_to_s3() for a blob whose metadata has already been fetched."""
+    source = f"gs://{blob.bucket.name}/{blob.name}"
+    with transfer_metrics.span("object", source=source, dest=f"s3://{s3_bucket}/{s3_key}", bytes=blob.size) as attrs:
+        try:
+            n_bytes = _stream_blob_to_s3(blob, s3_bucket, s3_key, s3_client, part_size, parts_in_flight, ledger)
+        except BaseException:
+            transfer_metrics.count("objects", status="failed")
+            raise
+        attrs["skipped"] = n_bytes == 0 and blob.size > 0
+        transfer_metrics.count("objects", status="skipped" if attrs["skipped"] else "copied")
+        transfer_metrics.count("bytes_transferred", n_bytes, direction="gcs_to_s3")
+        transfer_metrics.observe("object_bytes", blob.size, transfer_metrics.SIZE_BUCKETS)
+    return n_bytes
+
+
+def _stream_blob_to_s3(blob, s3_bucket, s3_key, s3_client, part_size, parts_in_flight, ledger):
+    source = f"gs://{blob.bucket.name}/{blob.name}"
+    if ledger is not None:
+        with transfer_metrics.span("ledger_check", source=source):
+            current = ledger.blob_is_current(blob, s3_bucket, s3_key, s3_client)
+        if current:
+            print(f"Skipping {source}: identical copy already at s3://{s3_bucket}/{s3_key}", flush=True)
+            return 0
+
+    checksums = StreamChecksums()
+
+    # small objects fit in a single PUT
+    if blob.size <= part_size:
+        with transfer_metrics.span("gcs_download", source=source, bytes=blob.size):
+            body = blob.download_as_bytes()
+        checksums.update(body)
+        checksums.verify(blob)
+        # the streamed checksums go on the S3 object so later runs can recognise it, even without a GCS MD5
+        metadata = checksum_metadata(checksums.crc32c, checksums.md5)
+        with transfer_metrics.span("s3_upload", dest=f"s3://{s3_bucket}/{s3_key}", bytes=len(body)):
+            s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=body, Metadata=metadata,
+                                 ChecksumCRC32C=checksums.crc32c)
+        if ledger is not None:
+            ledger.record_blob(blob, s3_bucket, s3_key)
+        return blob.size
+
+    # metadata is fixed when the upload is created, so it carries the GCS checksums; the upload is only
+    # completed once the streamed bytes have matched them
+    metadata = checksum_metadata(blob.crc32c, blob.md5_hash)
+    upload_id = s3_client.create_multipart_upload(Bucket=s3_bucket, Key=s3_key, Metadata=metadata,
+                                                  ChecksumAlgorithm="CRC32C")["UploadId"]
+    try:
+        slots = threading.BoundedSemaphore(parts_in_flight)
+        failed = threading.Event()
+
+        def upload_part(part_number: int, body: bytes) -> Dict:
+            try:
+                part_crc32c = crc32c_b64(body)
+                with transfer_metrics.span("s3_upload", dest=f"s3://{s3_bucket}/{s3_key}", part=part_number, bytes=len(body)):
+                    response = s3_client.upload_part(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id,
+                                                     PartNumber=part_number, Body=body, ChecksumCRC32C=part_crc32c)
+                return {"PartNumber": part_number, "ETag": response["ETag"], "ChecksumCRC32C": part_crc32c}
+            except Exception:
+                failed.set()
+                raise
+            finally:
+                slots.release()
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=parts_in_flight) as pool, \
+                blob.open("rb", chunk_size=part_size) as reader:
+            part_number = 1
+            while True:
+                # wait for a free slot before reading the next part so memory stays bounded
+                slots.acquire()
+                if failed.is_set():
+                    body = b""
+                else:
+                    with transfer_metrics.span("gcs_download", source=source, part=part_number) as attrs:
+                        body = _read_part(reader, part_size)
+                        attrs["bytes"] = len(body)
+                if not body:
+                    slots.release()
+                    break
+                # parts are read in order, so the whole-object checksums can be updated here
+                checksums.update(body)
+                futures.append(pool.submit(upload_part, part_number, body))
+                part_number += 1
+            parts = [future.result() for future in futures]
+
+        checksums.verify(blob)
+        s3_client.complete_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id,
+                                            MultipartUpload={"Parts": parts})
+    except BaseException:
+        s3_client.abort_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id)
+        raise
+
+    if ledger is not None:
+        ledger.record_blob(blob, s3_bucket, s3_key)
+    return blob.size
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """Writable binary stream that uploads to S3 as it is written, one multipart part at a time.
+
+    Only `part_size` bytes are buffered. Data that never fills a part is sent as a single PUT on close().
+    Call abort() instead of close() when the writer fails part-way so no partial object is left behind.
+    Wrap in io.TextIOWrapper(io.BufferedWriter(writer)) to write text.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, part_size: int = DEFAULT_PART_SIZE, metadata: Dict = None):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.metadata = metadata or {}
+        self.n_bytes = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._aborted = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self._aborted:
+            # anything flushed by a wrapping stream after abort() is dropped
+            return len(data)
+        self._buffer.extend(data)
+        self.n_bytes += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body: bytes) -> None:
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                                     Metadata=self.metadata)["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                              PartNumber=part_number, Body=body)
+        self._parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if not self._aborted:
+                if self._upload_id is None:
+                    self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), Metadata=self.metadata)
+                else:
+                    if self._buffer:
+                        self._upload_part(bytes(self._buffer))
+                    self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                             MultipartUpload={"Parts": self._parts})
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            super().close()
+
+    def abort(self) -> None:
+        """Drop everything written so far; the S3 object is left untouched."""
+        if self._upload_id is not None and not self._aborted:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        self._aborted = True
+        self._buffer = bytearray()
+
+
+def transfer_sample(sample: str, files: List[Tuple[str, str]], gcs_client, s3_client,
+                    file_pool: ThreadPoolExecutor, **stream_kwargs) -> TransferResult:
+    """Copy every (gs_uri, s3_uri) pair for one sample using the shared file pool."""
+    start = time.time()
+    futures = {file_pool.submit(stream_gcs_to_s3, gs_uri, s3_uri, gcs_client, s3_client, **stream_kwargs): gs_uri
+               for gs_uri, s3_uri in files}
+    n_bytes = 0
+    errors = []
+    for future in as_completed(futures):
+        try:
+            n_bytes += future.result()
+        except Exception as e:
+            errors.append(f"{futures[future]}: {e}")
+    return TransferResult(sample, not errors, n_bytes, time.time() - start, errors)
+
+
+def transfer_samples(jobs: Dict[str, List[Tuple[str, str]]], gcs_client=None, s3_client=None,
+                     sample_workers: int = DEFAULT_SAMPLE_WORKERS,
+                     file_workers: int = DEFAULT_FILE_WORKERS,
+                     **stream_kwargs) -> List[TransferResult]:
+    """Transfer the files of many samples concurrently.
+
+    `jobs` maps each sample to its list of (gs_uri, s3_uri) pairs. A failure in one file only marks its own
+    sample as failed; every other sample keeps going.
+    """
+    if gcs_client is None or s3_client is None:
+        gcs_client, s3_client = make_clients(file_workers * stream_kwargs.get("parts_in_flight", DEFAULT_PARTS_IN_FLIGHT))
+
+    results = []
+    with ThreadPoolExecutor(max_workers=file_workers) as file_pool, \
+            ThreadPoolExecutor(max_workers=sample_workers) as sample_pool:
+        futures = [sample_pool.submit(transfer_sample, sample, files, gcs_client, s3_client, file_pool, **stream_kwargs)
+                   for sample, files in jobs.items()]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result.ok:
+                mb = result.n_bytes / 1e6
+                print(f"{result.sample}: transferred {mb:.1f} MB in {result.seconds:.1f}s ({mb / max(result.seconds, 1e-6):.1f} MB/s)", flush=True)
+            else:
+                print(f"{result.sample}: FAILED", flush=True)
+                for error in result.errors:
+                    print(f"    {error}", flush=True)
+    return results
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Stream a single object from GCS to S3 without writing it to disk.")
+    parser.add_argument("gs_uri", help="Source gs:// URI")
+    parser.add_argument("s3_uri", help="Destination s3:// URI")
+    parser.add_argument("--part_size", type=int, default=DEFAULT_PART_SIZE, help="Multipart upload part size in bytes")
+    parser.add_argument("--parts_in_flight", type=int, default=DEFAULT_PARTS_IN_FLIGHT,
+                        help="Maximum number of parts buffered in memory at once")
+    args = parser.parse_args()
+
+    gcs_client, s3_client = make_clients(args.parts_in_flight)
+    try:
+        n_bytes = stream_gcs_to_s3(args.gs_uri, args.s3_uri, gcs_client, s3_client,
+                                   part_size=args.part_size, parts_in_flight=args.parts_in_flight)
+    except Exception as e:
+        sys.exit(f"Error: {e}")
+    print(f"Copied {n_bytes} bytes from {args.gs_uri} to {args.s3_uri}")
@@ -3,54 +3,92 @@ import os
 import argparse
 import subprocess
 from argparse import ArgumentParser
-from typing import List
+from typing import Dict, Iterator, List, Optional, Union
 
+DEFAULT_MIN_ANI = 95.0
+MASH_COLS = ["reference", "sample", "ani"]
 
-parser = ArgumentParser()
-parser.add_argument("--mash_table", dest="table",  default="results.txt", help="/path/to/input/mash/results.txt")
 
-args = parser.parse_args() 
-table = args.table
+def read_mash_table(table:str, chunksize:Optional[int] = None) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """Read results.txt from calc_mash_ani.sh, either whole or as an iterator of chunks."""
+    return pd.read_csv(table, names = MASH_COLS, sep='\t', chunksize=chunksize,
+                       dtype={"reference": str, "sample": str, "ani": "float64"})
+
+
+def ref_min_ani(df:pd.DataFrame) -> pd.Series:
+    """Minimum ANI of every reference across all samples, in order of first appearance."""
+    return df.groupby("reference", sort=False)["ani"].min()
+
+
+def ref_min_ani_chunked(chunks:Iterator[pd.DataFrame]) -> pd.Series:
+    """Same as ref_min_ani(), keeping only a running per-reference minimum in memory."""
+    running = pd.Series(dtype="float64")
+    for chunk in chunks:
+        running = pd.concat([running, ref_min_ani(chunk)]).groupby(level=0, sort=False).min()
+    return running
+
+
+def best_refs(mins:pd.Series, k:int = 1) -> List[str]:
+    """The k references with the highest minimum ANI (ties keep the earliest reference)."""
+    return mins.nlargest(k, keep="first").index.tolist()
 
 
 def best_ref(df:pd.DataFrame) -> str:
-    refs = df.reference.unique()
-    best_ref = refs[0]
-    best_ani = 0.0
-    for ref in refs:
-        cp = df.copy()
-        cp = cp.loc[cp['reference'] == ref]
-        min_ani = float(cp['ani'].min())
-        if min_ani > best_ani:
-            best_ani = min_ani
-            best_ref = ref 
-    return best_ref
-
-
-def bad_ani_seqs(df:pd.DataFrame, ref:str) -> List:
-    cp = df.copy()
-    print(len(cp.index))
-    cp = cp.loc[cp['reference'] == ref]
-    cp_total = len(cp.index)
-    cp = cp.loc[cp['ani'] >= 95.0]
-    cp_keep = len(cp.index)
-    pp_input = cp['sample'].tolist()
-    print(f'{cp_keep}/{cp_total} assemblies are withing .95 ANI of the reference genome')
+    return best_refs(ref_min_ani(df))[0]
+
+
+def bad_ani_seqs(df:pd.DataFrame, ref:str, min_ani:float = DEFAULT_MIN_ANI) -> List:
+    is_ref = (df['reference'] == ref).to_numpy()
+    keep = is_ref & (df['ani'] >= min_ani).to_numpy()
+    pp_input = df['sample'].to_numpy()[keep].tolist()
+    print(f'{keep.sum()}/{is_ref.sum()} assemblies are within {min_ani} ANI of the reference genome')
     return pp_input
 
 
+def bad_ani_seqs_chunked(chunks:Iterator[pd.DataFrame], refs:List[str], min_ani:float = DEFAULT_MIN_ANI) -> Dict[str, List]:
+    """Samples within min_ani of each reference in refs, collected in a single pass over the chunks."""
+    pp_inputs = {ref: [] for ref in refs}
+    totals = dict.fromkeys(refs, 0)
+    for chunk in chunks:
+        chunk = chunk[chunk['reference'].isin(refs)]
+        for ref, n in chunk['reference'].value_counts().items():
+            totals[ref] += n
+        chunk = chunk[chunk['ani'] >= min_ani]
+        for ref, samples in chunk.groupby('reference', sort=False)['sample']:
+            pp_inputs[ref].extend(samples.tolist())
+    for ref in refs:
+        print(f'{ref}: {len(pp_inputs[ref])}/{totals[ref]} assemblies are within {min_ani} ANI of the reference genome')
+    return pp_inputs
+
+
 def make_pp_input(filelist:List, reference:str):
     ref_name = os.path.basename(reference).split("_genomic")[0]
     with open(ref_name + '_pp-input.tsv', mode='wt', encoding='utf-8') as myfile:
         for i in filelist:
             file_base = os.path.basename(i).split("_genomic")[0]
             myfile.write(file_base + '\t' + i + '\n')
-        
+
 
 
 if __name__ == "__main__":
-    summary = pd.read_csv(table, \
-                      names = ["reference", "sample", "ani"], sep='\t')
-    ref_best = best_ref(summary)
-    pp_input = bad_ani_seqs(summary, ref_best)
-    make_pp_input(pp_input, ref_best)
\ No newline at end of file
+    parser = ArgumentParser()
+    parser.add_argument("--mash_table", dest="table",  default="results.txt", help="/path/to/input/mash/results.txt")
+    parser.add_argument("--min_ani", dest="min_ani", default=DEFAULT_MIN_ANI, type=float,
+                        help=f"minimum ANI to the reference for an assembly to be kept (default: {DEFAULT_MIN_ANI})")
+    parser.add_argument("--top_k", dest="top_k", default=1, type=int,
+                        help="number of best references to write PopPUNK input files for (default: 1)")
+    parser.add_argument("--chunksize", dest="chunksize", default=None, type=int,
+                        help="stream the mash table in chunks of this many rows to keep memory bounded")
+
+    args = parser.parse_args()
+    table = args.table
+
+    if args.chunksize:
+        refs = best_refs(ref_min_ani_chunked(read_mash_table(table, args.chunksize)), args.top_k)
+        pp_inputs = bad_ani_seqs_chunked(read_mash_table(table, args.chunksize), refs, args.min_ani)
+    else:
+        summary = read_mash_table(table)
+        refs = best_refs(ref_min_ani(summary), args.top_k)
+        pp_inputs = {ref: bad_ani_seqs(summary, ref, args.min_ani) for ref in refs}
+    for ref in refs:
+        make_pp_input(pp_inputs[ref], ref)
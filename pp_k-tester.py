@@ -1,58 +1,155 @@
+import os
 import sys
+import math
 import pandas as pd
 import subprocess
 from argparse import ArgumentParser
-from typing import List
-
-
-parser = ArgumentParser()
-parser.add_argument('--db', required=True, help='path/to/db')
-parser.add_argument("--min_clusters", default="2", type=int, help="minimum clusters to test")
-parser.add_argument("--max_clusters", default="3", type=int, help="maximum clusters to test")
-parser.add_argument("--step_size", dest="steps",  default="1", type=int, \
-                    help="step increment to best between cluster min and max")
-parser.add_argument('--analysis-args', dest='pp_args', default="", 
-                    help="Other arguments to pass to poppunk. e.g. ""'--thread 8'")
-
-args = parser.parse_args()
-db = args.db
-min_clusters = args.min_clusters
-max_clusters = args.max_clusters
-steps = args.steps
-pp_args = args.pp_args
-
-def fit_test(cluster_num:str, db:str, pp_args:str, add_list:List):
-    sys.stderr.write("Running --fit-model bgmm\n")
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List
+
+SCORE_COLS = ['avg entropy', "Score", "Score (w/ betweenness)", "Score (w/ weighted-betweenness)"]
+RESULT_COLS = ['K', 'status'] + SCORE_COLS
+DEFAULT_COARSE_POINTS = 5
+DEFAULT_TOLERANCE = 1e-4
+DEFAULT_PATIENCE = 2
+
+
+def fit_test(cluster_num:int, db:str, pp_args:str, threads:int) -> Dict:
+    """Fit a BGMM with K=cluster_num into its own output directory and parse the scores from stderr."""
+    outdir = f"{db}_K{cluster_num}"
     bgmm_cmd = \
-        "poppunk --fit-model bgmm  --ref-db " + db + \
-        " --output " + db + "--overwrite " + \
-        "--K " + str(cluster_num) + ""+ pp_args
+        "poppunk --fit-model bgmm --ref-db " + db + \
+        " --output " + outdir + " --overwrite" + \
+        " --K " + str(cluster_num) + \
+        " --threads " + str(threads) + " " + pp_args
     sys.stderr.write(bgmm_cmd + "\n")
 
+    row = {'K': cluster_num, 'status': 'ok'}
     try:
         proc = subprocess.run(bgmm_cmd, shell=True, check=True, \
                             universal_newlines = True, \
                             encoding='utf-8', capture_output=True)
-
-        row_list = [str(cluster_num)]
+        values = []
         for i in str(proc.stderr).split("\n"):
             if "Score" in i or "Avg. entropy of assignment" in i:
-                #print(i)
-                row_list.append(i.split("\t")[-1])
-    except:
-        row_list = []
+                values.append(i.split("\t")[-1])
+        row.update(zip(SCORE_COLS, values))
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        # keep the failure in the results instead of dropping the K value or stopping the sweep
+        if isinstance(e, subprocess.CalledProcessError):
+            last_line = [line for line in str(e.stderr).split("\n") if line.strip()][-1:] or [f"exit code {e.returncode}"]
+            reason = last_line[0].strip()
+        else:
+            reason = str(e) or type(e).__name__
+        row['status'] = f"failed: {reason}"
         print(f"{cluster_num} distinct component(s) could not be found.")
+    return row
+
+
+def run_fits(ks:List[int], db:str, pp_args:str, jobs:int, cpus:int) -> List[Dict]:
+    """Run the fits for every K concurrently, at most `jobs` at a time, splitting `cpus` threads between them."""
+    threads = max(1, cpus // jobs)
+    rows = []
+    # each job is its own poppunk process; the pool only waits on them
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(fit_test, k, db, pp_args, threads) for k in ks]
+        for future in as_completed(futures):
+            row = future.result()
+            print(f"K={row['K']}: {row['status']} (Score: {row.get('Score', 'NA')})", flush=True)
+            rows.append(row)
+    return rows
+
+
+def score_of(row:Dict) -> float:
+    try:
+        return float(row.get('Score'))
+    except (TypeError, ValueError):
+        return -math.inf
+
+
+def adaptive_search(min_k:int, max_k:int, db:str, pp_args:str, jobs:int, cpus:int,
+                    coarse_points:int = DEFAULT_COARSE_POINTS, tolerance:float = DEFAULT_TOLERANCE,
+                    patience:int = DEFAULT_PATIENCE) -> List[Dict]:
+    """Find the best-scoring K with a coarse grid followed by bracket-halving refinement around the best K.
+
+    Stops when the bracket is down to neighbouring K values or when `patience` refinement rounds in a row
+    improve the best Score by less than `tolerance` (the score has plateaued). Returns every fit in
+    evaluation order, with the round it was run in.
+    """
+    evaluated = {}
+    trace = []
+
+    def evaluate(ks, round_num):
+        ks = sorted(set(k for k in ks if min_k <= k <= max_k and k not in evaluated))
+        for row in sorted(run_fits(ks, db, pp_args, jobs, cpus), key=lambda r: r['K']):
+            row['round'] = round_num
+            evaluated[row['K']] = row
+            trace.append(row)
+        return [evaluated[k] for k in ks]
+
+    step = max(1, math.ceil((max_k - min_k) / max(1, coarse_points - 1)))
+    evaluate(list(range(min_k, max_k + 1, step)) + [max_k], 0)
+    best = max(evaluated.values(), key=score_of)
+
+    round_num = 0
+    stale_rounds = 0
+    while step > 1:
+        round_num += 1
+        step = math.ceil(step / 2)
+        new_rows = evaluate([best['K'] - step, best['K'] + step], round_num)
+        if not new_rows:
+            continue
+        new_best = max(new_rows, key=score_of)
+        gain = score_of(new_best) - score_of(best)
+        # -inf - -inf is nan when every fit so far failed; that is no progress either
+        if math.isnan(gain):
+            gain = 0.0
+        if gain > 0:
+            best = new_best
+        stale_rounds = stale_rounds + 1 if gain < tolerance else 0
+        print(f"Round {round_num}: best K={best['K']} (Score: {best.get('Score', 'NA')}), step {step}", flush=True)
+        if stale_rounds >= patience:
+            print("Score has plateaued, stopping search.")
+            break
 
-    return row_list
+    print(f"Best K={best['K']} (Score: {best.get('Score', 'NA')}) after {len(trace)} fit(s).")
+    return trace
 
 
 if __name__ == "__main__":
-    cluster_scores=[]
-    for i in range(min_clusters, max_clusters+1, steps):
-        cluster_scores.append(fit_test(i, db, pp_args, cluster_scores))
+    parser = ArgumentParser()
+    parser.add_argument('--db', required=True, help='path/to/db')
+    parser.add_argument("--min_clusters", default="2", type=int, help="minimum clusters to test")
+    parser.add_argument("--max_clusters", default="3", type=int, help="maximum clusters to test")
+    parser.add_argument("--step_size", dest="steps",  default="1", type=int, \
+                        help="step increment to best between cluster min and max")
+    parser.add_argument("--jobs", default=1, type=int, help="number of K values to fit at the same time")
+    parser.add_argument("--cpus", default=os.cpu_count(), type=int, \
+                        help="total threads to split between concurrent jobs (passed to poppunk as --threads)")
+    parser.add_argument('--analysis-args', dest='pp_args', default="",
+                        help="Other arguments to pass to poppunk. e.g. ""'--max-a-dist 0.8'")
+    parser.add_argument("--search", default="grid", choices=["grid", "adaptive"], \
+                        help="grid: fit every K from min to max by step_size. adaptive: coarse grid, then refine around the best Score")
+    parser.add_argument("--coarse_points", default=DEFAULT_COARSE_POINTS, type=int, \
+                        help="number of K values in the first pass of the adaptive search")
+    parser.add_argument("--tolerance", default=DEFAULT_TOLERANCE, type=float, \
+                        help="minimum improvement in the best Score for an adaptive search round to count as progress")
+    parser.add_argument("--patience", default=DEFAULT_PATIENCE, type=int, \
+                        help="stop the adaptive search after this many rounds in a row without progress")
 
+    args = parser.parse_args()
+    db = args.db
+    min_clusters = args.min_clusters
+    max_clusters = args.max_clusters
+    steps = args.steps
+    pp_args = args.pp_args
 
-    cluster_scores = [ls for ls in cluster_scores if ls != []]
-    df = pd.DataFrame(cluster_scores, columns = ['K', 'avg entropy', "Score", "Score (w/ betweenness)", "Score (w/ weighted-betweenness)"]) 
+    if args.search == "adaptive":
+        cluster_scores = adaptive_search(min_clusters, max_clusters, db, pp_args, args.jobs, args.cpus,
+                                         args.coarse_points, args.tolerance, args.patience)
+        df = pd.DataFrame(cluster_scores, columns = RESULT_COLS + ['round'])
+    else:
+        cluster_scores = run_fits(list(range(min_clusters, max_clusters+1, steps)), db, pp_args, args.jobs, args.cpus)
+        df = pd.DataFrame(cluster_scores, columns = RESULT_COLS).sort_values('K')
     df.to_csv(db+"_min-clust"+str(min_clusters)+"_max-clust"+str(max_clusters)+'.csv', index=False)
     print("see results in", db+"_min-clust"+str(min_clusters)+"_max-clust"+str(max_clusters)+'.csv')
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""Local SQLite inventory of S3 objects so the run-prefix scripts can answer lookups without listing buckets.
+
+Refresh it on a schedule (or after a run lands) and point the scripts at it with --inventory:
+
+    python s3_inventory.py refresh s3://<bucket>/workflow/phoenix/runs/
+    python s3_inventory.py ingest s3://<inventory-bucket>/<path>/manifest.json
+    python s3_phoenix_fix.py --bucket <bucket> --prefix workflow/phoenix/runs/<run> --inventory s3_inventory.sqlite
+
+The scripts only see what the last refresh saw. A refresh re-lists the prefix by default; refresh --append_only is
+cheaper but only picks up keys that sort after the last key seen, so samples added to an existing run (or any
+change or deletion) are missed until the next full refresh.
+"""
+import csv
+import gzip
+import io
+import json
+import sqlite3
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+
+import boto3
+
+DEFAULT_INVENTORY = "s3_inventory.sqlite"
+
+
+def split_s3_uri(uri):
+    bucket, _, prefix = uri.replace("s3://", "").partition("/")
+    return bucket, prefix
+
+
+def prefix_upper_bound(prefix):
+    """Smallest string greater than every string that starts with prefix (for index range scans)."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+
+
+def normalize_timestamp(value):
+    """UTC ISO 8601 string for a last-modified value from a listing (datetime) or an inventory report (string or
+    timestamp), so the same instant is stored the same way whichever path recorded it. Naive values are UTC."""
+    if value is None or value == "":
+        return None
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat()
+
+
+class S3Inventory:
+    """bucket/key -> size, ETag and last-modified, plus per-prefix refresh watermarks."""
+
+    def __init__(self, path=DEFAULT_INVENTORY):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS objects (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                size INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                seen INTEGER,
+                PRIMARY KEY (bucket, key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS watermarks (
+                bucket TEXT NOT NULL,
+                prefix TEXT NOT NULL,
+                last_key TEXT,
+                last_modified TEXT,
+                refreshed_at INTEGER,
+                PRIMARY KEY (bucket, prefix)
+            );
+        """)
+
+    def _upsert(self, bucket, rows, seen):
+        self.conn.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+                              [(bucket, key, size, etag, last_modified, seen) for key, size, etag, last_modified in rows])
+
+    def _range(self, prefix):
+        upper = prefix_upper_bound(prefix)
+        if upper is None:
+            return "", ()
+        return " AND key >= ? AND key < ?", (prefix, upper)
+
+    def refresh(self, bucket, prefix="", s3_client=None, full=True):
+        """Bring bucket/prefix up to date from a ListObjectsV2 listing. Returns the number of new or changed objects.
+
+        A full refresh re-lists the prefix, updates changed objects and removes objects that no longer exist.
+        With full=False the listing starts after the last key seen for this prefix: it is append-only and only
+        picks up new keys that sort after that key (new runs under later names), not samples added to earlier
+        runs, changed objects or deletions. S3 cannot list by modification time, so nothing cheaper is exact.
+        """
+        s3_client = s3_client or boto3.client("s3")
+        watermark = self.conn.execute("SELECT last_key, last_modified FROM watermarks WHERE bucket = ? AND prefix = ?",
+                                      (bucket, prefix)).fetchone()
+        kwargs = {"Bucket": bucket, "Prefix": prefix}
+        if watermark and watermark[0] and not full:
+            kwargs["StartAfter"] = watermark[0]
+        last_key, last_modified = watermark if watermark else (None, None)
+        where, params = self._range(prefix)
+        known = {key: (size, etag, modified) for key, size, etag, modified in self.objects(bucket, prefix)} if full else {}
+
+        seen = time.time_ns()
+        n = 0
+        for page in s3_client.get_paginator("list_objects_v2").paginate(**kwargs):
+            rows = [(obj["Key"], obj["Size"], obj["ETag"].strip('"'), normalize_timestamp(obj["LastModified"]))
+                    for obj in page.get("Contents", [])]
+            self._upsert(bucket, rows, seen)
+            for key, size, etag, modified in rows:
+                last_key = key if last_key is None or key > last_key else last_key
+                last_modified = modified if last_modified is None or modified > last_modified else last_modified
+                n += known.get(key) != (size, etag, modified)
+
+        if full:
+            self.conn.execute(f"DELETE FROM objects WHERE bucket = ? AND seen != ?{where}", (bucket, seen) + params)
+        self.conn.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?, ?)",
+                          (bucket, prefix, last_key, last_modified, int(time.time())))
+        self.conn.commit()
+        return n
+
+    def ingest_inventory(self, manifest_uri, s3_client=None, prefix=""):
+        """Load an S3 Inventory report (CSV or Parquet) from its manifest.json.
+
+        The report is a complete listing of its source bucket (or of prefix, for reports configured with a prefix
+        filter), so objects under it that are not in the report have been deleted and are removed.
+        """
+        s3_client = s3_client or boto3.client("s3")
+        manifest_bucket, manifest_key = split_s3_uri(manifest_uri)
+        manifest = json.loads(s3_client.get_object(Bucket=manifest_bucket, Key=manifest_key)["Body"].read())
+        fields = [f.strip() for f in manifest["fileSchema"].split(",")] if manifest["fileFormat"] == "CSV" else None
+        report_bucket = manifest["destinationBucket"].split(":::")[-1]
+
+        seen = time.time_ns()
+        n = 0
+        for report in manifest["files"]:
+            body = s3_client.get_object(Bucket=report_bucket, Key=report["key"])["Body"].read()
+            if manifest["fileFormat"] == "CSV":
+                # keys in CSV reports are URL-encoded
+                records = (dict(zip(fields, line)) for line in csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(body)))))
+                records = (dict(r, Key=unquote_plus(r["Key"])) for r in records)
+            else:
+                import pyarrow.parquet as pq
+                records = pq.read_table(io.BytesIO(body)).to_pylist()
+                records = ({"Bucket": r.get("bucket"), "Key": r.get("key"), "Size": r.get("size"),
+                            "ETag": r.get("e_tag"), "LastModifiedDate": r.get("last_modified_date")} for r in records)
+            by_bucket = {}
+            for r in records:
+                by_bucket.setdefault(r["Bucket"], []).append(
+                    (r["Key"], int(r["Size"] or 0), r.get("ETag"), normalize_timestamp(r.get("LastModifiedDate"))))
+            for bucket, rows in by_bucket.items():
+                self._upsert(bucket, rows, seen)
+                n += len(rows)
+        where, params = self._range(prefix)
+        self.conn.execute(f"DELETE FROM objects WHERE bucket = ? AND seen != ?{where}", (manifest["sourceBucket"], seen) + params)
+        self.conn.commit()
+        return n
+
+    def keys(self, bucket, prefix=""):
+        """Yield every key under bucket/prefix in lexicographic order, like a ListObjectsV2 listing."""
+        where, params = self._range(prefix)
+        for (key,) in self.conn.execute(f"SELECT key FROM objects WHERE bucket = ?{where} ORDER BY key", (bucket,) + params):
+            yield key
+
+    def objects(self, bucket, prefix=""):
+        """Yield (key, size, etag, last_modified) under bucket/prefix."""
+        where, params = self._range(prefix)
+        yield from self.conn.execute(f"SELECT key, size, etag, last_modified FROM objects WHERE bucket = ?{where} ORDER BY key",
+                                     (bucket,) + params)
+
+    def common_prefixes(self, bucket, prefix="", delimiter="/"):
+        """Directory names directly under prefix, like the PRE lines of `aws s3 ls`.
+
+        Skips over each directory with a single index seek instead of reading every key inside it.
+        """
+        upper = prefix_upper_bound(prefix)
+        sql = "SELECT key FROM objects WHERE bucket = ? AND key >= ?" + (" AND key < ?" if upper else "") + " ORDER BY key LIMIT 1"
+        prefixes = []
+        start = prefix
+        while True:
+            row = self.conn.execute(sql, (bucket, start, upper) if upper else (bucket, start)).fetchone()
+            if row is None:
+                break
+            rest = row[0][len(prefix):]
+            if delimiter in rest:
+                name = rest.split(delimiter, 1)[0]
+                prefixes.append(name)
+                start = prefix_upper_bound(prefix + name + delimiter)
+            else:
+                start = row[0] + "\0"
+        return prefixes
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Maintain a local SQLite inventory of S3 objects.")
+    parser.add_argument("--inventory", default=DEFAULT_INVENTORY, help=f"Path to the inventory database (Default: {DEFAULT_INVENTORY})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    refresh = subparsers.add_parser("refresh", help="List an S3 prefix into the inventory")
+    refresh.add_argument("uri", help="s3://bucket/prefix to refresh")
+    refresh.add_argument("--append_only", action="store_true",
+                         help="Only list keys after the last one seen. Misses keys added under earlier names, changes and deletions.")
+    ingest = subparsers.add_parser("ingest", help="Load an S3 Inventory report")
+    ingest.add_argument("manifest", help="s3:// URI of the report's manifest.json")
+    ingest.add_argument("--prefix", default="", help="Prefix filter the report was configured with, if any")
+    ls = subparsers.add_parser("ls", help="List keys under an S3 prefix from the inventory")
+    ls.add_argument("uri", help="s3://bucket/prefix to list")
+    args = parser.parse_args()
+
+    inventory = S3Inventory(args.inventory)
+    if args.command == "refresh":
+        bucket, prefix = split_s3_uri(args.uri)
+        print(f"{inventory.refresh(bucket, prefix, full=not args.append_only)} object(s) new or changed under {args.uri}")
+    elif args.command == "ingest":
+        print(f"{inventory.ingest_inventory(args.manifest, prefix=args.prefix)} object(s) loaded from {args.manifest}")
+    elif args.command == "ls":
+        bucket, prefix = split_s3_uri(args.uri)
+        try:
+            for key, size, etag, last_modified in inventory.objects(bucket, prefix):
+                print(f"{last_modified}\t{size}\t{key}")
+        except BrokenPipeError:
+            sys.exit(0)
+    inventory.close()
@@ -1,9 +1,13 @@
+import sys
 import boto3
+from botocore.config import Config
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List
-import glob
+import io
 import pandas as pd
-import os
+import transfer_metrics
+from s3_inventory import S3Inventory
 
 
 """
@@ -17,15 +21,22 @@ python --prefix workflow/phoenix/runs/<run_name> --bucket <bucket>
 """
 
 
-parser = ArgumentParser()
-parser.add_argument("--prefix", dest="prefix", help="path/phoenix/run")
-parser.add_argument("--bucket", dest="bucket", help="path/phoenix/run")
+DEFAULT_WORKERS = 32
 
-args = parser.parse_args() 
-prefix = args.prefix
-bucket_name = args.bucket
+s3_client = transfer_metrics.instrument_s3_client(boto3.client('s3', config=Config(max_pool_connections=DEFAULT_WORKERS)))
 
-s3_client = boto3.client('s3')
+
+def iter_s3_keys(bucket_name, prefix=""):
+    """
+    Yield the key of every object in an S3 bucket with an optional prefix, page by page.
+
+    :param bucket_name: Name of the S3 bucket
+    :param prefix: (Optional) Prefix to filter objects by path
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj['Key']
 
 
 def list_s3_objects(bucket_name, prefix=""):
@@ -35,31 +46,49 @@ def list_s3_objects(bucket_name, prefix=""):
     :param bucket_name: Name of the S3 bucket
     :param prefix: (Optional) Prefix to filter objects by path
     """
-    
-    paginator = s3_client.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+    return list(iter_s3_keys(bucket_name, prefix))
 
-    objs = []
-    #print(f"Listing objects in bucket: {bucket_name}")
-    for page in page_iterator:
-        if 'Contents' in page:
-            for obj in page['Contents']:
-                #print(obj['Key'])  # Print the object key (path)
-                objs.append(obj['Key']) 
-    return objs
 
+def index_phoenix_objects(keys, prefix):
+    """
+    Build a sample-keyed index of a Phoenix run in a single pass over its keys.
+
+    :param keys: Iterable of object keys (e.g. straight from iter_s3_keys)
+    :param prefix: Prefix of the Phoenix run
+    :return: (sample_list, {sample: [read keys]}, {sample: summaryline key})
+    """
+    sample_list = []
+    summaries = {}
+    reads = []  # (text after "/reads/", key) - matched to samples once every sample is known
+    for key in keys:
+        if key != prefix+"/" and key.endswith("/") and key[-2].isdigit():
+            sample_list.append(key.split("/")[-2])
+        elif key.endswith("_summaryline.tsv"):
+            summaries[key.split("/")[-1][:-len("_summaryline.tsv")]] = key
+        if "/reads/" in key:
+            reads.append((key.split("/reads/", 1)[1], key))
+
+    # a read belongs to every sample its name starts with, same as the f"/reads/{sample}" test
+    samples = set(sample_list)
+    lengths = sorted({len(sample) for sample in samples})
+    sample_reads = {sample: [] for sample in sample_list}
+    for rest, key in reads:
+        for n in lengths:
+            if rest[:n] in samples:
+                sample_reads[rest[:n]].append(key)
+    return sample_list, sample_reads, summaries
+
+
+def get_phoenix_reads(objs, bucket_name, prefix):
+    sample_list, reads, summaries = index_phoenix_objects(objs, prefix)
 
-def get_phoenix_reads(objs):
-    sample_list = get_phoenix_samples(objs)
-    
     sample_reads = {}
     sample_summary = []
     for sample in sample_list:
         # Get fastq files
-        fastqs = [f"s3://{bucket_name}/{item}" for item in objs if f"/reads/{sample}" in item]
-        sample_reads[sample] = fastqs
-        sample_summary.append(f"{prefix}/{sample}/{sample}_summaryline.tsv")
-    
+        sample_reads[sample] = [f"s3://{bucket_name}/{item}" for item in reads[sample]]
+        sample_summary.append(summaries.get(sample, f"{prefix}/{sample}/{sample}_summaryline.tsv"))
+
     return sample_reads, sample_summary
 
 
@@ -69,48 +98,87 @@ def make_manifest_csv(sample_reads):
     # Reset index to make keys a proper column (optional)
     df.reset_index(inplace=True)
     df.rename(columns={'index': 'sample'}, inplace=True)
-    df.to_csv("manifest.csv", index=False)
+    return df
 
 
-def make_phoenix_summary(sample_summary,_temp_files):
-    for s3_file_key in sample_summary:
-        local = s3_file_key.split("/")[-1]
-        temp_files.append(local)
-        s3_client.download_file(bucket_name, s3_file_key, local)
+def read_s3_tsv(bucket_name, s3_file_key):
+    with transfer_metrics.span("s3_download", source=f"s3://{bucket_name}/{s3_file_key}") as attrs:
+        body = s3_client.get_object(Bucket=bucket_name, Key=s3_file_key)['Body'].read()
+        attrs["bytes"] = len(body)
+    transfer_metrics.count("bytes_transferred", len(body), direction="s3_download")
+    return pd.read_csv(io.BytesIO(body), sep='\t')
 
-    tsv_files = glob.glob("WA*.tsv")
-    merged_df = pd.concat([pd.read_csv(file, sep='\t') for file in tsv_files], ignore_index=True)
 
-    # Save the merged table to a new TSV file
-    merged_df.to_csv("Phoenix_Summary.tsv", sep='\t', index=False)
-    return temp_files
+def make_phoenix_summary(sample_summary, bucket_name, workers=DEFAULT_WORKERS):
+    """
+    Fetch every sample summaryline concurrently into memory and merge them in sample order.
 
+    :param sample_summary: Keys of the <sample>_summaryline.tsv files
+    :param bucket_name: Name of the S3 bucket
+    :param workers: Number of summarylines to fetch at once
+    :return: (merged summary, keys that could not be read); the summary is None if any key failed
+    """
+    tables = [None] * len(sample_summary)
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(read_s3_tsv, bucket_name, key): i for i, key in enumerate(sample_summary)}
+        for future in as_completed(futures):
+            try:
+                tables[futures[future]] = future.result()
+            except Exception as e:
+                transfer_metrics.count("objects", status="failed")
+                failed.append(sample_summary[futures[future]])
+                print(f"Could not read s3://{bucket_name}/{sample_summary[futures[future]]}: {e}")
 
-def get_phoenix_samples(objs):
-    sample_list = []
-    for obj in objs:
-        if obj != prefix+"/" :
-            if obj.endswith("/"):
-                if obj[-2].isdigit():
-                    sample_list.append(obj.split("/")[-2])
-    return sample_list
+    # a partial summary would overwrite the complete copy in S3
+    if failed or not tables:
+        return None, sorted(failed)
+    return pd.concat(tables, ignore_index=True), []
 
 
-if __name__ == "__main__":
-    li = list_s3_objects(bucket_name, prefix)
-    #print(li)
-    sample_list = get_phoenix_samples(li)
-    sample_reads, sample_summary = get_phoenix_reads(li)
+def upload_df(df, bucket_name, key, sep=','):
+    """Write a DataFrame straight from memory to S3."""
+    body = df.to_csv(sep=sep, index=False).encode('utf-8')
+    with transfer_metrics.span("s3_upload", dest=f"s3://{bucket_name}/{key}", bytes=len(body)):
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+    transfer_metrics.count("bytes_transferred", len(body), direction="s3_upload")
 
-    # Make and upload Phoenix_summary.tsv and manifest.csv files
-    temp_files = ["Phoenix_Summary.tsv", "manifest.csv"]
 
-    temp_files = make_phoenix_summary(sample_summary, temp_files)
-    s3_client.upload_file("Phoenix_Summary.tsv", bucket_name, f"{prefix}/Phoenix_Summary.tsv")
+def get_phoenix_samples(objs, prefix):
+    return index_phoenix_objects(objs, prefix)[0]
 
-    make_manifest_csv(sample_reads)
-    s3_client.upload_file("manifest.csv", bucket_name, f"{prefix}/manifest.csv")
 
-    # Remove files related to summary and manifest
-    for file_path in temp_files:
-        os.remove(file_path)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--prefix", dest="prefix", help="path/phoenix/run")
+    parser.add_argument("--bucket", dest="bucket", help="path/phoenix/run")
+    parser.add_argument("--workers", dest="workers", type=int, default=DEFAULT_WORKERS, help="summarylines to fetch at once")
+    parser.add_argument("--inventory", dest="inventory", help="local S3 inventory (see s3_inventory.py) to read the run listing from instead of S3")
+    transfer_metrics.add_arguments(parser)
+
+    args = parser.parse_args() 
+    transfer_metrics.configure_from_args("s3_phoenix_fix", args)
+    prefix = args.prefix
+    bucket_name = args.bucket
+
+    # index the run while the listing pages stream in
+    if args.inventory:
+        keys = S3Inventory(args.inventory).keys(bucket_name, prefix)
+    else:
+        keys = iter_s3_keys(bucket_name, prefix)
+    # listing and indexing are interleaved, so this span covers both
+    with transfer_metrics.profile("list_and_index") as attrs:
+        sample_reads, sample_summary = get_phoenix_reads(keys, bucket_name, prefix)
+        attrs["samples"] = len(sample_summary)
+
+    # Make and upload Phoenix_summary.tsv and manifest.csv files
+    with transfer_metrics.span("fetch_summaries", objects=len(sample_summary)):
+        merged_df, failed = make_phoenix_summary(sample_summary, bucket_name, args.workers)
+    if failed:
+        sys.exit(f"Error: {len(failed)} summaryline(s) could not be read; nothing was uploaded to s3://{bucket_name}/{prefix}/")
+    if merged_df is None:
+        sys.exit(f"Error: no samples found under s3://{bucket_name}/{prefix}/; nothing was uploaded")
+    upload_df(merged_df, bucket_name, f"{prefix}/Phoenix_Summary.tsv", sep='\t')
+
+    upload_df(make_manifest_csv(sample_reads), bucket_name, f"{prefix}/manifest.csv")
+    print(f"Uploaded Phoenix_Summary.tsv ({len(merged_df)} samples) and manifest.csv to s3://{bucket_name}/{prefix}/")
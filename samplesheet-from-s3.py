@@ -2,19 +2,130 @@
 
 import boto3
 import argparse
+import queue
 import textwrap
 import sys
+import threading
+from botocore.config import Config
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from s3_inventory import S3Inventory
+
+DEFAULT_WORKERS = 16
+MAX_SHARD_DEPTH = 3
+
+
+def find_shards(s3_client, bucket, prefix, workers):
+    """Split prefix into sub-prefixes using the '/' delimiter.
+
+    Descends one level at a time until there are at least `workers` shards (or MAX_SHARD_DEPTH is reached).
+    A generator: yields the keys that sit directly under the levels that were expanded, page by page as they are
+    listed, and returns the shards (use `shards = yield from find_shards(...)`).
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    shards = [prefix]
+    for _ in range(MAX_SHARD_DEPTH):
+        if len(shards) >= workers:
+            break
+        next_shards = []
+        for shard in shards:
+            for page in paginator.paginate(Bucket=bucket, Prefix=shard, Delimiter='/'):
+                yield from (obj['Key'] for obj in page.get('Contents', []))
+                next_shards.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        shards = next_shards
+        if not shards:
+            break
+    return shards
+
+
+def iter_keys(s3_client, bucket, prefix, workers=DEFAULT_WORKERS):
+    """Yield every key under prefix, listing the shards of the prefix concurrently.
+
+    Keys are yielded page by page as the listings come back, so the full listing is never held in memory.
+    """
+    shards = yield from find_shards(s3_client, bucket, prefix, workers)
+    if not shards:
+        return
+
+    pages = queue.Queue(maxsize=workers * 4)
+    # set when the consumer stops early (an exception or a break), so the listers stop instead of blocking on a full queue
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_shard(shard):
+        try:
+            for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=shard):
+                if stop.is_set() or not put([obj['Key'] for obj in page.get('Contents', [])]):
+                    return
+        finally:
+            put(None)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(list_shard, shard) for shard in shards]
+        try:
+            finished = 0
+            while finished < len(shards):
+                page = pages.get()
+                if page is None:
+                    finished += 1
+                else:
+                    yield from page
+        finally:
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+        # surface listing errors from the workers
+        for future in futures:
+            future.result()
+
+
+def pair_reads(keys):
+    """Group fastq keys into R1/R2 pairs by sample. Returns (pairs, errors, number of keys seen)."""
+    fqs = defaultdict(dict)
+    errors = []
+    n_keys = 0
+    for f in keys:
+        n_keys += 1
+        fname = f.split('/')[-1]
+        ext = fname.split('.')
+        if any(e in ['fastq','fq'] for e in ext):
+            id = fname.split('_')[0]
+            finfo = fname.split('_')[1:]
+            if any(e in ['R1','1'] for e in finfo):
+                fqs[id]['r1'] = f
+            elif any(e in ['R2','2'] for e in finfo):
+                fqs[id]['r2'] = f
+            else:
+                errors.append(f"Cannot determine if {fname} is foward or reverse read.")
+
+    pairs = {}
+    for k, v in fqs.items():
+        missing = [r for r in ['r1', 'r2'] if r not in v]
+        if missing:
+            errors.append(f"{k} is missing its {' and '.join(m.upper() for m in missing)} read.")
+        else:
+            pairs[k] = v
+    return pairs, errors, n_keys
+
 
 def main():
-    version = "1.0"
+    version = "1.1"
 
     parser = argparse.ArgumentParser(description="Create samplesheet from paired reads in an S3 bucket")
     parser.add_argument("bucket_uri", help="URI path to s3 bucket containing reads")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"Number of prefixes to list at once (Default: {DEFAULT_WORKERS})")
+    parser.add_argument("--inventory", help="Local S3 inventory (see s3_inventory.py) to read the listing from instead of S3")
     parser.add_argument('--version', action='version', version=f'%(prog)s {version}')
     args = parser.parse_args()
 
-    print(textwrap.dedent(f""" 
+    print(textwrap.dedent(f"""
         samplesheet-from-s3.py v{version}
         -----------------------------
     """), flush=True)
@@ -23,45 +134,40 @@ def main():
 
     if not bucket_uri.startswith('s3://'):
         sys.exit(f'Error: {bucket_uri} does not look like an s3 URI')
-    
+
     bucket_bits = bucket_uri.replace("s3://", "").split('/')
     bucket = bucket_bits[0]
     prefix = '/'.join(bucket_bits[1:])
 
-    s3_client = boto3.client('s3')
-    response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    if 'Contents' not in response:
+    if args.inventory:
+        keys = S3Inventory(args.inventory).keys(bucket, prefix)
+    else:
+        s3_client = boto3.client('s3', config=Config(max_pool_connections=args.workers))
+        keys = iter_keys(s3_client, bucket, prefix, args.workers)
+    fqs, errors, n_keys = pair_reads(keys)
+    if n_keys == 0:
         sys.exit("No objects found - check your URI path")
-    
-    fqs = defaultdict(dict)
-    for obj in response['Contents']:
-            f = obj['Key']
-            fname = f.split('/')[-1]
-            ext = fname.split('.')
-            if any(e in ['fastq','fq'] for e in ext):
-                id = fname.split('_')[0]
-                finfo = fname.split('_')[1:]
-                if any(e in ['R1','1'] for e in finfo):
-                    fqs[id]['r1'] = f
-                elif any(e in ['R2','2'] for e in finfo): 
-                    fqs[id]['r2'] = f
-                else:
-                    sys.exit(f"Error: Cannot determine if {fname} is foward or reverse read.")
-    
+
     fq_csv = ['sample,fastq_1,fastq_2']
     for k, v in fqs.items():
         r1 = f"s3://{bucket}/{v['r1']}"
         r2 = f"s3://{bucket}/{v['r2']}"
         fq_csv.append(','.join([str(k),str(r1),str(r2)]))
-    
+
     fileout = 'samplesheet.csv'
     with open(fileout, 'w') as out:
         out.write('\n'.join(fq_csv))
 
-    print(f"File saved to {fileout}")
-        
+    print(f"{len(fqs)} sample(s) from {n_keys} object(s) saved to {fileout}")
+
+    if errors:
+        print(f"\n{len(errors)} pairing error(s):", file=sys.stderr)
+        for error in errors:
+            print(f"  {error}", file=sys.stderr)
+        sys.exit("Error: some reads could not be paired and were left out of the samplesheet.")
+
+
 
-    
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
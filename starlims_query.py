@@ -1,52 +1,429 @@
 import sys
+import os
+import time
+import json
+import uuid
+import queue
+import hashlib
+import threading
+import decimal
+import datetime
 import configparser
-import pymssql
 import argparse
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BATCH_SIZE = 50000
+DEFAULT_STATE = 'starlims_watermarks.json'
+# pandas dtypes for pymssql's cursor.description type codes (NUMBER, DATETIME, DECIMAL); STRING/BINARY stay objects
+TYPE_CODE_DTYPES = {3: 'float64', 4: 'datetime64[ns]', 5: 'float64'}
+
+
+#----- CONNECTIONS -----#
+def connect(server, port):
+    import pymssql
+    return pymssql.connect(server = server, port = port)
+
+
+def placeholder(conn):
+    # pymssql uses %s, the sqlite3 stand-in used for local testing uses ?
+    return '?' if type(conn).__module__.startswith('sqlite3') else '%s'
 
-# ---- ARGUMENTS -----#
-parser = argparse.ArgumentParser(
-                    prog='get_sl_data.py',
-                    description='This script quries the StarLIMS SQL database and saves it as a comma-separated file.')
-parser.add_argument('-q',
-                    '--query',
-                    help = 'SQL query')
-parser.add_argument('-o', 
-                    '--output',
-                    help = 'Name of output file (e.g., 2023_lims_data.csv)')
-parser.add_argument('-c',
-                    '--config',
-                    help = 'Path to config file (.ini). Used preferentially over --server and --port flags.')
-parser.add_argument('-s', 
-                    '--server',
-                    help = 'Server name. Must be used in combination with server port number.')
-parser.add_argument('-p', 
-                    '--port',
-                    help = 'Server port number. Must be used in combination with server name.')
-
-args = parser.parse_args()
-
-#----- ASSIGN SERVER & POR -----#
-if args.port is not None and args.server is not None:
-    serv = args.server
-    prt = args.port
-
-# via config file
-if args.config is not None:
-    # load LIMS config file
-    config = configparser.ConfigParser()
-    config.read(args.config)
-    
-    serv = config['DEFAULT']['SERVER'].split(',')[0]
-    prt = config['DEFAULT']['SERVER'].split(',')[1]
-
-# no server info supplied
-if args.port is None and args.server is None and args.config is None:
-    sys.exit("Error: Please provide the server name and port number via the --config or --server and --port flags.")
-
-#----- CONNECT TO SERVER -----#
-conn = pymssql.connect(server = serv, port = prt)
 
 #----- PERFORM QUERY & SAVE RESULTS -----#
-df = pd.read_sql(args.query, conn)
-df.to_csv(args.output, sep=',', index = False, encoding = 'utf-8')
+def fetch_batches(conn, query, batch_size, params=()):
+    """Run query and yield the results as DataFrames of at most batch_size rows."""
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    columns = [col[0] for col in cursor.description]
+    dtypes = {col[0]: TYPE_CODE_DTYPES[col[1]] for col in cursor.description if col[1] in TYPE_CODE_DTYPES}
+    first = True
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        # an empty first batch is still yielded so the output gets its header
+        if not rows and not first:
+            break
+        first = False
+        df = pd.DataFrame.from_records(rows, columns=columns)
+        # a column with no values in this batch takes its type from the cursor, not from the (absent) values
+        empty = {c: dtype for c, dtype in dtypes.items() if df[c].isna().all()}
+        yield df.astype(empty) if empty else df
+        if not rows:
+            break
+    cursor.close()
+
+
+def parquet_schema(df):
+    """Writer schema from the first batch. Columns that are all null in it are stored as strings and decimals
+    get the widest precision, so later batches can always be cast to it."""
+    import pyarrow as pa
+    fields = []
+    for field in pa.Schema.from_pandas(df, preserve_index=False):
+        if pa.types.is_null(field.type):
+            field = pa.field(field.name, pa.string())
+        elif pa.types.is_decimal(field.type):
+            field = pa.field(field.name, pa.decimal128(38, field.type.scale))
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def to_schema(df, schema):
+    """Arrow table of a batch in the writer's schema.
+
+    Types are inferred per batch, so the same column can come back as float64 in one batch (ints with a NULL) and
+    int64 in the next, or as numbers after a batch where it was all NULL. Such columns are cast to the writer's type.
+    """
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    columns = [table.column(f.name) if table.schema.field(f.name).type == f.type else table.column(f.name).cast(f.type)
+               for f in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def write_batches(batches, output, fmt, compression, append=False):
+    """Write each batch to output as it arrives, reporting progress in rows per second.
+
+    With append, CSV rows are added to an existing output (which already has its header). Parquet cannot be appended to.
+    """
+    if append and fmt == 'parquet':
+        raise ValueError(f"Cannot append to {output}: Parquet files cannot be appended to, use a store instead")
+    start = time.time()
+    n_rows = 0
+    writer = None
+    header = not (append and os.path.exists(output) and os.path.getsize(output) > 0)
+    started = False
+    with open(output, 'ab' if append else 'wb') as out:
+        for df in batches:
+            # only the first batch is needed when empty (for the header or schema)
+            if started and not len(df):
+                continue
+            started = True
+            if fmt == 'parquet':
+                import pyarrow.parquet as pq
+                if writer is None:
+                    schema = parquet_schema(df)
+                    writer = pq.ParquetWriter(out, schema, compression=compression)
+                writer.write_table(to_schema(df, schema))
+            else:
+                out.write(df.to_csv(sep=',', index=False, header=header).encode('utf-8'))
+                header = False
+            n_rows += len(df)
+            elapsed = time.time() - start
+            print(f"{n_rows} rows written ({n_rows / max(elapsed, 1e-6):.0f} rows/s)", file=sys.stderr, flush=True)
+        if writer is not None:
+            writer.close()
+    return n_rows
+
+
+#----- INCREMENTAL PULLS -----#
+def query_key(query):
+    return hashlib.sha1(query.encode('utf-8')).hexdigest()[:12]
+
+
+def load_watermark(state_file, name):
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file) as f:
+        return from_watermark(json.load(f).get(name))
+
+
+def save_watermark(state_file, name, value):
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+    state[name] = value
+    with open(state_file, 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def to_watermark(value):
+    """JSON-friendly form of a column value. Dates and datetimes are stored as ISO strings tagged with their type."""
+    if isinstance(value, pd.Timestamp):
+        value = value.to_pydatetime()
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'date': value.isoformat()}
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def from_watermark(value):
+    """Column value back from its stored form, so dates are bound as native parameters and not as strings."""
+    if isinstance(value, dict) and 'datetime' in value:
+        return datetime.datetime.fromisoformat(value['datetime'])
+    if isinstance(value, dict) and 'date' in value:
+        return datetime.date.fromisoformat(value['date'])
+    return value
+
+
+def native(value):
+    """Value as the driver should bind it (pandas timestamps and numpy scalars as their Python equivalents)."""
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def incremental_query(query, column, watermark, ph):
+    """Wrap query so it only returns rows with column greater than the stored watermark."""
+    if watermark is None:
+        return query, ()
+    return f"SELECT * FROM ({query}) AS q WHERE q.{column} > {ph}", (watermark,)
+
+
+def tracking_watermark(batches, column, state):
+    """Pass batches through while keeping the highest value of column seen in state['max']."""
+    for df in batches:
+        if len(df) and df[column].notna().any():
+            batch_max = df[column].max()
+            if state.get('max') is None or batch_max > state['max']:
+                state['max'] = batch_max
+        yield df
+
+
+def write_to_store(batches, store, compression):
+    """Append batches to a local Parquet store partitioned by load date. Returns the part written."""
+    partition = os.path.join(store, f"load_date={datetime.date.today().isoformat()}")
+    os.makedirs(partition, exist_ok=True)
+    part = os.path.join(partition, f"part-{uuid.uuid4().hex}.parquet")
+    n_rows = write_batches(batches, part, 'parquet', compression)
+    if n_rows == 0:
+        os.remove(part)
+    return part, n_rows
+
+
+#----- PARALLEL PULLS -----#
+def split_range(lo, hi, n):
+    """Split [lo, hi] into n contiguous (start, end) ranges. Works for numbers, dates and ISO date strings
+    (sqlite has no date type); the inner bounds have the same type as the end points.
+
+    Raises ValueError for any other column type (e.g. text keys), which cannot be split arithmetically.
+    """
+    start, end = lo, hi
+    if isinstance(lo, str):
+        try:
+            start, end = datetime.datetime.fromisoformat(lo), datetime.datetime.fromisoformat(hi)
+        except ValueError:
+            start = None
+    if not isinstance(start, (int, float, decimal.Decimal, datetime.date)):
+        raise ValueError(f"Only numeric or date columns can be partitioned, got values like {lo!r}")
+    if isinstance(start, int):
+        inner = [start + (end - start) * i // n for i in range(1, n)]
+    else:
+        inner = [start + (end - start) * i / n for i in range(1, n)]
+    # keep the original end points so the outer bounds compare exactly like the column values
+    bounds = [lo] + [b.isoformat() if isinstance(lo, str) else b for b in inner] + [hi]
+    return [(bounds[i], bounds[i + 1]) for i in range(n) if i == n - 1 or bounds[i] != bounds[i + 1]]
+
+
+def range_queries(conn, query, column, n, params=()):
+    """Split query into n queries over contiguous ranges of column (the last range includes the maximum)."""
+    ph = placeholder(conn)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT MIN(q.{column}), MAX(q.{column}) FROM ({query}) AS q", params)
+    lo, hi = cursor.fetchone()
+    cursor.close()
+    if lo is None:
+        return [(query, params)]
+    try:
+        ranges = split_range(lo, hi, n)
+    except ValueError as e:
+        raise ValueError(f"Cannot partition on {column}: {e}") from None
+    queries = []
+    for i, (start, end) in enumerate(ranges):
+        op = '<=' if i == len(ranges) - 1 else '<'
+        queries.append((f"SELECT * FROM ({query}) AS q WHERE q.{column} >= {ph} AND q.{column} {op} {ph}",
+                        tuple(params) + (native(start), native(end))))
+    return queries
+
+
+def parallel_batches(connect_fn, queries, batch_size, workers):
+    """Run queries on a pool of connections and yield their batches as they arrive (in no particular order)."""
+    batches = queue.Queue(maxsize=workers * 2)
+    done = object()
+    # set when the consumer stops early (closed, or the writer raised), so the workers stop instead of blocking on a full queue
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(query, params):
+        if stop.is_set():
+            return
+        conn = connect_fn()
+        try:
+            for df in fetch_batches(conn, query, batch_size, params):
+                if not put(df):
+                    return
+        finally:
+            conn.close()
+            put(done)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run, query, params) for query, params in queries]
+        try:
+            finished = 0
+            empty = None
+            yielded = False
+            while finished < len(queries):
+                df = batches.get()
+                if df is done:
+                    finished += 1
+                elif len(df):
+                    yielded = True
+                    yield df
+                else:
+                    empty = df
+        finally:
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+        for future in futures:
+            future.result()
+        # an empty batch is only passed on when no range returned rows, so the output still gets its header
+        if not yielded and empty is not None:
+            yield empty
+
+
+def extract(connect_fn, query, output=None, fmt='csv', compression='zstd', batch_size=DEFAULT_BATCH_SIZE,
+            incremental_column=None, state_file=DEFAULT_STATE, name=None, store=None,
+            partition_column=None, partitions=1, workers=1):
+    """Pull query results, optionally incrementally (above a stored watermark) and/or in parallel ranges.
+
+    connect_fn returns a new DB-API connection; pymssql in production, sqlite3 for local testing.
+    """
+    conn = connect_fn()
+    ph = placeholder(conn)
+    name = name or query_key(query)
+    params = ()
+    watermark = None
+    if incremental_column:
+        watermark = load_watermark(state_file, name)
+        print(f"Pulling rows with {incremental_column} > {watermark}" if watermark is not None else "No watermark stored, pulling all rows", file=sys.stderr)
+        query, params = incremental_query(query, incremental_column, watermark, ph)
+
+    if partition_column and partitions > 1:
+        queries = range_queries(conn, query, partition_column, partitions, params)
+        conn.close()
+        batches = parallel_batches(connect_fn, queries, batch_size, workers)
+    else:
+        batches = fetch_batches(conn, query, batch_size, params)
+
+    state = {}
+    if incremental_column:
+        batches = tracking_watermark(batches, incremental_column, state)
+
+    if store:
+        part, n_rows = write_to_store(batches, store, compression)
+        print(f"{n_rows} new rows appended to {store}" + (f" ({part})" if n_rows else ""), file=sys.stderr)
+    else:
+        # after the first pull an output file only receives the new rows, so they are added to it
+        n_rows = write_batches(batches, output, fmt, compression, append=watermark is not None)
+
+    if incremental_column and state.get('max') is not None:
+        save_watermark(state_file, name, to_watermark(state['max']))
+    return n_rows
+
+
+if __name__ == "__main__":
+    # ---- ARGUMENTS -----#
+    parser = argparse.ArgumentParser(
+                        prog='get_sl_data.py',
+                        description='This script quries the StarLIMS SQL database and saves it as a comma-separated file.')
+    parser.add_argument('-q',
+                        '--query',
+                        help = 'SQL query')
+    parser.add_argument('-o',
+                        '--output',
+                        help = 'Name of output file (e.g., 2023_lims_data.csv)')
+    parser.add_argument('-c',
+                        '--config',
+                        help = 'Path to config file (.ini). Used preferentially over --server and --port flags.')
+    parser.add_argument('-s',
+                        '--server',
+                        help = 'Server name. Must be used in combination with server port number.')
+    parser.add_argument('-p',
+                        '--port',
+                        help = 'Server port number. Must be used in combination with server name.')
+    parser.add_argument('--stream',
+                        action = 'store_true',
+                        help = 'Fetch and write the results in batches instead of loading them all into memory.')
+    parser.add_argument('--batch_size',
+                        type = int,
+                        default = DEFAULT_BATCH_SIZE,
+                        help = f'Number of rows per batch when streaming (Default: {DEFAULT_BATCH_SIZE}).')
+    parser.add_argument('--format',
+                        choices = ['csv', 'parquet'],
+                        help = 'Output format. Defaults to parquet if the output ends in .parquet, otherwise csv.')
+    parser.add_argument('--compression',
+                        default = 'zstd',
+                        help = 'Parquet compression codec (Default: zstd).')
+    parser.add_argument('--incremental_column',
+                        help = 'Date or identity column. Only rows above the value stored from the last run are pulled and appended to a CSV --output or to --store. Implies --stream.')
+    parser.add_argument('--state',
+                        default = DEFAULT_STATE,
+                        help = f'JSON file holding the watermark of each query (Default: {DEFAULT_STATE}).')
+    parser.add_argument('--name',
+                        help = 'Name the watermark is stored under (Default: a hash of the query).')
+    parser.add_argument('--store',
+                        help = 'Directory of a local Parquet store to append results to (partitioned by load date) instead of --output.')
+    parser.add_argument('--partition_column',
+                        help = 'Numeric key or date column used to split the query into ranges pulled in parallel. Implies --stream.')
+    parser.add_argument('--partitions',
+                        type = int,
+                        default = 1,
+                        help = 'Number of ranges to split the query into (Default: 1).')
+    parser.add_argument('--workers',
+                        type = int,
+                        default = 4,
+                        help = 'Number of connections used for parallel pulls (Default: 4).')
+
+    args = parser.parse_args()
+
+    #----- ASSIGN SERVER & POR -----#
+    if args.port is not None and args.server is not None:
+        serv = args.server
+        prt = args.port
+
+    # via config file
+    if args.config is not None:
+        # load LIMS config file
+        config = configparser.ConfigParser()
+        config.read(args.config)
+
+        serv = config['DEFAULT']['SERVER'].split(',')[0]
+        prt = config['DEFAULT']['SERVER'].split(',')[1]
+
+    # no server info supplied
+    if args.port is None and args.server is None and args.config is None:
+        sys.exit("Error: Please provide the server name and port number via the --config or --server and --port flags.")
+    if args.output is None and args.store is None:
+        sys.exit("Error: Please provide an output file (--output) or a local store (--store).")
+
+    fmt = args.format or ('parquet' if args.output and args.output.endswith('.parquet') else 'csv')
+    if args.incremental_column and args.store is None and fmt == 'parquet':
+        sys.exit("Error: New rows cannot be appended to a Parquet --output. Use a CSV --output or a local store (--store) with --incremental_column.")
+    if args.stream or args.incremental_column or args.partition_column or args.store:
+        try:
+            extract(lambda: connect(serv, prt), args.query, args.output, fmt, args.compression, args.batch_size,
+                    args.incremental_column, args.state, args.name, args.store,
+                    args.partition_column, args.partitions, args.workers)
+        except ValueError as e:
+            sys.exit(f"Error: {e}")
+    else:
+        #----- CONNECT TO SERVER -----#
+        conn = connect(serv, prt)
+        df = pd.read_sql(args.query, conn)
+        if fmt == 'parquet':
+            df.to_parquet(args.output, index = False, compression = args.compression)
+        else:
+            df.to_csv(args.output, sep=',', index = False, encoding = 'utf-8')
@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
 import os
-import argparse
-import firecloud.api as fapi
-import subprocess
+import io
+import sys
+import boto3
 from argparse import ArgumentParser
-from pathlib import Path
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
-from typing import List
+from gcs2s3 import S3MultipartWriter, split_uri
+from transfer_ledger import TransferLedger, DEFAULT_LEDGER, REVALIDATE_HELP, file_md5, checksum_metadata
+
+# use the copy of export_large_tsv.py kept in this repo instead of downloading Broad's
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "waphl-terra2aws"))
+from export_large_tsv import download_table_from_workspace, write_tsv_from_workspace, write_parquet_from_workspace, DEFAULT_MAX_IN_FLIGHT
 
 parser = ArgumentParser()
 parser.add_argument("-f", dest="access_file", required=True,
@@ -16,7 +22,14 @@ parser.add_argument("-f", dest="access_file", required=True,
 parser.add_argument("--tables", dest="tables",  required=True, help="Table(s) to pull and/or push to s3 bucket", nargs="*")
 parser.add_argument('--pull', dest="pull", action='store_true', help="Pulls table(s) from Terra.bio")
 parser.add_argument("--push", dest="push",  action='store_true', help="Pushes table(s) to s3 bucket")
-parser.add_argument("--clean", dest="clean",  action='store_true', help="Pushes table(s) to s3 bucket")
+parser.add_argument("--clean", dest="clean",  action='store_true', help="Removes the local file of every table when done")
+parser.add_argument("--keep_local", dest="keep_local",  action='store_true', help="With --pull --push, also write each table to a local file (by default tables are streamed straight to s3)")
+parser.add_argument("--format", dest="format", default="tsv", choices=["tsv", "parquet"], help="Table format. parquet is typed and zstd-compressed, so readers can load only the columns they need (Default: tsv)")
+parser.add_argument("--workers", dest="workers", default=4, type=int, help="Number of tables to pull/push at the same time (Default: 4)")
+parser.add_argument("--max_in_flight", dest="max_in_flight", default=DEFAULT_MAX_IN_FLIGHT, type=int, help=f"Number of pages fetched at the same time for each table (Default: {DEFAULT_MAX_IN_FLIGHT})")
+parser.add_argument("--force", dest="force",  action='store_true', help="Push table(s) even if an identical copy already exists in the s3 bucket")
+parser.add_argument("--ledger", dest="ledger", default=DEFAULT_LEDGER, help=f"Local cache of files already copied to AWS (Default: {DEFAULT_LEDGER})")
+parser.add_argument("--revalidate", dest="revalidate", action="store_true", help=REVALIDATE_HELP)
 
 
 args = parser.parse_args() 
@@ -29,70 +42,119 @@ pull = args.pull
 push = args.push
 tables = args.tables
 clean = args.clean
-python_v = "python3"
-home_dir = str(Path.home())
+force = args.force
 
 
 def local_to_s3(local_file: str,
                 s3_file: str = out_s3,
-                force: bool = False) -> None:
-      if force == False:
-            import httplib2
-            h = httplib2.Http()
-            resp = h.request(s3_file, 'HEAD')
-            if int(resp[0]['status']) < 400:
-                  subprocess.run(f'aws s3 cp {local_file} {s3_file}', shell=True)
-            else:
-                  print(s3_file+" already exists")
-      else:
-            subprocess.run(f'aws s3 cp {local_file} {s3_file}', shell=True)
-
-
-def script_check(expt: str = f"{home_dir}/terra_aws_scripts/export_large_tsv.py",
-                impt: str = f"{home_dir}/terra_aws_scripts/import_large_tsv.py") -> List[str]:
-    if not os.path.exists(f'{home_dir}/terra_aws_scripts'):
-        print('Path ~/terra_aws_scripts does not yet exist\nCreating ~/terra_aws_scripts ...')
-        os.makedirs(f'{home_dir}/terra_aws_scripts')
-
-    if not os.path.exists(expt):  
-            print(f"export_large_tsv.py to {home_dir}/terra_aws_scripts/export_large_tsv.py")      
-            subprocess.run(f'wget -O {home_dir}/terra_aws_scripts/export_large_tsv.py \
-                           https://raw.githubusercontent.com/broadinstitute/terra-tools/master/scripts/export_large_tsv/export_large_tsv.py', 
-                           shell=True)
-    if not os.path.exists(impt):
-            print(f"import_large_tsv.py to {home_dir}/terra_aws_scripts/import_large_tsv.py")      
-            subprocess.run(f'wget -O {home_dir}/terra_aws_scripts/import_large_tsv.py \
-                           https://raw.githubusercontent.com/broadinstitute/terra-tools/master/scripts/import_large_tsv/import_large_tsv.py', 
-                           shell=True)
-    
-    return expt, impt
+                force: bool = False,
+                ledger: TransferLedger = None,
+                s3_client = None) -> None:
+      s3_bucket, _, s3_key = s3_file.replace("s3://", "").partition("/")
+      s3_client = s3_client or boto3.client("s3")
+      md5 = file_md5(local_file)
+      size = os.path.getsize(local_file)
+      source = os.path.abspath(local_file)
+      if force == False and ledger is not None and ledger.is_current(source, s3_bucket, s3_key, s3_client, size, md5=md5):
+            print(s3_file+" already exists")
+            return
+      s3_client.upload_file(local_file, s3_bucket, s3_key, ExtraArgs={"Metadata": checksum_metadata(md5=md5)})
+      print(f"{local_file} uploaded to {s3_file}")
+      if ledger is not None:
+            ledger.record(source, s3_file, size, md5=md5)
+
+
+class Tee:
+      """Stream that writes everything to several streams (e.g. an S3 upload and a local copy)."""
+      def __init__(self, *streams):
+            self.streams = streams
+            self.closed = False
+
+      def write(self, data) -> int:
+            for stream in self.streams:
+                  stream.write(data)
+            return len(data)
+
+      def flush(self) -> None:
+            for stream in self.streams:
+                  stream.flush()
 
 
 def pull_terra_table(project_billing: str,
                      terra_workspace: str,
                      table_name: str,
-                     force: bool = True) -> None:
-      subprocess.run(f'{python_v} {home_dir}/terra_aws_scripts/export_large_tsv.py \
-                     --project {project_billing} --workspace {terra_workspace} \
-                     --entity_type {table_name} \
-                     --tsv_filename ./{table_name}.tsv', shell=True)
+                     max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                     fmt: str = "tsv") -> None:
+      download_table_from_workspace(project_billing, terra_workspace, table_name, f"./{table_name}.{fmt}",
+                                    max_in_flight = max_in_flight, fmt = fmt)
+
+
+def pull_push_table(project_billing: str,
+                    terra_workspace: str,
+                    table_name: str,
+                    s3_file: str,
+                    s3_client,
+                    keep_local: bool = False,
+                    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                    fmt: str = "tsv") -> int:
+      """Export a Terra table (TSV or Parquet) straight into an S3 multipart upload. Returns the number of bytes uploaded."""
+      s3_bucket, s3_key = split_uri(s3_file)
+      writer = S3MultipartWriter(s3_client, s3_bucket, s3_key)
+      out = io.BufferedWriter(writer, buffer_size = 1024 * 1024)
+      if fmt == "tsv":
+            out = io.TextIOWrapper(out, encoding = "utf-8", newline = "")
+      local = open(f"./{table_name}.{fmt}", "w" if fmt == "tsv" else "wb") if keep_local else None
+      try:
+            write_table = write_parquet_from_workspace if fmt == "parquet" else write_tsv_from_workspace
+            write_table(project_billing, terra_workspace, table_name,
+                        Tee(out, local) if local else out, max_in_flight = max_in_flight)
+            out.flush()
+      except BaseException:
+            # never leave a half-written table in S3
+            writer.abort()
+            raise
+      finally:
+            out.close()
+            if local:
+                  local.close()
+      print(f"{table_name} uploaded to {s3_file} ({writer.n_bytes / 1e6:.1f} MB)", flush = True)
+      return writer.n_bytes
+
+
+def run_table(table: str, s3_client, ledger: TransferLedger) -> None:
+      s3_file = "s3://"+out_s3+table+"."+args.format
+      if pull and push:
+            pull_push_table(project_billing, terra_workspace, table, s3_file, s3_client,
+                            keep_local = args.keep_local, max_in_flight = args.max_in_flight, fmt = args.format)
+      elif pull:
+            pull_terra_table(project_billing, terra_workspace, table, args.max_in_flight, args.format)
+      elif push:
+            local_to_s3(table+"."+args.format, s3_file, force = force, ledger = ledger, s3_client = s3_client)
 
 
 def clean_by_file(filename) -> None:
-     # Clean files by extention
-     subprocess.run(f'rm -rf *{filename}', shell=True)
-     print(f'{filename} has been removed from local environment')
+     if os.path.exists(filename):
+          os.remove(filename)
+          print(f'{filename} has been removed from local environment')
      
 
 if __name__ == "__main__":
-    script_check()
     if type(tables) is not list:
         tables = [tables]
-    for table in tables:
-        if pull:
-            pull_terra_table(project_billing, terra_workspace, table)
-        if push:
-            local_to_s3(table+".tsv" ,  "s3://"+out_s3+table+".tsv", force = True)
+    ledger = TransferLedger(args.ledger, revalidate=args.revalidate)
+    s3_client = boto3.client("s3", config = Config(max_pool_connections = max(10, args.workers * 2)))
+    failed = []
+    # each table is pulled page by page (max_in_flight pages at a time) and several tables run at once
+    with ThreadPoolExecutor(max_workers = args.workers) as pool:
+        futures = {pool.submit(run_table, table, s3_client, ledger): table for table in tables}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"Error: {futures[future]} failed: {e}", flush = True)
     if clean:
-         clean_by_file(table+".tsv")
-         
\ No newline at end of file
+         for table in tables:
+              clean_by_file(table+"."+args.format)
+    if failed:
+         sys.exit(f"Error: {len(failed)} table(s) failed: {', '.join(failed)}")
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Stage dehosted SARS-CoV-2 reads from Terra (GCS) in S3 for SRA submission (Python replacement for terra2aws_sra.sh).
+
+    python terra2aws_sra.py BioSampleObjects.txt merged_df.tsv s3://<bucket>/<path>
+
+The merged table is read once into a WGS_ID -> (R1, R2) index instead of being scanned twice per sample. Reads
+are streamed GCS -> S3 for several samples at once (no local copies), the sequencer is read from the first
+FASTQ header of a small ranged download of R1, and an upload counts as done when S3 accepted it - there is
+no separate listing afterwards. sra_metadata.csv and error.txt are written once every sample has finished,
+in input order.
+"""
+import csv
+import zlib
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import gcs2s3
+import transfer_metrics
+from s3_inventory import split_s3_uri
+from transfer_ledger import TransferLedger, DEFAULT_LEDGER, REVALIDATE_HELP
+
+# 1-based columns of the merged table, as in `cut -f 55,58,118`
+R1_COL = 55
+R2_COL = 58
+ID_COL = 118
+DEFAULT_WORKERS = 8
+HEAD_BYTES = 64 * 1024  # compressed bytes fetched from the start of R1 to read its first header
+
+SEQUENCERS = {"V": "NextSeq 2000", "M": "Illumina MiSeq"}
+METADATA_COLS = ["biosample_accession", "library_ID", "title", "library_strategy", "library_source", "library_selection",
+                 "library_layout", "platform", "instrument_model", "design_description", "file_type", "filename", "filename2"]
+TITLE = "Baseline surveillance (random sampling) of severe acute respiratory syndrome coronavirus 2"
+DESIGN = "Tiled-amplicon whole genome sequencing of severe acute respiratory syndrome coronavirus 2"
+
+
+def read_biosamples(path:str) -> List[Tuple[str, str]]:
+    """(SAMN, WGS_ID) from the first two tab-separated columns, skipping the NCBI header line if present."""
+    rows = []
+    with open(path) as f:
+        for i, line in enumerate(f):
+            fields = line.rstrip("\r\n").split("\t")
+            if not line.strip() or (i == 0 and fields[0].strip().lower() == "accession"):
+                continue
+            rows.append((fields[0].strip(), fields[1].strip() if len(fields) > 1 else ""))
+    return rows
+
+
+def read_index(path:str) -> Dict[str, Tuple[str, str]]:
+    """WGS_ID -> (R1, R2) from the merged table, with commas and spaces removed as `tr -d ', '` did.
+
+    Rows shorter than the ID column are read like `cut -f` read them: the missing fields are empty.
+    """
+    index = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            r1, r2, wgs_id = (fields[col - 1].replace(",", "").replace(" ", "") if len(fields) >= col else ""
+                              for col in (R1_COL, R2_COL, ID_COL))
+            # the first row for an ID wins
+            index.setdefault(wgs_id, (r1, r2))
+    return index
+
+
+def check_sample(samn:str, wgs_id:str, r1:str, r2:str) -> List[str]:
+    """Reasons the sample cannot be staged, in the order terra2aws_sra.sh reported them."""
+    checks = [(samn.startswith("SAMN"), "bad_samn"),
+              ("-PHL-" in wgs_id, "bad_id"),
+              (r1.startswith("gs://"), "bad_read1_path"),
+              (r2.startswith("gs://"), "bad_read2_path"),
+              (r1.endswith("R1_dehosted.fastq.gz"), "bad_read1_file"),
+              (r2.endswith("R2_dehosted.fastq.gz"), "bad_read2_file")]
+    return [reason for ok, reason in checks if not ok]
+
+
+def detect_sequencer(blob) -> str:
+    """Instrument from the first FASTQ header (@V... NextSeq 2000, @M... MiSeq), using only the head of the gzip."""
+    if not blob.size:
+        # an empty R1 has no header, and a ranged download of it is refused with 416
+        return "Unknown"
+    head = blob.download_as_bytes(start=0, end=HEAD_BYTES - 1)
+    # a truncated stream is fine: decompressobj returns whatever the bytes so far decode to
+    try:
+        text = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head)
+    except zlib.error:
+        # not gzip: zcat printed nothing in terra2aws_sra.sh, so the sample was still staged as Unknown
+        return "Unknown"
+    header = text.split(b"\n", 1)[0].split(b":", 1)[0].decode(errors="replace")
+    return SEQUENCERS.get(header[1:2], "Unknown")
+
+
+def stage_sample(samn:str, wgs_id:str, r1:str, r2:str, s3_bucket:str, s3_prefix:str,
+                 gcs_client, s3_client, ledger) -> Tuple[List[str], List[str]]:
+    """Copy both reads to s3://<bucket>/<prefix><WGS_ID>_R{1,2}.fastq.gz. Returns (metadata row or [], error reasons)."""
+    with transfer_metrics.span("sample", sample=wgs_id) as attrs:
+        try:
+            blobs = []
+            for uri in (r1, r2):
+                gs_bucket, gs_blob = gcs2s3.split_uri(uri)
+                blob = gcs_client.bucket(gs_bucket).get_blob(gs_blob)
+                if blob is None:
+                    raise FileNotFoundError(f"{uri} does not exist")
+                blobs.append(blob)
+            sequencer = detect_sequencer(blobs[0])
+            for read, blob in zip(("R1", "R2"), blobs):
+                # returns only once S3 has accepted the PUT / completed the multipart upload
+                gcs2s3.stream_blob_to_s3(blob, s3_bucket, f"{s3_prefix}{wgs_id}_{read}.fastq.gz", s3_client, ledger=ledger)
+        except Exception as e:
+            print(f"{wgs_id}: FAILED ({e})", flush=True)
+            attrs["error"] = str(e)
+            return [], ["no_file_aws"]
+        attrs["sequencer"] = sequencer
+    print(f"{wgs_id}: staged ({sequencer})", flush=True)
+    return [samn, wgs_id, TITLE, "WGS", "VIRAL RNA", "PCR", "paired", "ILLUMINA", sequencer, DESIGN, "fastq", r1, r2], []
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Stage dehosted reads from Terra in S3 and write the SRA metadata sheet.")
+    parser.add_argument("biosamples", help="BioSample objects file (tab-separated; SAMN and WGS ID in the first two columns)")
+    parser.add_argument("merged_df", help=f"Tab-separated merged table (R1 in column {R1_COL}, R2 in column {R2_COL}, WGS ID in column {ID_COL})")
+    parser.add_argument("s3", help="Destination S3 URI for the reads")
+    parser.add_argument("--workers", dest="workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"Number of samples to stage at once (Default: {DEFAULT_WORKERS})")
+    parser.add_argument("--metadata", dest="metadata", default="sra_metadata.csv", help="SRA metadata sheet to write (Default: sra_metadata.csv)")
+    parser.add_argument("--errors", dest="errors", default="error.txt", help="Per-sample errors to write (Default: error.txt)")
+    parser.add_argument("--ledger", dest="ledger", default=DEFAULT_LEDGER,
+                        help=f"Local cache of files already copied to AWS (Default: {DEFAULT_LEDGER})")
+    parser.add_argument("--force", dest="force", action="store_true",
+                        help="Copy every file, even if an identical copy already exists in AWS.")
+    parser.add_argument("--revalidate", dest="revalidate", action="store_true", help=REVALIDATE_HELP)
+    transfer_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    transfer_metrics.configure_from_args("terra2aws_sra", args)
+    s3_bucket, s3_prefix = split_s3_uri(args.s3.rstrip("/"))
+    s3_prefix = s3_prefix + "/" if s3_prefix else ""
+
+    with transfer_metrics.span("read_inputs"):
+        biosamples = read_biosamples(args.biosamples)
+        index = read_index(args.merged_df)
+
+    results = [None] * len(biosamples)
+    gcs_client, s3_client = gcs2s3.make_clients(args.workers * gcs2s3.DEFAULT_PARTS_IN_FLIGHT)
+    ledger = None if args.force else TransferLedger(args.ledger, revalidate=args.revalidate)
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {}
+        for i, (samn, wgs_id) in enumerate(biosamples):
+            r1, r2 = index.get(wgs_id, ("", ""))
+            reasons = check_sample(samn, wgs_id, r1, r2)
+            if reasons:
+                results[i] = ([], reasons)
+            else:
+                futures[pool.submit(stage_sample, samn, wgs_id, r1, r2, s3_bucket, s3_prefix, gcs_client, s3_client, ledger)] = i
+        for future, i in futures.items():
+            results[i] = future.result()
+
+    with open(args.metadata, "w", newline="") as metadata, open(args.errors, "w", newline="") as errors:
+        metadata_csv = csv.writer(metadata, lineterminator="\n")
+        errors_csv = csv.writer(errors, lineterminator="\n")
+        metadata_csv.writerow(METADATA_COLS)
+        errors_csv.writerow(["WGS_ID", "REASON"])
+        for (samn, wgs_id), (row, reasons) in zip(biosamples, results):
+            if row:
+                metadata_csv.writerow(row)
+            errors_csv.writerows([wgs_id, reason] for reason in reasons)
+
+    n_staged = sum(1 for row, _ in results if row)
+    print(f"{n_staged} of {len(biosamples)} sample(s) staged; metadata in {args.metadata}, errors in {args.errors}")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Skip-if-present ledger shared by the Terra to AWS transfer tools.
+
+An object is considered already transferred when the S3 copy has the same size and either
+  - carries the source checksum in its metadata (x-amz-meta-crc32c / x-amz-meta-md5), or
+  - has a single-part ETag equal to the source MD5.
+Every confirmed match is cached in a local SQLite file so re-runs do not need to ask S3 again. A cached match
+is trusted as it is: if the S3 copy is deleted or replaced afterwards, the file keeps being skipped. Tools
+expose --revalidate (revalidate=True) to confirm every match against S3 with a HEAD request instead.
+"""
+import base64
+import hashlib
+import os
+import sqlite3
+import threading
+
+from botocore.exceptions import ClientError
+
+DEFAULT_LEDGER = os.path.join(os.path.expanduser("~"), ".terra2aws_ledger.sqlite")
+REVALIDATE_HELP = ("Confirm every file the ledger says is already in AWS with a HEAD request before skipping it. "
+                   "Without it, a file whose S3 copy was deleted or replaced after it was recorded keeps being skipped.")
+
+
+def md5_to_hex(md5_b64):
+    """Convert a base64 MD5 (as stored by GCS) to the hex digest S3 uses in single-part ETags."""
+    return base64.b64decode(md5_b64).hex() if md5_b64 else None
+
+
+def file_md5(path, chunk_size=8 * 1024 * 1024):
+    """Base64 MD5 of a local file, in the same format GCS reports."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode()
+
+
+def checksum_metadata(crc32c=None, md5=None):
+    """S3 user metadata that lets later runs recognise an identical copy, even for multipart uploads."""
+    return {k: v for k, v in [("crc32c", crc32c), ("md5", md5)] if v}
+
+
+class TransferLedger:
+    """Local cache of source -> destination copies that are known to be identical."""
+
+    def __init__(self, path=DEFAULT_LEDGER, revalidate=False):
+        self.path = path
+        self.revalidate = revalidate
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS ledger (
+                                  source TEXT NOT NULL,
+                                  dest TEXT NOT NULL,
+                                  size INTEGER,
+                                  crc32c TEXT,
+                                  md5 TEXT,
+                                  PRIMARY KEY (source, dest))""")
+        self._conn.commit()
+
+    def _cached(self, source, dest, size, crc32c, md5):
+        with self._lock:
+            row = self._conn.execute("SELECT size, crc32c, md5 FROM ledger WHERE source = ? AND dest = ?",
+                                     (source, dest)).fetchone()
+        if row is None or row[0] != size:
+            return False
+        return bool((crc32c and row[1] == crc32c) or (md5 and row[2] == md5))
+
+    def forget(self, source, dest):
+        """Drop the cached copy of source at dest, e.g. once S3 no longer confirms it."""
+        with self._lock:
+            self._conn.execute("DELETE FROM ledger WHERE source = ? AND dest = ?", (source, dest))
+            self._conn.commit()
+
+    def record(self, source, dest, size, crc32c=None, md5=None):
+        """Remember that dest holds an identical copy of source."""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?, ?)",
+                               (source, dest, size, crc32c, md5))
+            self._conn.commit()
+
+    @staticmethod
+    def _s3_matches(s3_client, s3_bucket, s3_key, size, crc32c, md5):
+        try:
+            head = s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        if head["ContentLength"] != size:
+            return False
+        stored = head.get("Metadata", {})
+        etag = head["ETag"].strip('"')
+        return bool((crc32c and stored.get("crc32c") == crc32c)
+                    or (md5 and stored.get("md5") == md5)
+                    or (md5 and "-" not in etag and etag == md5_to_hex(md5)))
+
+    def is_current(self, source, s3_bucket, s3_key, s3_client, size, crc32c=None, md5=None):
+        """Return True if s3://s3_bucket/s3_key already holds an identical copy of source.
+
+        The local cache is checked first; S3 is only asked (one HEAD request) on a cache miss, or for every
+        file when the ledger was opened with revalidate=True. A cached entry S3 no longer confirms is dropped.
+        """
+        dest = f"s3://{s3_bucket}/{s3_key}"
+        cached = self._cached(source, dest, size, crc32c, md5)
+        if cached and not self.revalidate:
+            return True
+
+        match = self._s3_matches(s3_client, s3_bucket, s3_key, size, crc32c, md5)
+        if match:
+            self.record(source, dest, size, crc32c, md5)
+        elif cached:
+            self.forget(source, dest)
+        return match
+
+    def blob_is_current(self, blob, s3_bucket, s3_key, s3_client):
+        """is_current() for a GCS blob, using its stored size, CRC32C and MD5."""
+        return self.is_current(f"gs://{blob.bucket.name}/{blob.name}", s3_bucket, s3_key, s3_client,
+                               blob.size, blob.crc32c, blob.md5_hash)
+
+    def record_blob(self, blob, s3_bucket, s3_key):
+        self.record(f"gs://{blob.bucket.name}/{blob.name}", f"s3://{s3_bucket}/{s3_key}",
+                    blob.size, blob.crc32c, blob.md5_hash)
+
+    def close(self):
+        self._conn.close()
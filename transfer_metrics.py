@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""Timed spans, counters and latency histograms shared by the Terra/S3 transfer tools.
+
+Nothing is recorded until configure() is called (the tools do it from --trace/--prom/--profile), so the
+module-level helpers cost next to nothing otherwise:
+
+    with transfer_metrics.span("download_table", table=table):   # one JSON line per span in the trace
+        ...
+    transfer_metrics.count("bytes_transferred", n_bytes, direction="gcs_to_s3")
+    transfer_metrics.observe("object_bytes", n_bytes)
+
+--trace writes every span as a JSON line (name, start, seconds, thread, ok and its attributes) as it ends.
+--prom writes a Prometheus textfile-collector summary on exit: counters plus a latency histogram per span
+name. Span attributes only go to the trace, so per-object values (URIs, keys) never become metric labels.
+--profile cprofile|sampling wraps the CPU-bound sections marked with profile() and writes a .prof file
+(cProfile) or a .folded file of collapsed stacks (flamegraph.pl / speedscope) per section.
+"""
+import atexit
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+DEFAULT_PREFIX = "terra2aws"
+DEFAULT_SAMPLE_INTERVAL = 0.005
+# seconds; spans range from sub-second metadata calls to multi-minute table pulls
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+SIZE_BUCKETS = tuple(2 ** n for n in range(10, 41, 3))  # 1 KiB .. 1 TiB
+
+_metrics = None
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value):
+    """Label value escaped as the text exposition format requires (backslash, double quote and newline)."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Metrics:
+    """Thread-safe store of counters and histograms with an optional JSON-lines trace."""
+
+    def __init__(self, tool, trace=None, prom=None, prefix=DEFAULT_PREFIX, profile=None, profile_dir="."):
+        self.tool = tool
+        self.prom = prom
+        self.prefix = prefix
+        self.profile_mode = profile
+        self.profile_dir = profile_dir
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._trace = open(trace, "a") if trace else None
+        self._counters = defaultdict(float)
+        self._histograms = {}
+
+    def _labels(self, labels):
+        return tuple(sorted({"tool": self.tool, **{k: str(v) for k, v in labels.items()}}.items()))
+
+    def count(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, self._labels(labels))] += value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    def record(self, event):
+        if self._trace is None:
+            return
+        line = json.dumps({"tool": self.tool, **event}, default=str)
+        with self._lock:
+            self._trace.write(line + "\n")
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        start = time.time()
+        ok = True
+        try:
+            yield attrs  # callers may add attributes (e.g. bytes) once they know them
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            seconds = time.time() - start
+            self.observe("span_seconds", seconds, span=name)
+            if not ok:
+                self.count("span_errors", span=name)
+            self.record({"type": "span", "name": name, "start": start, "seconds": round(seconds, 6),
+                         "thread": threading.current_thread().name, "ok": ok, **attrs})
+
+    def write_prometheus(self):
+        """Write every counter and histogram in the text exposition format, replacing the file atomically."""
+        def fmt(labels):
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+        for i, ((name, labels), value) in enumerate(counters):
+            metric = f"{self.prefix}_{name}_total"
+            if i == 0 or counters[i - 1][0][0] != name:
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{fmt(labels)} {_number(value)}")
+        for i, ((name, labels), hist) in enumerate(histograms):
+            metric = f"{self.prefix}_{name}"
+            if i == 0 or histograms[i - 1][0][0] != name:
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, n in zip(hist.buckets, hist.counts):
+                cumulative += n
+                lines.append(f"{metric}_bucket{fmt(labels + (('le', f'{bound:g}'),))} {cumulative}")
+            lines.append(f"{metric}_bucket{fmt(labels + (('le', '+Inf'),))} {hist.count}")
+            lines.append(f"{metric}_sum{fmt(labels)} {_number(hist.sum)}")
+            lines.append(f"{metric}_count{fmt(labels)} {hist.count}")
+        labels = self._labels({})
+        lines.append(f"# TYPE {self.prefix}_run_seconds gauge")
+        lines.append(f"{self.prefix}_run_seconds{fmt(labels)} {_number(round(time.time() - self.started, 3))}")
+        lines.append(f"# TYPE {self.prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{self.prefix}_last_run_timestamp_seconds{fmt(labels)} {time.time():.0f}")
+
+        # the node_exporter textfile collector may read at any moment; never let it see a partial file
+        tmp = f"{self.prom}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.prom)
+
+    def close(self):
+        if self.prom:
+            self.write_prometheus()
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of every other thread at a fixed interval and counts them as collapsed stacks."""
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self._done.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join([names.get(thread_id, str(thread_id))] + stack[::-1])] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f"{stack} {n}\n")
+
+
+#----- MODULE-LEVEL API -----#
+def configure(tool, trace=None, prom=None, profile=None, profile_dir=".", prefix=DEFAULT_PREFIX):
+    """Start recording for this process. Output files are written when the process exits."""
+    global _metrics
+    if not (trace or prom or profile):
+        return None
+    if _metrics is not None:
+        _metrics.close()
+    _metrics = Metrics(tool, trace, prom, prefix, profile, profile_dir)
+    atexit.register(_metrics.close)
+    return _metrics
+
+
+def add_arguments(parser):
+    """Add --trace, --prom, --profile and --profile_dir to an ArgumentParser."""
+    parser.add_argument("--trace", dest="trace",
+                        help="Append a JSON-lines trace of every timed stage and object to this file.")
+    parser.add_argument("--prom", dest="prom",
+                        help="Write a Prometheus textfile-collector summary (counters and latency histograms) to this file on exit.")
+    parser.add_argument("--profile", dest="profile", choices=["cprofile", "sampling"],
+                        help="Profile the CPU-bound sections with cProfile (.prof) or a stack sampler (.folded).")
+    parser.add_argument("--profile_dir", dest="profile_dir", default=".",
+                        help="Directory for the profiler output (Default: current directory)")
+
+
+def configure_from_args(tool, args):
+    return configure(tool, args.trace, args.prom, args.profile, args.profile_dir)
+
+
+def count(name, value=1, **labels):
+    if _metrics is not None:
+        _metrics.count(name, value, **labels)
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    if _metrics is not None:
+        _metrics.observe(name, value, buckets, **labels)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Time a stage or object. Yields a dict; keys added to it are written to the trace with the span."""
+    if _metrics is None:
+        yield attrs
+        return
+    with _metrics.span(name, **attrs) as attrs:
+        yield attrs
+
+
+@contextlib.contextmanager
+def profile(name, **attrs):
+    """Profile a CPU-bound section when --profile is set; also times it as a span.
+
+    Output goes to <profile_dir>/<tool>.<name>[.<attribute values>].prof|.folded.
+    """
+    if _metrics is None or _metrics.profile_mode is None:
+        with span(name, **attrs) as attrs:
+            yield attrs
+        return
+    os.makedirs(_metrics.profile_dir, exist_ok=True)
+    path = os.path.join(_metrics.profile_dir, ".".join([_metrics.tool, name] + [str(v) for v in attrs.values()]))
+    if _metrics.profile_mode == "cprofile":
+        profiler = cProfile.Profile()
+        with span(name, profile=f"{path}.prof", **attrs) as attrs:
+            profiler.enable()
+            try:
+                yield attrs
+            finally:
+                profiler.disable()
+                profiler.dump_stats(f"{path}.prof")
+    else:
+        sampler = StackSampler()
+        with span(name, profile=f"{path}.folded", **attrs) as attrs:
+            sampler.start()
+            try:
+                yield attrs
+            finally:
+                sampler.stop()
+                sampler.write(f"{path}.folded")
+
+
+def instrument_s3_client(s3_client):
+    """Record the latency, request count and botocore retries of every S3 operation made with this client.
+
+    Latency is per API call including retries, labelled by operation (ListObjectsV2, GetObject, UploadPart, ...).
+    """
+    def before_call(context, **kwargs):
+        context["metrics_start"] = time.time()
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        if _metrics is None:
+            return
+        if "metrics_start" in context:
+            observe("s3_request_seconds", time.time() - context["metrics_start"], operation=model.name)
+        count("s3_requests", operation=model.name)
+        retries = (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries:
+            count("s3_retries", retries, operation=model.name)
+
+    s3_client.meta.events.register("before-call.s3", before_call)
+    s3_client.meta.events.register("after-call.s3", after_call)
+    return s3_client
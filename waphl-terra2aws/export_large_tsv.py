@@ -1,38 +1,95 @@
 # -*- coding: utf-8 -*-
-"""Download a remote tsv from a Terra workspace data model when it is too large to export from Terra UI."""
+"""Download a remote tsv (or typed Parquet file) from a Terra workspace data model when it is too large to export from Terra UI."""
 from firecloud import api as fapi
 from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import math
+import sys
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import requests
 
 DEFAULT_PAGE_SIZE = 1000
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_RETRIES = 5
+DEFAULT_COMPRESSION = "zstd"
+# status codes worth retrying - anything else is treated as a permanent failure
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
 
 
-def get_entity_by_page(project, workspace, entity_type, page, page_size=DEFAULT_PAGE_SIZE, sort_direction='asc', filter_terms=None):
-    """Get entities from workspace by page given a page_size(number of entities/rows in entity table)."""
-    # API = https://api.firecloud.org/#!/Entities/entityQuery
-    response = fapi.get_entities_query(project, workspace, entity_type, page=page,
-                                       page_size=page_size, sort_direction=sort_direction,
-                                       filter_terms=filter_terms)
-
-    if response.status_code != 200:
-        print(response.text)
-        exit(1)
+def get_entity_by_page(project, workspace, entity_type, page, page_size=DEFAULT_PAGE_SIZE, sort_direction='asc', filter_terms=None, retries=DEFAULT_RETRIES):
+    """Get entities from workspace by page given a page_size(number of entities/rows in entity table).
 
-    return(response.json())
-
-
-def download_tsv_from_workspace(project, workspace, entity_type, tsv_name, page_size=DEFAULT_PAGE_SIZE, attr_list=None):
-    """Download large TSV file from Terra workspace by designated number of rows."""
+    Transient errors are retried with exponential backoff; a RuntimeError is raised once retries run out.
+    """
+    # API = https://api.firecloud.org/#!/Entities/entityQuery
+    for attempt in range(retries + 1):
+        try:
+            response = fapi.get_entities_query(project, workspace, entity_type, page=page,
+                                               page_size=page_size, sort_direction=sort_direction,
+                                               filter_terms=filter_terms)
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+        else:
+            if response.status_code == 200:
+                return(response.json())
+            error = f"{response.status_code} {response.text}"
+            if response.status_code not in RETRY_STATUS_CODES:
+                break
+        if attempt < retries:
+            wait = 2 ** attempt
+            print(f"Page {page} failed ({error.strip()}). Retrying in {wait}s.")
+            time.sleep(wait)
+
+    raise RuntimeError(f"Could not get page {page} of {entity_type}: {error}")
+
+
+def iter_entity_pages(project, workspace, entity_type, num_pages, page_size=DEFAULT_PAGE_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """Yield page responses in page order while up to max_in_flight pages are fetched concurrently.
+
+    Only the pages inside the window are held in memory, so memory use does not grow with the table size.
+    """
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        pending = deque()
+        next_page = 1
+        while next_page <= num_pages and len(pending) < max_in_flight:
+            pending.append(pool.submit(get_entity_by_page, project, workspace, entity_type, next_page, page_size))
+            next_page += 1
+        while pending:
+            page_response = pending.popleft().result()
+            # keep the window full before handing the page back to the caller
+            if next_page <= num_pages:
+                pending.append(pool.submit(get_entity_by_page, project, workspace, entity_type, next_page, page_size))
+                next_page += 1
+            yield page_response
+
+
+def entity_to_row(entity_json, entity_id, attribute_names):
+    """Convert one entity from a page response into a list of string values ordered by attribute_names."""
+    attributes = entity_json["attributes"]
+    # add name and value to dictionary of attributes
+    attributes[entity_id] = entity_json["name"]
+    # if entity's attribute(column) is in list of attributes from response, set response's attribute value
+    return [str(attributes.get(attribute_name, "")) for attribute_name in attribute_names]
+
+
+def get_table_columns(project, workspace, entity_type, attr_list=None):
+    """Return (entity_count, entity_id, attribute_names) for a table, with the entity id as the first column."""
     # get all entity types in workspace using API call
     # API = https://api.firecloud.org/#!/Entities/getEntityTypes
     response = fapi.list_entity_types(project, workspace)
     if response.status_code != 200:
-        print(response.text)
-        exit(1)
+        raise RuntimeError(f"Could not list entity types in {project}/{workspace}: {response.text}")
 
     # get/report # of entities + associated attributes(column names) of input entity type
     entity_types_json = response.json()
+    if entity_type not in entity_types_json:
+        raise RuntimeError(f"{entity_type} is not a table in {project}/{workspace}")
     entity_count = entity_types_json[entity_type]["count"]
     entity_id = entity_types_json[entity_type]["idName"]
     # if user provided list of specific attributes to return, else return all attributes
@@ -44,48 +101,128 @@ def download_tsv_from_workspace(project, workspace, entity_type, tsv_name, page_
 
     # add the entity_id value to list of attributes (not a default attribute of API response)
     attribute_names.insert(0, entity_id)
+    return entity_count, entity_id, attribute_names
 
-    print(f'{entity_count} {entity_type}(s) to export.')
 
+def iter_entity_rows(project, workspace, entity_type, entity_count, entity_id, attribute_names, page_size=DEFAULT_PAGE_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """Yield every row of a table as a list of strings, in page order."""
+    print(f'{entity_count} {entity_type}(s) to export.')
+    num_pages = int(math.ceil(float(entity_count) / page_size))
+
+    # get entities by page where each page has page_size # of rows using API call
+    # and hand each page on as soon as it arrives (in page order)
+    print(f'Getting all {num_pages} pages of entity data ({max_in_flight} at a time).')
+    for page_response in tqdm(iter_entity_pages(project, workspace, entity_type, num_pages, page_size, max_in_flight), total=num_pages, desc=entity_type):
+        for entity_json in page_response["results"]:
+            yield entity_to_row(entity_json, entity_id, attribute_names)
+
+
+def write_tsv_from_workspace(project, workspace, entity_type, tsvout, page_size=DEFAULT_PAGE_SIZE, attr_list=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """Write a Terra workspace table to an open text stream (a file, or e.g. an S3 upload) page by page. Returns the number of rows."""
+    entity_count, entity_id, attribute_names = get_table_columns(project, workspace, entity_type, attr_list)
+    # add header with attribute values to tsv
+    tsvout.write("\t".join(attribute_names) + "\n")
+    row_num = 0
+    for row in iter_entity_rows(project, workspace, entity_type, entity_count, entity_id, attribute_names, page_size, max_in_flight):
+        tsvout.write("\t".join(row) + "\n")
+        row_num += 1
+    return row_num
+
+
+def infer_column(column):
+    """Cast a string column to int64, float64 or bool when every non-empty value allows it. Empty strings become null."""
+    column = pc.if_else(pc.equal(column, ""), pa.scalar(None, pa.string()), column)
+    values = column.drop_null()
+    if len(values) == 0:
+        return column
+    # leading zeros mean an identifier (e.g. an accession or zip code), not a number
+    if not pc.any(pc.match_substring_regex(values, r"^[+-]?0\d")).as_py():
+        for numeric_type in (pa.int64(), pa.float64()):
+            try:
+                return pc.cast(column, numeric_type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                pass
+    if pc.all(pc.is_in(pc.utf8_lower(values), value_set=pa.array(["true", "false"]))).as_py():
+        return pc.equal(pc.utf8_lower(column), "true")
+    return column
+
+
+def rows_to_table(rows, attribute_names):
+    """Untyped (all string) Arrow table from a list of rows."""
+    columns = list(zip(*rows)) if rows else [[] for _ in attribute_names]
+    return pa.Table.from_arrays([pa.array(column, pa.string()) for column in columns], names=attribute_names)
+
+
+def write_parquet_from_workspace(project, workspace, entity_type, out, page_size=DEFAULT_PAGE_SIZE, attr_list=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, compression=DEFAULT_COMPRESSION):
+    """Write a Terra workspace table to a path or binary stream as typed Parquet. Returns the number of rows.
+
+    Rows are collected into compact Arrow string columns as the pages arrive; column types are inferred once
+    the whole table is in, since a column is only numeric if every row is. String columns are dictionary
+    encoded in the file.
+    """
+    entity_count, entity_id, attribute_names = get_table_columns(project, workspace, entity_type, attr_list)
+    batches = []
+    rows = []
+    for row in iter_entity_rows(project, workspace, entity_type, entity_count, entity_id, attribute_names, page_size, max_in_flight):
+        rows.append(row)
+        if len(rows) == page_size:
+            batches.append(rows_to_table(rows, attribute_names))
+            rows = []
+    batches.append(rows_to_table(rows, attribute_names))
+    table = pa.concat_tables(batches).combine_chunks()
+
+    # the entity id always stays a string
+    columns = [table.column(0)] + [infer_column(table.column(i)) for i in range(1, table.num_columns)]
+    table = pa.Table.from_arrays(columns, names=attribute_names)
+    pq.write_table(table, out, compression=compression, use_dictionary=True)
+    return table.num_rows
+
+
+def download_tsv_from_workspace(project, workspace, entity_type, tsv_name, page_size=DEFAULT_PAGE_SIZE, attr_list=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """Download large TSV file from Terra workspace by designated number of rows."""
     with open(tsv_name, "w") as tsvout:
-        # add header with attribute values to tsv
-        tsvout.write("\t".join(attribute_names) + "\n")
-        # set starting row value and calculate number of pages
-        row_num = 0
-        num_pages = int(math.ceil(float(entity_count) / page_size))
-
-        # get entities by page where each page has page_size # of rows using API call
-        print(f'Getting all {num_pages} pages of entity data.')
-        all_page_responses = []
-        for page in tqdm(range(1, num_pages + 1)):
-            all_page_responses.append(get_entity_by_page(project, workspace, entity_type, page, page_size))
-
-        # for each response(page) in all_page_responses[] - contains parameter metadata
-        print(f'Writing {entity_count} attributes to tsv file.')
-        for page_response in tqdm(all_page_responses):
-            # for each set of attributes in results (no parameters) get attribute names and entity_id(name)
-            for entity_json in page_response["results"]:
-                attributes = entity_json["attributes"]
-                name = entity_json["name"]
-                # add name and value to dictionary of attributes
-                attributes[entity_id] = name
-
-                values = []
-                # for each attribute(column name) in list of attribute names(all columns for entity)
-                for attribute_name in attribute_names:
-                    value = ""
-                    # if entity's attribute(column) is in list of attributes from response, set response's attribute value
-                    if attribute_name in attributes:
-                        value = attributes[attribute_name]
-
-                    values.append(str(value))
-
-                tsvout.write("\t".join(values) + "\n")
-                row_num += 1
+        write_tsv_from_workspace(project, workspace, entity_type, tsvout, page_size, attr_list, max_in_flight)
 
     print(f'Finished exporting {entity_type}(s) to tsv with name {tsv_name}.')
 
 
+def download_parquet_from_workspace(project, workspace, entity_type, parquet_name, page_size=DEFAULT_PAGE_SIZE, attr_list=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, compression=DEFAULT_COMPRESSION):
+    """Download a Terra workspace table to a typed, compressed Parquet file."""
+    write_parquet_from_workspace(project, workspace, entity_type, parquet_name, page_size, attr_list, max_in_flight, compression)
+
+    print(f'Finished exporting {entity_type}(s) to parquet with name {parquet_name}.')
+
+
+def table_format(file_name):
+    return "parquet" if str(file_name).endswith(".parquet") else "tsv"
+
+
+def download_table_from_workspace(project, workspace, entity_type, file_name, page_size=DEFAULT_PAGE_SIZE, attr_list=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, fmt=None):
+    """Download a table as TSV or Parquet. The format defaults to Parquet when file_name ends in .parquet."""
+    fmt = fmt or table_format(file_name)
+    if fmt == "parquet":
+        download_parquet_from_workspace(project, workspace, entity_type, file_name, page_size, attr_list, max_in_flight)
+    else:
+        download_tsv_from_workspace(project, workspace, entity_type, file_name, page_size, attr_list, max_in_flight)
+
+
+def read_terra_table(file_name, columns=None):
+    """Load an exported table (TSV or Parquet) into a DataFrame, reading only `columns` if given.
+
+    The entity id column is always returned first, whatever its name.
+    """
+    if table_format(file_name) == "parquet":
+        names = pq.read_schema(file_name).names
+        if columns is not None:
+            columns = [names[0]] + [c for c in columns if c in names and c != names[0]]
+        return pq.read_table(file_name, columns=columns).to_pandas()
+    if columns is not None:
+        names = list(pd.read_csv(file_name, sep="\t", nrows=0).columns)
+        columns = [names[0]] + [c for c in columns if c in names and c != names[0]]
+    df = pd.read_csv(file_name, sep="\t", usecols=columns)
+    return df[columns] if columns is not None else df
+
+
 if __name__ == "__main__":
     # argument parser
     parser = argparse.ArgumentParser(description="Exports/downloadload a TSV file from Terra when it is too large to download via the UI.")
@@ -93,9 +230,14 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--project', type=str, required=True, help='Terra namespace/project of workspace.')
     parser.add_argument('-w', '--workspace', type=str, required=True, help='Name of Terra workspace.')
     parser.add_argument('-e', '--entity_type', type=str, required=True, help='Entity type being requested for tsv export to local destination.')
-    parser.add_argument('-f', '--tsv_filename', type=str, required=True, help='Name of tsv file to be exported from Terra to local destination.')
+    parser.add_argument('-f', '--tsv_filename', type=str, required=True, help='Name of tsv (or .parquet) file to be exported from Terra to local destination.')
     parser.add_argument('-n', '--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='Number of entities/rows to export per page.')
     parser.add_argument('-a', '--attribute_list', nargs='+', help='column names to return - separated by spaces. ex. -a col1 col2')
+    parser.add_argument('--max_in_flight', type=int, default=DEFAULT_MAX_IN_FLIGHT, help='Number of pages to fetch concurrently. Use 1 to fetch pages one at a time.')
+    parser.add_argument('--format', choices=['tsv', 'parquet'], help='Output format. Defaults to parquet (typed, zstd-compressed) if the file name ends in .parquet, otherwise tsv.')
 
     args = parser.parse_args()
-    download_tsv_from_workspace(args.project, args.workspace, args.entity_type, args.tsv_filename, args.page_size, args.attribute_list)
+    try:
+        download_table_from_workspace(args.project, args.workspace, args.entity_type, args.tsv_filename, args.page_size, args.attribute_list, args.max_in_flight, args.format)
+    except RuntimeError as e:
+        sys.exit(str(e))
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Append-only Parquet index of the files migrated from Terra to AWS.
+
+Records are buffered in memory and written in batches to
+s3://<bucket>/meta_index/WORKSPACE=<ws>/WORKFLOW=<wf>/DATE=<yyyy-mm-dd>/part-<uuid>.parquet
+so the whole index can be read back with a single dataset scan instead of one GET per file.
+
+A file is indexed once per (ID, CURRENT_PATH): re-runs that skip files already in S3 still report them, so each
+partition keeps the keys of its rows in <partition>/_keys.parquet (rewritten with every part). It is read once per
+partition and run, instead of every part file, to avoid writing the same rows again. Dataset scans skip it, as they
+skip every file starting with "_".
+"""
+import argparse
+import io
+import threading
+import uuid
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+from pyarrow import fs
+
+META_COLS = ["ID", "ALT_ID", "FILE", "ORIGIN_PATH", "CURRENT_PATH", "TIMESTAMP", "PLATFORM", "WORKSPACE", "WORKFLOW"]
+PARTITION_COLS = ["WORKSPACE", "WORKFLOW", "DATE"]
+DEFAULT_PREFIX = "meta_index"
+DEFAULT_FLUSH_ROWS = 5000
+KEYS_FILE = "_keys.parquet"
+
+SCHEMA = pa.schema([("ID", pa.string()),
+                    ("ALT_ID", pa.string()),
+                    ("FILE", pa.string()),
+                    ("ORIGIN_PATH", pa.string()),
+                    ("CURRENT_PATH", pa.string()),
+                    ("TIMESTAMP", pa.float64()),
+                    ("PLATFORM", pa.string())])
+
+
+class MetaIndexWriter:
+    """Thread-safe buffer of metadata rows that flushes to partitioned Parquet in S3."""
+
+    def __init__(self, s3_client, bucket, prefix=DEFAULT_PREFIX, flush_rows=DEFAULT_FLUSH_ROWS):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.flush_rows = flush_rows
+        self._rows = []
+        self._lock = threading.Lock()
+        # partition prefix -> (ID, CURRENT_PATH) already written there; _write_lock serialises the check and the write
+        self._indexed = {}
+        self._write_lock = threading.Lock()
+
+    def add(self, row):
+        """Add one row ordered like META_COLS. Flushes once flush_rows rows are buffered."""
+        with self._lock:
+            self._rows.append(row)
+            if len(self._rows) < self.flush_rows:
+                return
+            rows, self._rows = self._rows, []
+        self._write(rows)
+
+    def flush(self):
+        """Write every buffered row to S3."""
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if rows:
+            self._write(rows)
+
+    def _read_keys(self, key):
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        table = pq.read_table(io.BytesIO(body), columns=["ID", "CURRENT_PATH"])
+        return set(zip(table.column("ID").to_pylist(), table.column("CURRENT_PATH").to_pylist()))
+
+    def _partition_index(self, partition):
+        """(ID, CURRENT_PATH) of every row already written under a partition prefix."""
+        if partition not in self._indexed:
+            try:
+                indexed = self._read_keys(f"{partition}/{KEYS_FILE}")
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                    raise
+                # no key manifest yet (new partition, or one written before it existed): read the parts once
+                indexed = set()
+                for page in self.s3_client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=partition + "/"):
+                    for obj in page.get("Contents", []):
+                        indexed |= self._read_keys(obj["Key"])
+            self._indexed[partition] = indexed
+        return self._indexed[partition]
+
+    def _save_partition_index(self, partition, indexed):
+        ids, paths = zip(*indexed) if indexed else ((), ())
+        table = pa.table({"ID": pa.array(ids, pa.string()), "CURRENT_PATH": pa.array(paths, pa.string())})
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression="zstd")
+        self.s3_client.put_object(Bucket=self.bucket, Key=f"{partition}/{KEYS_FILE}", Body=buffer.getvalue())
+
+    def _write(self, rows):
+        df = pd.DataFrame(rows, columns=META_COLS)
+        df = df.astype({col: str for col in META_COLS if col != "TIMESTAMP"}).drop_duplicates(["ID", "CURRENT_PATH"])
+        df["DATE"] = pd.to_datetime(df["TIMESTAMP"], unit="s").dt.strftime("%Y-%m-%d")
+        n_written = 0
+        with self._write_lock:
+            for (workspace, workflow, date), part in df.groupby(PARTITION_COLS):
+                partition = (f"{self.prefix}/WORKSPACE={quote(str(workspace), safe='')}"
+                             f"/WORKFLOW={quote(str(workflow), safe='')}/DATE={date}")
+                indexed = self._partition_index(partition)
+                part = part[[key not in indexed for key in zip(part["ID"], part["CURRENT_PATH"])]]
+                if part.empty:
+                    continue
+                table = pa.Table.from_pandas(part.drop(columns=PARTITION_COLS), schema=SCHEMA, preserve_index=False)
+                buffer = io.BytesIO()
+                pq.write_table(table, buffer, compression="zstd")
+                self.s3_client.put_object(Bucket=self.bucket, Key=f"{partition}/part-{uuid.uuid4().hex}.parquet", Body=buffer.getvalue())
+                indexed.update(zip(part["ID"], part["CURRENT_PATH"]))
+                # after the part: a failure in between can only index these rows twice, never skip them
+                self._save_partition_index(partition, indexed)
+                n_written += len(part)
+        print(f"Wrote {n_written} metadata record(s) to s3://{self.bucket}/{self.prefix}/ ({len(rows) - n_written} already indexed)", flush=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def load_meta_index(bucket, prefix=DEFAULT_PREFIX, columns=None, filter=None):
+    """Load the metadata index (or a subset of its columns/partitions) into a DataFrame with a single read.
+
+    e.g. load_meta_index("my-bucket", filter=ds.field("WORKFLOW") == "phoenix")
+    """
+    dataset = ds.dataset(f"{bucket}/{prefix.strip('/')}", filesystem=fs.S3FileSystem(),
+                         format="parquet", partitioning="hive")
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the Terra to AWS metadata index to a CSV file.")
+    parser.add_argument('-b', '--bucket', type=str, required=True, help='S3 bucket name containing the index.')
+    parser.add_argument('--prefix', type=str, default=DEFAULT_PREFIX, help=f'Prefix of the index in the bucket (Default: {DEFAULT_PREFIX}).')
+    parser.add_argument('--workspace', type=str, help='Only return records from this workspace.')
+    parser.add_argument('--workflow', type=str, help='Only return records from this workflow.')
+    parser.add_argument('-o', '--output', type=str, default='meta_index.csv', help='Output CSV file (Default: meta_index.csv).')
+    args = parser.parse_args()
+
+    expr = None
+    for col, value in [("WORKSPACE", args.workspace), ("WORKFLOW", args.workflow)]:
+        if value is not None:
+            expr = ds.field(col) == value if expr is None else expr & (ds.field(col) == value)
+    df = load_meta_index(args.bucket, args.prefix, filter=expr)
+    df.to_csv(args.output, index=False)
+    print(f"{len(df)} record(s) saved to {args.output}")
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Row-level change detection for Terra tables.
+
+Each entity row is hashed together with the GCS generation of every gs:// file it points to. The hashes
+of the last migrated version of each table are kept in
+s3://<bucket>/terra_tbls/_snapshots/<table>.parquet, so a run only migrates the rows that were added or
+changed since (including files overwritten in place, which get a new generation).
+"""
+import io
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DEFAULT_PREFIX = "terra_tbls/_snapshots"
+DEFAULT_WORKERS = 8
+# gs:// paths are grouped by their first SHARD_DEPTH directories (e.g. submissions/<submission id>/) for listing
+SHARD_DEPTH = 2
+
+SCHEMA = pa.schema([("ID", pa.string()), ("HASH", pa.uint64())])
+
+
+def _list_generations(gcs_client, bucket, prefix, names):
+    generations = {}
+    for blob in gcs_client.list_blobs(bucket, prefix=prefix, fields="items(name,generation),nextPageToken"):
+        if blob.name in names:
+            generations[f"gs://{bucket}/{blob.name}"] = blob.generation
+    return generations
+
+
+def fetch_generations(gcs_client, uris, workers=DEFAULT_WORKERS):
+    """GCS generation of each gs:// URI. Returns (generations, URIs that could not be listed).
+
+    Generations come from bucket listings (up to 1000 objects per request, name and generation only) of the
+    directories the URIs live in, rather than one metadata request per object. Every directory is listed on
+    every run, since that is the only way to see a file overwritten in place. Objects that do not exist are left
+    out; so are the URIs of a directory whose listing failed, which are returned so their rows can be treated
+    as changed instead of failing the whole table.
+    """
+    shards = defaultdict(set)
+    for uri in set(uris):
+        bucket, _, name = uri[len("gs://"):].partition("/")
+        parts = name.split("/")
+        shards[(bucket, "/".join(parts[:SHARD_DEPTH]) + "/" if len(parts) > SHARD_DEPTH else name)].add(name)
+
+    def list_shard(shard):
+        (bucket, prefix), names = shard
+        try:
+            return _list_generations(gcs_client, bucket, prefix, names), set()
+        except Exception as e:
+            print(f"Could not list gs://{bucket}/{prefix}: {e}", flush=True)
+            return {}, {f"gs://{bucket}/{name}" for name in names}
+
+    generations = {}
+    failed = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result, shard_failed in pool.map(list_shard, shards.items()):
+            generations.update(result)
+            failed |= shard_failed
+    return generations, failed
+
+
+def row_hashes(df, gs_cols, generations):
+    """64-bit hash of every row's values plus the generation of each file in gs_cols."""
+    values = df.astype(str)
+    for col in gs_cols:
+        values[f"{col}:generation"] = df[col].map(generations).astype(str)
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+
+def snapshot_key(table, prefix=DEFAULT_PREFIX):
+    return f"{prefix.strip('/')}/{table}.parquet"
+
+
+def load_snapshot(s3_client, bucket, table, prefix=DEFAULT_PREFIX):
+    """Row hashes from the last migration of table as a Series indexed by entity ID (empty if there is none)."""
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=snapshot_key(table, prefix))["Body"].read()
+    except s3_client.exceptions.NoSuchKey:
+        return pd.Series(dtype="uint64")
+    snapshot = pq.read_table(io.BytesIO(body)).to_pandas()
+    return pd.Series(snapshot["HASH"].to_numpy(), index=snapshot["ID"])
+
+
+def save_snapshot(s3_client, bucket, table, ids, hashes, prefix=DEFAULT_PREFIX):
+    snapshot = pa.Table.from_arrays([pa.array(ids, pa.string()), pa.array(hashes, pa.uint64())], schema=SCHEMA)
+    buffer = io.BytesIO()
+    pq.write_table(snapshot, buffer, compression="zstd")
+    s3_client.put_object(Bucket=bucket, Key=snapshot_key(table, prefix), Body=buffer.getvalue())
+
+
+def changed_rows(ids, hashes, previous):
+    """Boolean mask of the rows that are new or whose hash differs from the previous snapshot."""
+    if previous.empty:
+        return np.ones(len(hashes), dtype=bool)
+    # look the hashes up by position; reindex() would pass them through float64 and lose bits
+    position = previous.index.get_indexer(ids)
+    return (position == -1) | (previous.to_numpy()[position] != hashes)
@@ -4,12 +4,23 @@ import sys
 import argparse
 import pandas as pd
 import os
-import re
 import firecloud.api as fapi
 import pathlib
-from google.cloud import storage
-import boto3
+import threading
+import time
 import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# shared transfer engine lives at the top of the repo
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import gcs2s3
+import transfer_metrics
+from transfer_ledger import TransferLedger, DEFAULT_LEDGER, REVALIDATE_HELP
+from meta_index import MetaIndexWriter
+from export_large_tsv import download_table_from_workspace, read_terra_table
+from table_snapshot import fetch_generations, row_hashes, load_snapshot, save_snapshot, changed_rows
+from transfer_plan import detect_uri_columns, build_transfer_plan
 
 #----- ARGUMENTS -----#
 parser = argparse.ArgumentParser(
@@ -27,7 +38,7 @@ parser.add_argument('--workflow_name',
                     help = 'The name you would like the workflow to be saved under.')
 parser.add_argument('--sample_patterns',
                     nargs = "*",
-                    help = 'String patterns that should be extracted from the sample name. Only samples that match one of these pattern will be transferred. Multiple patterns separated by spaces can be supplied (Default: "*").')
+                    help = 'String patterns that should be extracted from the sample name. Only samples that match one of these pattern will be transferred. Multiple patterns separated by spaces can be supplied (Default: the whole sample name).')
 parser.add_argument('-u', 
                     '--uri',
                     help = 'URI path to target S3 bucket')
@@ -35,7 +46,29 @@ parser.add_argument('-o',
                     '--outdir',
                     default = 'data',
                     help = 'Directory to save results in the S3 bucket (Default: "data/")')
+parser.add_argument('--max_transfers',
+                    type = int,
+                    default = gcs2s3.DEFAULT_FILE_WORKERS,
+                    help = f'Number of files to transfer at once (Default: {gcs2s3.DEFAULT_FILE_WORKERS})')
+parser.add_argument('--ledger',
+                    default = DEFAULT_LEDGER,
+                    help = f'Local cache of files already copied to AWS (Default: {DEFAULT_LEDGER})')
+parser.add_argument('--force',
+                    action = 'store_true',
+                    help = 'Copy every file, even if an identical copy already exists in AWS.')
+parser.add_argument('--revalidate',
+                    action = 'store_true',
+                    help = REVALIDATE_HELP)
+parser.add_argument('--table_format',
+                    default = 'parquet',
+                    choices = ['parquet', 'tsv'],
+                    help = 'Format the Terra tables are staged in (locally and under terra_tbls/ in S3). parquet is typed and zstd-compressed (Default: parquet)')
+parser.add_argument('--ignore_snapshot',
+                    action = 'store_true',
+                    help = 'Migrate the files of every row, not just the rows added or changed since the last run.')
+transfer_metrics.add_arguments(parser)
 args = parser.parse_args()
+transfer_metrics.configure_from_args("waphl-terra2aws", args)
 
 #----- CONFIG PANDAS -----#
 pd.set_option("display.max_rows", 1000)
@@ -53,84 +86,132 @@ else:
 s3_bucket = args.uri.split('s3://')[1]
 if s3_bucket.endswith('/'):
         s3_bucket = s3_bucket[:-1]
-s3_client = boto3.client('s3')
+
+#----- CLIENTS -----#
+# one GCS and one S3 client shared by every transfer thread
+gcs_client, s3_client = gcs2s3.make_clients(args.max_transfers * gcs2s3.DEFAULT_PARTS_IN_FLIGHT)
+# files with an identical copy already in S3 are skipped unless --force is used
+ledger = None if args.force else TransferLedger(args.ledger, revalidate=args.revalidate)
 
 #------ DOWNLOAD ALL TABLES FOR WORKSPACE -----#
 # set local directory for staging terra tables
 local_dir: str = f"terra_tbls/"
 
 # get list of tables in workspace
-all_tables = fapi.list_entity_types(args.project, args.workspace).json()
+with transfer_metrics.span("list_tables", workspace=args.workspace):
+    all_tables = fapi.list_entity_types(args.project, args.workspace).json()
 # create directory
 pathlib.Path(local_dir).mkdir(parents=True, exist_ok=True)
 # download tables
+local_tables = []
 for table in all_tables:
     if '_set' not in table:
         print(f"Downloading table: {table}")
-        #os.system("python3 export_large_tsv.py -p "+args.project+" -w "+args.workspace+" -e "+table+" -f "+os.path.join(local_dir,table+".tsv"))
-
-# determine if there are any new tables
-new_tables = os.popen(f"aws s3 sync --dryrun --size-only {local_dir} s3://{s3_bucket}/terra_tbls/ | sed 's/(dryrun) upload: //g' | cut -f 1 -d ' '").read().split("\n")
-
-pathlib.Path('tmp').mkdir(parents=True, exist_ok=True)
-for table in new_tables[:-1]:
-    print(f"Migrating files from table: {table}")
-    df = pd.read_csv(table, sep = "\t")
-    df.rename(columns={ df.columns[0]: "sample" }, inplace = True)
-    gs_cols = ['sample']
-    for col in df.columns:
-        if "gs://" in df[col].to_string():
-            gs_cols.append(col)
-    if len(gs_cols) == 1:
-        print(f"No Google file paths detected. No files will be migrated")
-    else:
-        print(f"The following columns will be migrated: {gs_cols[:-1]}")
-        sample_name = None
-        meta = []
-        for index, row in df[gs_cols].iterrows():
-            for pattern in args.sample_patterns:
-                match = re.search(pattern, row['sample'])
-                if match:
-                    sample_name = match.group()
-            if not sample_name:
-                print(f"{row['sample']} does not match any of the supplied patterns ({args.sample_patterns}). Files for this sample will not be transferred.")
-            else:
-                for col in gs_cols[1:]:
-                    gs_path = row[col]
-                    if 'gs://' not in gs_path:
-                        print(f"No Google file detected in {col}.")
-                        file_name = None
-                    else:
-                        gs_path = gs_path.split('gs://')[1]
-                        gs_bucket = gs_path.split('/')[0]
-                        gs_blob = '/'.join(gs_path.split('/')[1:])
-                        file_name = gs_path.split('/')[-1]
-
-                        if args.target_workflow == gs_path.split('/')[3]:
-                            storage_client = storage.Client()
-                            bucket = storage_client.bucket(gs_bucket)
-                            blob = bucket.get_blob(gs_blob)
-                            file_time = blob.time_created.timestamp()
-                            blob.download_to_filename(f"tmp/{file_name}")
-
-                            s3_object = f"source={s3_outdir}/sample={sample_name}/workflow={args.workflow_name}/file={file_name}/timestamp={file_time}/{file_name}"
-                            s3_uri = f"s3://{s3_bucket}/{s3_object}"
-                            s3_client.upload_file(f"tmp/{file_name}", s3_bucket, s3_object)
-                    meta_row = [row['sample'], sample_name, file_name, row[col], s3_uri, file_time, "Terra", args.workspace, args.workflow_name]
-                    meta_cols = ["ID","ALT_ID","FILE","ORIGIN_PATH","CURRENT_PATH","TIMESTAMP","PLATFORM","WORKSPACE","WORKFLOW"]
-                    pd.DataFrame([meta_row], columns=meta_cols).to_csv('tmp/meta.csv', index=False)
-                    s3_meta_file = f"{sample_name}_{args.workflow_name}_{file_name}_{file_time}_meta.csv"
-                    s3_meta_object = f"meta/{s3_meta_file}"
-                    s3_client.upload_file(f"tmp/meta.csv", s3_bucket, s3_meta_object)
-
-
-
-
-
-
-
-                    
-
-
-
-
+        local_table = os.path.join(local_dir, f"{table}.{args.table_format}")
+        with transfer_metrics.span("download_table", table=table, format=args.table_format) as attrs:
+            download_table_from_workspace(args.project, args.workspace, table, local_table, fmt = args.table_format)
+            attrs["bytes"] = os.path.getsize(local_table)
+        local_tables.append((table, local_table))
+
+#----- MIGRATE FILES -----#
+# metadata records are buffered and written to s3://<bucket>/meta_index/ as partitioned Parquet
+meta_writer = MetaIndexWriter(s3_client, s3_bucket)
+worker_stats = defaultdict(lambda: [0, 0.0])  # thread name -> [bytes, seconds]
+stats_lock = threading.Lock()
+
+def migrate_file(sample, sample_name, gs_uri, gs_bucket, gs_blob, file_name):
+    """Stream one file from GCS to S3 and record its metadata. Runs in a worker thread."""
+    start = time.time()
+    with transfer_metrics.span("gcs_metadata", source=gs_uri):
+        blob = gcs_client.bucket(gs_bucket).get_blob(gs_blob)
+    if blob is None:
+        raise FileNotFoundError(f"{gs_uri} does not exist")
+    file_time = blob.time_created.timestamp()
+
+    s3_object = f"source={s3_outdir}/sample={sample_name}/workflow={args.workflow_name}/file={file_name}/timestamp={file_time}/{file_name}"
+    s3_uri = f"s3://{s3_bucket}/{s3_object}"
+    n_bytes = gcs2s3.stream_blob_to_s3(blob, s3_bucket, s3_object, s3_client, ledger=ledger)
+
+    meta_writer.add([sample, sample_name, file_name, gs_uri, s3_uri, file_time, "Terra", args.workspace, args.workflow_name])
+
+    seconds = time.time() - start
+    worker = threading.current_thread().name
+    with stats_lock:
+        worker_stats[worker][0] += n_bytes
+        worker_stats[worker][1] += seconds
+    print(f"[{worker}] {file_name}: {n_bytes / 1e6:.1f} MB in {seconds:.1f}s ({n_bytes / 1e6 / max(seconds, 1e-6):.1f} MB/s)", flush=True)
+    return n_bytes
+
+# the rows buffered so far are written even if a table fails, since their files are already in S3
+try:
+    for table, local_table in local_tables:
+        print(f"Migrating files from table: {table}")
+        with transfer_metrics.span("read_table", table=table) as attrs:
+            df = read_terra_table(local_table)
+            attrs["rows"] = len(df)
+        df.rename(columns={ df.columns[0]: "sample" }, inplace = True)
+        df["sample"] = df["sample"].astype(str)
+        gs_cols = detect_uri_columns(df.drop(columns = "sample"))
+        if not gs_cols:
+            print(f"No Google file paths detected. No files will be migrated")
+            continue
+
+        # only rows that are new, or whose values or gs:// files changed since the last run, are migrated
+        uris = pd.concat([df[col] for col in gs_cols]).dropna().astype(str)
+        with transfer_metrics.span("fetch_generations", table=table) as attrs:
+            generations, unlisted = fetch_generations(gcs_client, uris[uris.str.startswith("gs://")])
+            attrs.update(objects=len(generations), unlisted=len(unlisted))
+        with transfer_metrics.profile("row_hashes", table=table):
+            hashes = row_hashes(df, gs_cols, generations)
+        with transfer_metrics.span("load_snapshot", table=table):
+            previous = pd.Series(dtype="uint64") if args.ignore_snapshot else load_snapshot(s3_client, s3_bucket, table)
+        # rows with a file whose directory could not be listed are migrated and kept out of the snapshot
+        unlisted_rows = df[gs_cols].isin(unlisted).any(axis=1).to_numpy()
+        changed = changed_rows(df["sample"], hashes, previous) | unlisted_rows
+        transfer_metrics.count("rows", int(changed.sum()), table=table, status="changed")
+        transfer_metrics.count("rows", int(len(df) - changed.sum()), table=table, status="unchanged")
+        print(f"{changed.sum()} of {len(df)} row(s) added or changed since the last snapshot.")
+
+        print(f"The following columns will be migrated: {gs_cols}")
+        with transfer_metrics.profile("transfer_plan", table=table):
+            plan, unmatched = build_transfer_plan(df[changed], gs_cols, args.sample_patterns, args.target_workflow)
+        if unmatched:
+            print(f"{len(unmatched)} sample(s) do not match any of the supplied patterns ({args.sample_patterns}). Files for these samples will not be transferred: {', '.join(unmatched)}")
+        transfers = list(plan[["sample", "sample_name", "gs_uri", "bucket", "blob", "file"]].itertuples(index = False, name = None))
+
+        print(f"Transferring {len(transfers)} file(s) using {args.max_transfers} worker(s).")
+        table_start = time.time()
+        table_bytes = 0
+        failed = []
+        # unmatched samples stay out of the snapshot too, so they are picked up if the patterns change
+        failed_samples = set(unmatched)
+        with transfer_metrics.span("migrate_files", table=table, files=len(transfers)) as attrs, \
+                ThreadPoolExecutor(max_workers=args.max_transfers, thread_name_prefix="transfer") as pool:
+            futures = {pool.submit(migrate_file, *transfer): transfer for transfer in transfers}
+            for future in as_completed(futures):
+                try:
+                    table_bytes += future.result()
+                except Exception as e:
+                    failed.append(futures[future][2])
+                    failed_samples.add(futures[future][0])
+                    print(f"Failed to transfer {futures[future][2]}: {e}", flush=True)
+            attrs.update(bytes=table_bytes, failed=len(failed))
+        table_seconds = time.time() - table_start
+        transfer_metrics.count("samples", len(failed_samples), table=table, status="failed")
+        print(f"Finished {table}: {table_bytes / 1e6:.1f} MB in {table_seconds:.1f}s ({table_bytes / 1e6 / max(table_seconds, 1e-6):.1f} MB/s), {len(failed)} failed.")
+
+        # rows with failed transfers are left out of the snapshot so they are retried on the next run
+        with transfer_metrics.span("meta_flush", table=table):
+            meta_writer.flush()
+        keep = ~df["sample"].isin(failed_samples).to_numpy() & ~unlisted_rows
+        with transfer_metrics.span("save_snapshot", table=table, rows=int(keep.sum())):
+            save_snapshot(s3_client, s3_bucket, table, df["sample"][keep], hashes[keep])
+        with transfer_metrics.span("upload_table", table=table, bytes=os.path.getsize(local_table)):
+            s3_client.upload_file(local_table, s3_bucket, f"terra_tbls/{os.path.basename(local_table)}")
+finally:
+    with transfer_metrics.span("meta_flush"):
+        meta_writer.flush()
+
+print("Per-worker throughput:")
+for worker, (n_bytes, seconds) in sorted(worker_stats.items()):
+    print(f"  {worker}: {n_bytes / 1e6:.1f} MB in {seconds:.1f}s ({n_bytes / 1e6 / max(seconds, 1e-6):.1f} MB/s)")